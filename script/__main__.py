@@ -8,6 +8,7 @@ import do
 import os
 from pathlib import Path
 from setting.prompt import get_system_prompt
+from common.agent import run_json_protocol
 
 
 class ImagePromptInitializer:
@@ -71,11 +72,6 @@ class StreamHandler:
         self.value = ""
 
 
-def parse_message(message: str):
-    message = message.split("```json")[1].split("```")[0]
-    return json.loads(message)
-
-
 def main():
     # 无前端的测试代码
     system_prompt = get_system_prompt()
@@ -96,19 +92,9 @@ def main():
         "我想学习Python，有什么好的链接吗？",
     ]
     for prompt in prompts:
-        rsp = model(prompt)
-        data = parse_message(rsp)
-        while "tools" in data and data["tools"] != []:
-            results = []
-            for tool_calling in data["tools"]:
-                tool_name = tool_calling["name"]
-                tool_arg = tool_calling["args"]
-                if type(tool_arg) == str:
-                    tool_arg = json.loads(tool_arg)
-                result = tools.call_tool_by_name(tool_name, **tool_arg)
-                results.append({"name": tool_name, "result": str(result)})
-            rsp = model(str(results))
-            data = parse_message(rsp)
+        # 回复格式错误时会提醒模型重新回复，超出轮数、时间或token预算时结束
+        _, _, report = run_json_protocol(model, prompt)
+        print(report)
     Path("./data").mkdir(parents=True, exist_ok=True)
     with open("./data/result.json", "w", encoding="utf-8") as f:
         f.write(json.dumps(model.messages, ensure_ascii=False))
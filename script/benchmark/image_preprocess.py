@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import base64
+import tempfile
+
+from setting import settings, prompt
+from common.image import ImagePreprocessor, guess_mime
+from common.models.OpenAi import OpenAi
+
+"""
+图片预处理测试，在`script`目录下运行：
+python -m benchmark.image_preprocess [图片目录] [图片模型名称]
+
+对比原图与预处理后（按`IMAGE_MAX_EDGE`缩小、按`IMAGE_QUALITY`重新编码并去掉EXIF）的请求体大小与预处理耗时，
+第二次预处理命中磁盘缓存；给出图片模型名称时（需要可用的`API_URL`与`API_KEY`）再分别用两种图片请求一次，对比耗时
+"""
+
+EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif")
+
+
+def describe(model_name: str, data: bytes, mime: str):
+    model = OpenAi(
+        settings.API_URL,
+        settings.API_KEY,
+        model_name,
+        temperature=0,
+        max_tokens=256,
+        single_flight=False,
+    )
+    model.system_prompt = prompt.IMAGE_PROMPT
+    content = [
+        {"type": "text", "text": "描述这张图片"},
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": "data:{};base64,{}".format(
+                    mime, base64.b64encode(data).decode("utf-8")
+                )
+            },
+        },
+    ]
+    start = time.perf_counter()
+    model(content)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    image_dir = sys.argv[1] if len(sys.argv) > 1 else settings.UPLOAD_PATH
+    model_name = sys.argv[2] if len(sys.argv) > 2 else None
+    paths = [
+        os.path.join(image_dir, name)
+        for name in sorted(os.listdir(image_dir))
+        if name.lower().endswith(EXTENSIONS)
+    ]
+    preprocessor = ImagePreprocessor(
+        tempfile.mkdtemp(), max_edge=settings.IMAGE_MAX_EDGE, quality=settings.IMAGE_QUALITY
+    )
+
+    total_original, total_processed = 0, 0
+    latency_original, latency_processed = 0.0, 0.0
+    for path in paths:
+        with open(path, "rb") as f:
+            original = f.read()
+        start = time.perf_counter()
+        data, mime = preprocessor(path)
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        preprocessor(path)
+        cached = time.perf_counter() - start
+        # base64编码后的大小，即请求体中图片所占的大小
+        original_size = len(base64.b64encode(original))
+        processed_size = len(base64.b64encode(data))
+        total_original += original_size
+        total_processed += processed_size
+        line = "{:<30} {:>10} {:>9.1f}KB -> {:<10} {:>9.1f}KB preprocess: {:>7.1f}ms cached: {:>6.2f}ms".format(
+            os.path.basename(path)[:30],
+            guess_mime(path, original),
+            original_size / 1024,
+            mime,
+            processed_size / 1024,
+            first * 1000,
+            cached * 1000,
+        )
+        if model_name:
+            before = describe(model_name, original, guess_mime(path, original))
+            after = describe(model_name, data, mime)
+            latency_original += before
+            latency_processed += after
+            line += " latency: {:.2f}s -> {:.2f}s".format(before, after)
+        print(line)
+
+    if paths:
+        print(
+            "payload: {:.1f}KB -> {:.1f}KB ({:.1%})".format(
+                total_original / 1024,
+                total_processed / 1024,
+                total_processed / total_original,
+            )
+        )
+    if paths and model_name:
+        print(
+            "vision latency: {:.2f}s -> {:.2f}s".format(
+                latency_original / len(paths), latency_processed / len(paths)
+            )
+        )
@@ -0,0 +1,69 @@
+import sys
+import time
+
+from setting import prompt
+from common.kvcache import KVCacheManager
+from common.models.DeepseekLocal import DeepseekLocal
+
+"""
+本地模型系统提示缓存测试，对比新会话第一轮的耗时，在`script`目录下运行：
+python -m benchmark.local_prefix_cache [模型路径]
+
+系统提示使用`prompt.get_system_prompt()`（含完整的工具列表），每个会话只生成一个token，
+耗时基本等于预填充耗时。第一个会话需要计算系统提示，之后的会话复用共享的缓存
+"""
+
+SESSIONS = 5
+QUESTIONS = ["现在几点了？", "帮我查一下明天的天气", "介绍一下你自己", "1+1等于几？", "你能做什么？"]
+
+
+def run(loaded: DeepseekLocal, prefix_cache: bool):
+    kv_cache = KVCacheManager()
+    system_prompt = prompt.get_system_prompt()
+    times = []
+    for idx in range(SESSIONS):
+        # 共享已加载的模型，每次新建一个会话
+        session = DeepseekLocal(
+            loaded.model_path,
+            model=loaded.model,
+            tokenizer=loaded.tokenizer,
+            system_prompt=system_prompt,
+            max_tokens=1,
+            kv_cache=kv_cache,
+            prefix_cache=prefix_cache,
+        )
+        start = time.perf_counter()
+        session(QUESTIONS[idx % len(QUESTIONS)])
+        times.append(time.perf_counter() - start)
+        report = session.generation_report
+        print(
+            "prefix cache: {:<5} session {} prompt tokens: {:>5} reused: {:>5} prefilled: {:>5} {:.3f}s".format(
+                str(prefix_cache),
+                idx + 1,
+                report["prompt_tokens"],
+                report["reused_tokens"],
+                report["prefill_tokens"],
+                times[-1],
+            )
+        )
+    later = sum(times[1:]) / (len(times) - 1)
+    print(
+        "prefix cache: {:<5} first session {:.3f}s, later sessions avg {:.3f}s".format(
+            str(prefix_cache), times[0], later
+        )
+    )
+    return later
+
+
+if __name__ == "__main__":
+    model_path = (
+        sys.argv[1] if len(sys.argv) > 1 else "./model/DeepSeek-R1-Distill-Qwen-1.5B"
+    )
+    loaded = DeepseekLocal(model_path, prefix_cache=False)
+    without_cache = run(loaded, False)
+    with_cache = run(loaded, True)
+    print(
+        "new session first-turn latency: {:.3f}s -> {:.3f}s ({:.1f}x)".format(
+            without_cache, with_cache, without_cache / with_cache
+        )
+    )
@@ -0,0 +1,98 @@
+import sys
+import json
+import time
+import psutil
+import subprocess
+
+from common.kvcache import common_prefix_length
+from common.models.DeepseekLocal import load_model
+from transformers import AutoTokenizer
+
+"""
+本地模型量化对比，在`script`目录下运行：
+python -m benchmark.local_quantization [模型路径]
+
+每种量化方式在单独的进程中加载，比较内存占用（加载前后的RSS之差）、加载时间、贪心解码的速度，
+以及输出与fp32的一致程度（相同前缀的token比例，贪心解码一旦出现不同的token，之后的输出通常都会不同）
+"""
+
+MODES = ["fp32", "bf16", "int8"]
+PROMPTS = ["介绍一下你自己", "用Python写一个快速排序", "为什么天空是蓝色的？"]
+NEW_TOKENS = 64
+
+
+def measure(model_path: str, mode: str):
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    start = time.perf_counter()
+    model = load_model(model_path, "cpu", None if mode == "fp32" else mode)
+    load_time = time.perf_counter() - start
+    memory = process.memory_info().rss - rss
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    outputs = []
+    tokens = 0
+    generate_time = 0.0
+    for prompt in PROMPTS:
+        input_ids = tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}],
+            add_generation_prompt=True,
+            return_tensors="pt",
+        )
+        start = time.perf_counter()
+        output = model.generate(
+            input_ids,
+            do_sample=False,
+            max_new_tokens=NEW_TOKENS,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        generate_time += time.perf_counter() - start
+        outputs.append(output[0, input_ids.shape[1] :].tolist())
+        tokens += len(outputs[-1])
+    return {
+        "mode": mode,
+        "memory": memory,
+        "load_time": load_time,
+        "tokens_per_second": tokens / generate_time,
+        "outputs": outputs,
+    }
+
+
+def agreement(outputs: list[list[int]], reference: list[list[int]]):
+    same = sum(common_prefix_length(a, b) for a, b in zip(outputs, reference))
+    return same / max(sum(len(b) for b in reference), 1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        print(json.dumps(measure(sys.argv[3], sys.argv[2])))
+        sys.exit(0)
+
+    model_path = (
+        sys.argv[1] if len(sys.argv) > 1 else "./model/DeepSeek-R1-Distill-Qwen-1.5B"
+    )
+    results = []
+    for mode in MODES:
+        rsp = subprocess.run(
+            [sys.executable, "-m", "benchmark.local_quantization", "--child", mode, model_path],
+            capture_output=True,
+            text=True,
+        )
+        if rsp.returncode != 0:
+            print("{:<6} failed: {}".format(mode, rsp.stderr.strip().splitlines()[-1:]))
+            continue
+        results.append(json.loads(rsp.stdout.strip().splitlines()[-1]))
+
+    reference = results[0]["outputs"] if results and results[0]["mode"] == "fp32" else None
+    for result in results:
+        print(
+            "{:<6} memory: {:>8.1f}MB load: {:>6.2f}s {:>8.2f} tokens/s agreement: {}".format(
+                result["mode"],
+                result["memory"] / 1024**2,
+                result["load_time"],
+                result["tokens_per_second"],
+                "{:.1%}".format(agreement(result["outputs"], reference))
+                if reference
+                else "-",
+            )
+        )
@@ -0,0 +1,67 @@
+import sys
+import time
+
+from common.kvcache import KVCacheManager
+from common.models.DeepseekLocal import DeepseekLocal
+
+"""
+本地模型投机解码测试，在`script`目录下运行：
+python -m benchmark.local_speculative [主模型路径] [草稿模型路径] [每次预测的token数]
+
+对比不使用与使用草稿模型时的解码速度，并给出草稿token的接受率
+"""
+
+PROMPTS = ["介绍一下你自己", "用Python写一个快速排序", "为什么天空是蓝色的？"]
+MAX_TOKENS = 128
+
+
+def run(loaded: DeepseekLocal, draft: DeepseekLocal | None, draft_tokens: int):
+    tokens = 0
+    decode_time = 0.0
+    draft_total = 0
+    accepted = 0
+    start = time.perf_counter()
+    for prompt in PROMPTS:
+        session = DeepseekLocal(
+            loaded.model_path,
+            model=loaded.model,
+            tokenizer=loaded.tokenizer,
+            draft_model=None if draft is None else draft.model,
+            draft_tokenizer=None if draft is None else draft.tokenizer,
+            draft_tokens=draft_tokens,
+            tempture=1e-5,
+            max_tokens=MAX_TOKENS,
+            max_new_tokens=MAX_TOKENS,
+            kv_cache=KVCacheManager(),
+            prefix_cache=False,
+        )
+        session(prompt)
+        report = session.generation_report
+        tokens += report["decode_tokens"]
+        decode_time += report["decode_time"]
+        draft_total += report["draft_tokens"]
+        accepted += report["accepted_tokens"]
+    total = time.perf_counter() - start
+    speed = tokens / decode_time if decode_time else 0
+    print(
+        "{:<12} decode: {:>8.2f} tokens/s total: {:>7.2f}s acceptance: {}".format(
+            "speculative" if draft is not None else "baseline",
+            speed,
+            total,
+            "{:.1%} ({}/{})".format(accepted / draft_total, accepted, draft_total)
+            if draft_total
+            else "-",
+        )
+    )
+    return speed
+
+
+if __name__ == "__main__":
+    model_path = sys.argv[1] if len(sys.argv) > 1 else "./model/DeepSeek-R1-Distill-Qwen-7B"
+    draft_path = sys.argv[2] if len(sys.argv) > 2 else "./model/DeepSeek-R1-Distill-Qwen-1.5B"
+    draft_tokens = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    loaded = DeepseekLocal(model_path, draft_path=None, prefix_cache=False)
+    draft = DeepseekLocal(draft_path, draft_path=None, prefix_cache=False)
+    baseline = run(loaded, None, draft_tokens)
+    speculative = run(loaded, draft, draft_tokens)
+    print("net speedup: {:.2f}x".format(speculative / baseline if baseline else 0))
@@ -0,0 +1,84 @@
+import sys
+
+from setting import settings, prompt
+from common.context import layout_rag_prompt
+from common.models.OpenAi import OpenAi
+from common.telemetry import Telemetry
+
+"""
+RAG对话前缀缓存命中率测试，需要可用的`API_URL`与`API_KEY`，在`script`目录下运行：
+python -m benchmark.rag_prompt_cache [模型名称]
+
+分别以"system"与"user"两种方式组装多轮RAG对话，每轮检索到不同的参考文档，
+统计服务商在`usage`中返回的缓存命中token数（`prompt_tokens_details.cached_tokens`或`prompt_cache_hit_tokens`）。
+服务商通常只缓存超过一定长度（如1024个token）的前缀，且缓存需要几秒才能生效，因此前几轮的命中率可能为0
+"""
+
+TURNS = 6
+DOCUMENTS_PER_TURN = 4
+MAX_TOKENS = 64
+
+
+def make_documents(turn: int):
+    documents = ""
+    for idx in range(DOCUMENTS_PER_TURN):
+        documents += "文件名：manual-{}.md\n".format(turn)
+        documents += "开始行数：{}\n".format(idx * 40)
+        documents += "结束行数：{}\n".format(idx * 40 + 39)
+        documents += "相关度：{}\n".format(0.9 - idx * 0.1)
+        documents += "内容：\n{}\n\n".format(
+            "第{}章第{}节：设备在运行过程中需要定期检查电源、散热与网络连接，".format(turn, idx) * 12
+        )
+    return documents
+
+
+def run(model_name: str, layout: str):
+    events = []
+    telemetry = Telemetry()
+    telemetry.add_hook(events.append)
+    history = []
+    for turn in range(TURNS):
+        question = "第{}个问题：设备第{}章的维护步骤是什么？".format(turn + 1, turn + 1)
+        model = OpenAi(
+            settings.API_URL,
+            settings.API_KEY,
+            model_name,
+            temperature=0,
+            max_tokens=MAX_TOKENS,
+            single_flight=False,
+            telemetry=telemetry,
+        )
+        model.messages, _prompt = layout_rag_prompt(
+            history, prompt.RAG_PROMPT, question, make_documents(turn), layout
+        )
+        answer = model(_prompt)
+        # 与前端一样，历史对话中只保存用户的原始问题
+        history.append({"role": "user", "content": question})
+        history.append({"role": "assistant", "content": answer})
+
+    prompt_tokens = sum(event["prompt_tokens"] for event in events)
+    cached_tokens = sum(event["cached_tokens"] for event in events)
+    for turn, event in enumerate(events):
+        print(
+            "{:<8} turn {} prompt tokens: {:>6} cached tokens: {:>6} ttft: {:.2f}s".format(
+                layout,
+                turn + 1,
+                event["prompt_tokens"],
+                event["cached_tokens"],
+                event["ttft"] or 0,
+            )
+        )
+    print(
+        "{:<8} total  prompt tokens: {:>6} cached tokens: {:>6} cached ratio: {:.1%}".format(
+            layout,
+            prompt_tokens,
+            cached_tokens,
+            cached_tokens / prompt_tokens if prompt_tokens else 0,
+        )
+    )
+
+
+if __name__ == "__main__":
+    model_name = sys.argv[1] if len(sys.argv) > 1 else settings.DEFAULT_MODEL
+    for layout in ("system", "user"):
+        run(model_name, layout)
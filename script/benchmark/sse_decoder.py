@@ -0,0 +1,103 @@
+import copy
+import json
+import random
+import time
+
+from common import sse
+
+"""
+SSE解析微基准测试，在`script`目录下运行：
+python -m benchmark.sse_decoder
+
+对比旧的逐块解析方式（逐块解码、strip、json.loads、deepcopy）与`common.sse`的增量解析：
+aligned: 每个数据块恰好是一个事件（理想情况，旧方式可以正确解析）
+random: 数据块在任意位置被切分（实际网络情况，旧方式会丢失事件）
+"""
+
+TOKENS = 20000
+ROUNDS = 5
+
+
+def make_stream(n: int):
+    words = ["你好", "，", "这是", "一个", "测试", " the", " quick", " fox", "\n", "。"]
+    events = []
+    for idx in range(n):
+        obj = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "bench",
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"content": words[idx % len(words)]},
+                    "finish_reason": None,
+                }
+            ],
+        }
+        events.append(
+            "data: {}\n\n".format(json.dumps(obj, ensure_ascii=False)).encode("utf-8")
+        )
+    events.append(b"data: [DONE]\n\n")
+    return events
+
+
+def split_randomly(data: bytes, seed: int = 0):
+    rng = random.Random(seed)
+    chunks = []
+    idx = 0
+    while idx < len(data):
+        size = rng.randint(1, 512)
+        chunks.append(data[idx : idx + size])
+        idx += size
+    return chunks
+
+
+def legacy_parse(chunks):
+    tokens = []
+    dropped = 0
+    for line in chunks:
+        line = line.decode("utf-8", errors="ignore").strip()
+        if line.startswith("data:"):
+            line = line[5:]
+            if line.find("[DONE]") != -1:
+                break
+            try:
+                obj = json.loads(line)
+            except json.JSONDecodeError:
+                dropped += 1
+                continue
+            content = obj["choices"][0]["delta"].get("content")
+            tokens.append(copy.deepcopy(content or ""))
+    return tokens, dropped
+
+
+def decoder_parse(chunks):
+    tokens = []
+    for event in sse.iter_events(chunks):
+        if event.is_done:
+            continue
+        content = event.json()["choices"][0]["delta"].get("content")
+        tokens.append(content or "")
+    return tokens, 0
+
+
+def bench(name: str, func, chunks):
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        tokens, dropped = func(chunks)
+        best = min(best, time.perf_counter() - start)
+    print(
+        "{:<8} {:<16} tokens: {:>6} dropped chunks: {:>6} {:>12.0f} tokens/s".format(
+            name, func.__name__, len(tokens), dropped, len(tokens) / best
+        )
+    )
+
+
+if __name__ == "__main__":
+    events = make_stream(TOKENS)
+    random_chunks = split_randomly(b"".join(events))
+    for name, chunks in (("aligned", events), ("random", random_chunks)):
+        bench(name, legacy_parse, chunks)
+        bench(name, decoder_parse, chunks)
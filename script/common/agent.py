@@ -0,0 +1,210 @@
+import json
+import time
+
+from contextlib import contextmanager
+from setting import settings
+import tools
+
+"""
+智能体循环，模型与工具交替执行，直到模型给出最终回答或超出预算
+原生工具调用（function calling）与System-Prompt中约定的JSON协议共用该循环，每次请求都受轮数、时间与token数的限制
+"""
+
+FORMAT_ERROR_PROMPT = """你的回复不符合要求的JSON结构，请按照系统提示中的回复结构重新回复，注意保留包围JSON的```json标识块"""
+
+
+class AgentRound:
+    """
+    一轮模型调用与工具执行的记录
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.model_time = 0.0
+        self.tool_time = 0.0
+        self.tool_calls = 0
+        self.tokens = 0
+
+    @contextmanager
+    def timing(self, name: str):
+        """
+        计时，`name`为"model"或"tool"
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cost = time.perf_counter() - start
+            if name == "model":
+                self.model_time += cost
+            else:
+                self.tool_time += cost
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "model_time": self.model_time,
+            "tool_time": self.tool_time,
+            "tool_calls": self.tool_calls,
+            "tokens": self.tokens,
+        }
+
+
+class AgentLoop:
+    """
+    智能体循环的预算控制
+    ----------------
+    迭代该对象得到每一轮的记录，超出轮数、时间或token预算时迭代结束；模型给出最终回答时调用`finish`
+    :param max_rounds: 最大轮数（每轮一次模型调用）
+    :param deadline: 整个请求的最长时间（秒）
+    :param token_budget: 整个请求最多消耗的token数（输入与输出之和），为0时不限制
+    """
+
+    def __init__(
+        self,
+        max_rounds: int | None = None,
+        deadline: float | None = None,
+        token_budget: int | None = None,
+    ):
+        self.max_rounds = settings.AGENT_MAX_ROUNDS if max_rounds is None else max_rounds
+        self.deadline = settings.AGENT_DEADLINE if deadline is None else deadline
+        self.token_budget = (
+            settings.AGENT_TOKEN_BUDGET if token_budget is None else token_budget
+        )
+        self.rounds: list[AgentRound] = []
+        self.stop_reason = None
+        self.__start = None
+
+    def __iter__(self):
+        self.__start = time.monotonic()
+        self.rounds = []
+        self.stop_reason = None
+        for _ in range(self.max_rounds):
+            reason = self.exceeded()
+            if reason is not None:
+                self.stop_reason = reason
+                return
+            yield self.add_round()
+            if self.stop_reason is not None:
+                return
+        self.stop_reason = "max_rounds"
+
+    def add_round(self):
+        """
+        新增一轮记录，循环结束后额外的请求（如要求模型直接回答）也应通过该方法记录
+        """
+        agent_round = AgentRound(len(self.rounds))
+        self.rounds.append(agent_round)
+        return agent_round
+
+    def stop(self, reason: str):
+        """
+        结束循环，下一次迭代时停止
+        """
+        self.stop_reason = reason
+
+    def finish(self):
+        """
+        模型给出了最终回答，结束循环
+        """
+        self.stop("finished")
+
+    @property
+    def finished(self):
+        return self.stop_reason == "finished"
+
+    @property
+    def tokens(self):
+        return sum(agent_round.tokens for agent_round in self.rounds)
+
+    def remaining(self):
+        """
+        距离截止时间的剩余秒数
+        """
+        if self.__start is None:
+            return self.deadline
+        return max(self.deadline - (time.monotonic() - self.__start), 0)
+
+    def exceeded(self):
+        """
+        检查预算，超出时返回原因，否则返回None
+        """
+        if self.remaining() <= 0:
+            return "deadline"
+        if self.token_budget and self.tokens >= self.token_budget:
+            return "token_budget"
+        return None
+
+    def report(self):
+        return {
+            "rounds": [agent_round.to_dict() for agent_round in self.rounds],
+            "stop_reason": self.stop_reason,
+            "tokens": self.tokens,
+            "elapsed": self.deadline - self.remaining(),
+        }
+
+
+def parse_json_reply(message: str):
+    """
+    解析System-Prompt约定的JSON结构回复，格式不正确时返回None
+    """
+    try:
+        if "```json" in message:
+            message = message.split("```json")[1].split("```")[0]
+        data = json.loads(message)
+    except (ValueError, IndexError, TypeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
+
+
+def run_json_protocol(model, prompt: str, agent_loop: AgentLoop | None = None):
+    """
+    使用System-Prompt约定的JSON协议运行智能体循环
+    ---------------------
+    模型回复中的`tools`字段会被并发执行，结果以用户的身份返回给模型，直到模型不再调用工具或超出预算。
+    回复格式不正确时提醒模型按格式重新回复（计为一轮），不会直接中断
+    :param model: 模型，需为可调用对象，输入提示词返回回复，如`OpenAi`；模型有`deadline`属性时每轮调用期间设为剩余的时间
+    :param prompt: 用户输入
+    :param agent_loop: 预算控制，默认使用`settings`中的配置
+    :return: (最后一次的回复, 解析后的回复（格式不正确时为None）, 循环报告)
+    """
+    agent_loop = AgentLoop() if agent_loop is None else agent_loop
+    rsp, data = "", None
+    next_prompt = prompt
+    for agent_round in agent_loop:
+        with agent_round.timing("model"):
+            if hasattr(model, "deadline"):
+                # 模型调用的时间同样计入截止时间，不能超出剩余的时间，调用结束后恢复模型原有的设置
+                deadline, model.deadline = model.deadline, agent_loop.remaining()
+                try:
+                    rsp = model(next_prompt)
+                finally:
+                    model.deadline = deadline
+            else:
+                rsp = model(next_prompt)
+        agent_report = getattr(model, "agent_report", None)
+        if agent_report:
+            agent_round.tokens = agent_report["tokens"]
+        data = parse_json_reply(rsp)
+        if data is None:
+            next_prompt = FORMAT_ERROR_PROMPT
+            continue
+        tool_callings = [
+            {"name": tool_calling["name"], "args": tool_calling.get("args")}
+            for tool_calling in data.get("tools") or []
+            if isinstance(tool_calling, dict) and "name" in tool_calling
+        ]
+        if not tool_callings:
+            agent_loop.finish()
+            break
+        agent_round.tool_calls = len(tool_callings)
+        with agent_round.timing("tool"):
+            results = tools.call_tools(
+                tool_callings, timeout=min(settings.TOOL_TIMEOUT, agent_loop.remaining())
+            )
+        next_prompt = str(
+            [{"name": result["name"], "result": str(result["result"])} for result in results]
+        )
+    return rsp, data, agent_loop.report()
@@ -0,0 +1,545 @@
+import time
+import random
+import asyncio
+import threading
+
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from setting import settings
+
+"""
+多个兼容OpenAI的服务地址之间的负载均衡
+按权重选择进行中请求最少的地址，连续失败的地址会被熔断一段时间；失败的请求在重试预算内换一个地址重试，
+非流式请求还可以在等待超过近期P95耗时后向另一个地址发出对冲请求，取先返回的结果
+"""
+
+# 需要换一个地址重试的状态码
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class Endpoint:
+    """
+    一个服务地址
+    ----------------
+    :param url: 基础地址
+    :param api_key: api_key
+    :param weight: 权重，权重越大分到的请求越多
+    """
+
+    def __init__(self, url: str, api_key: str, weight: float = 1):
+        self.url = url
+        self.api_key = api_key
+        self.weight = weight
+
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        # 熔断器状态
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "state": self.state,
+        }
+
+
+class EndpointPool:
+    """
+    服务地址池
+    ----------------
+    :param endpoints: 地址列表
+    :param failure_threshold: 连续失败多少次后熔断
+    :param cooldown: 熔断持续时间（秒），之后放行一个试探请求，成功则恢复
+    :param max_retries: 单个请求的最大重试次数
+    :param retry_budget: 重试预算，每个请求积累的重试次数，如0.2表示重试数最多约为请求数的20%
+    :param backoff_base: 重试退避的基础时间（秒），第n次重试在[0, base * 2^n]内随机等待
+    :param backoff_max: 重试退避的最长时间（秒）
+    :param hedge: 是否对非流式请求发出对冲请求
+    :param hedge_quantile: 对冲请求的等待时间取近期耗时的该分位数
+    :param hedge_min_samples: 耗时样本数不足该数量时不发出对冲请求
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        failure_threshold: int = 5,
+        cooldown: float = 30,
+        max_retries: int = 2,
+        retry_budget: float = 0.2,
+        backoff_base: float = 0.2,
+        backoff_max: float = 5,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_samples: int = 20,
+    ):
+        if not endpoints:
+            raise ValueError("endpoints must not be empty")
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+
+        self.__lock = threading.Lock()
+        # 非流式请求的耗时样本，用于计算对冲请求的等待时间
+        self.__latencies = deque(maxlen=500)
+        # 重试预算，初始允许少量重试，上限避免长时间空闲后积累过多
+        self.__retry_tokens = 10.0
+        self.__retries = 0
+        self.__retries_denied = 0
+        self.__hedges = 0
+        self.__hedge_wins = 0
+        self.__executor = None
+
+    # 选择与统计
+
+    def select(self, exclude=()):
+        """
+        选择一个地址：在熔断器放行的地址中选择（进行中请求数 + 1）/ 权重最小的，相同时随机
+        所有地址都被熔断时忽略熔断器，避免整个服务不可用
+        """
+        now = time.monotonic()
+        with self.__lock:
+            candidates = [
+                endpoint
+                for endpoint in self.endpoints
+                if endpoint not in exclude and self.__allow(endpoint, now)
+            ]
+            if not candidates:
+                candidates = [
+                    endpoint for endpoint in self.endpoints if endpoint not in exclude
+                ] or list(self.endpoints)
+            best = min(
+                candidates,
+                key=lambda endpoint: (
+                    (endpoint.outstanding + 1) / endpoint.weight,
+                    random.random(),
+                ),
+            )
+            if best.state == HALF_OPEN:
+                best.probing = True
+            best.outstanding += 1
+            best.requests += 1
+        return best
+
+    def __allow(self, endpoint: Endpoint, now: float):
+        # 调用时需持有锁
+        if endpoint.state == CLOSED:
+            return True
+        if endpoint.state == OPEN and now - endpoint.opened_at >= self.cooldown:
+            endpoint.state = HALF_OPEN
+            endpoint.probing = False
+        # 半开状态只放行一个试探请求
+        return endpoint.state == HALF_OPEN and not endpoint.probing
+
+    def done(self, endpoint: Endpoint, success: bool, latency: float | None = None):
+        """
+        请求结束，更新进行中请求数与熔断器状态
+        -----------------
+        :param success: 地址是否正常（返回了非重试状态码）
+        :param latency: 非流式请求的耗时，用于计算对冲等待时间
+        """
+        with self.__lock:
+            endpoint.outstanding -= 1
+            endpoint.probing = False
+            if success:
+                endpoint.state = CLOSED
+                endpoint.consecutive_failures = 0
+                if latency is not None:
+                    self.__latencies.append(latency)
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if (
+                endpoint.state == HALF_OPEN
+                or endpoint.consecutive_failures >= self.failure_threshold
+            ):
+                endpoint.state = OPEN
+                endpoint.opened_at = time.monotonic()
+
+    def deposit(self):
+        # 每个请求为重试预算积累一部分
+        with self.__lock:
+            self.__retry_tokens = min(self.__retry_tokens + self.retry_budget, 10.0)
+
+    def withdraw(self):
+        """
+        从重试预算中取出一次重试，预算不足时返回False
+        """
+        with self.__lock:
+            if self.__retry_tokens < 1:
+                self.__retries_denied += 1
+                return False
+            self.__retry_tokens -= 1
+            self.__retries += 1
+            return True
+
+    def backoff(self, attempt: int):
+        """
+        第`attempt`次重试前的等待时间（全抖动的指数退避）
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def hedge_delay(self):
+        """
+        对冲请求的等待时间，样本不足时返回None
+        """
+        with self.__lock:
+            if len(self.__latencies) < self.hedge_min_samples:
+                return None
+            samples = sorted(self.__latencies)
+        return samples[min(int(len(samples) * self.hedge_quantile), len(samples) - 1)]
+
+    def stats(self):
+        delay = self.hedge_delay()
+        with self.__lock:
+            return {
+                "endpoints": [endpoint.to_dict() for endpoint in self.endpoints],
+                "retries": self.__retries,
+                "retries_denied": self.__retries_denied,
+                "retry_tokens": self.__retry_tokens,
+                "hedges": self.__hedges,
+                "hedge_wins": self.__hedge_wins,
+                "hedge_delay": delay,
+            }
+
+    # 请求
+
+    def request(
+        self,
+        transport,
+        method: str,
+        path: str,
+        headers,
+        body: str | bytes | None = None,
+        stream: bool = False,
+        timeout: float | None = None,
+    ):
+        """
+        通过同步连接池发送请求，失败时在重试预算内换一个地址重试
+        -----------------
+        :param transport: `HttpTransport`
+        :param path: 接口路径，如"/chat/completions"
+        :param headers: 请求头函数，输入地址的api_key，返回请求头
+        :param stream: 是否流式读取，流式请求只在收到响应头之前重试，不发出对冲请求
+        :return: `urllib3.BaseHTTPResponse`，所有尝试都失败时返回最后一次的响应或抛出最后一次的异常
+        """
+        self.deposit()
+        tried = []
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff(attempt - 1))
+            hedge = self.hedge and not stream and attempt == 0
+            try:
+                if hedge:
+                    rsp = self.__hedged(
+                        transport, method, path, headers, body, timeout, tried
+                    )
+                else:
+                    endpoint = self.select(exclude=tried)
+                    tried.append(endpoint)
+                    rsp = self.__attempt(
+                        transport, endpoint, method, path, headers, body, stream, timeout
+                    )
+            except transport.errors:
+                if attempt == self.max_retries or not self.withdraw():
+                    raise
+                continue
+            if rsp.status not in RETRY_STATUS:
+                return rsp
+            if attempt == self.max_retries or not self.withdraw():
+                return rsp
+            if stream:
+                transport.release(rsp)
+        return rsp
+
+    def __attempt(
+        self, transport, endpoint, method, path, headers, body, stream, timeout
+    ):
+        # 向一个地址发送请求，调用前已通过`select`计入进行中请求
+        start = time.monotonic()
+        try:
+            rsp = transport.request(
+                method,
+                endpoint.url + path,
+                headers=headers(endpoint.api_key),
+                body=body,
+                stream=stream,
+                timeout=timeout,
+            )
+        except Exception:
+            self.done(endpoint, False)
+            raise
+        success = rsp.status not in RETRY_STATUS
+        self.done(
+            endpoint, success, None if stream else time.monotonic() - start
+        )
+        # 记录实际请求的地址，供遥测使用
+        rsp.endpoint_url = endpoint.url
+        return rsp
+
+    def __hedged(self, transport, method, path, headers, body, timeout, tried):
+        # 先向一个地址发送请求，超过对冲等待时间仍未返回时向另一个地址再发一次，取先成功返回的结果
+        delay = self.hedge_delay()
+        first = self.select(exclude=tried)
+        tried.append(first)
+        if delay is None or len(self.endpoints) < 2:
+            return self.__attempt(
+                transport, first, method, path, headers, body, False, timeout
+            )
+        executor = self.__get_executor()
+        futures = [
+            executor.submit(
+                self.__attempt, transport, first, method, path, headers, body, False, timeout
+            )
+        ]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            second = self.select(exclude=tried)
+            tried.append(second)
+            with self.__lock:
+                self.__hedges += 1
+            futures.append(
+                executor.submit(
+                    self.__attempt, transport, second, method, path, headers, body, False, timeout
+                )
+            )
+        pending = set(futures)
+        result = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and future.result().status not in RETRY_STATUS:
+                    if future is not futures[0]:
+                        with self.__lock:
+                            self.__hedge_wins += 1
+                    # 落后的请求在后台完成，非流式响应读取完毕后连接会自动归还
+                    return future.result()
+                result = future
+        return result.result()
+
+    def __get_executor(self):
+        with self.__lock:
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(
+                    max_workers=settings.HTTP_POOL_MAXSIZE,
+                    thread_name_prefix="hedge",
+                )
+            return self.__executor
+
+    async def arequest(
+        self,
+        transport,
+        method: str,
+        path: str,
+        headers,
+        body: str | bytes | None = None,
+        timeout: float | None = None,
+    ):
+        """
+        `request`的异步版本，读取完整响应体
+        -----------------
+        :param transport: `AsyncHttpTransport`
+        :return: `httpx.Response`
+        """
+        self.deposit()
+        tried = []
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff(attempt - 1))
+            try:
+                if self.hedge and attempt == 0:
+                    rsp = await self.__ahedged(
+                        transport, method, path, headers, body, timeout, tried
+                    )
+                else:
+                    endpoint = self.select(exclude=tried)
+                    tried.append(endpoint)
+                    rsp = await self.__aattempt(
+                        transport, endpoint, method, path, headers, body, timeout
+                    )
+            except transport.errors:
+                if attempt == self.max_retries or not self.withdraw():
+                    raise
+                continue
+            if rsp.status_code not in RETRY_STATUS:
+                return rsp
+            if attempt == self.max_retries or not self.withdraw():
+                return rsp
+        return rsp
+
+    async def __aattempt(self, transport, endpoint, method, path, headers, body, timeout):
+        start = time.monotonic()
+        success = False
+        try:
+            rsp = await transport.request(
+                method,
+                endpoint.url + path,
+                headers=headers(endpoint.api_key),
+                body=body,
+                timeout=timeout,
+            )
+            success = rsp.status_code not in RETRY_STATUS
+            rsp.endpoint_url = endpoint.url
+            return rsp
+        finally:
+            self.__adone(endpoint, success, start)
+
+    def __adone(self, endpoint, success, start):
+        task = asyncio.current_task()
+        if task is not None and task.cancelling():
+            # 被取消的对冲请求不计为地址失败
+            with self.__lock:
+                endpoint.outstanding -= 1
+                endpoint.probing = False
+            return
+        self.done(endpoint, success, time.monotonic() - start if success else None)
+
+    async def __ahedged(self, transport, method, path, headers, body, timeout, tried):
+        delay = self.hedge_delay()
+        first = self.select(exclude=tried)
+        tried.append(first)
+        if delay is None or len(self.endpoints) < 2:
+            return await self.__aattempt(
+                transport, first, method, path, headers, body, timeout
+            )
+        tasks = [
+            asyncio.create_task(
+                self.__aattempt(transport, first, method, path, headers, body, timeout)
+            )
+        ]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            second = self.select(exclude=tried)
+            tried.append(second)
+            with self.__lock:
+                self.__hedges += 1
+            tasks.append(
+                asyncio.create_task(
+                    self.__aattempt(transport, second, method, path, headers, body, timeout)
+                )
+            )
+        pending = set(tasks)
+        result = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result().status_code not in RETRY_STATUS:
+                        if task is not tasks[0]:
+                            with self.__lock:
+                                self.__hedge_wins += 1
+                        return task.result()
+                    result = task
+        finally:
+            # 取消落后的请求
+            for task in pending:
+                task.cancel()
+        return result.result()
+
+    @asynccontextmanager
+    async def astream(
+        self,
+        transport,
+        method: str,
+        path: str,
+        headers,
+        body: str | bytes | None = None,
+        timeout: float | None = None,
+    ):
+        """
+        异步流式请求，只在收到响应头之前重试，退出时归还连接
+        -----------------
+        :param transport: `AsyncHttpTransport`
+        :return: `AsyncContextManager[httpx.Response]`
+        """
+        self.deposit()
+        tried = []
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff(attempt - 1))
+            endpoint = self.select(exclude=tried)
+            tried.append(endpoint)
+            last = attempt == self.max_retries
+            stack = AsyncExitStack()
+            try:
+                rsp = await stack.enter_async_context(
+                    transport.stream(
+                        method,
+                        endpoint.url + path,
+                        headers=headers(endpoint.api_key),
+                        body=body,
+                        timeout=timeout,
+                    )
+                )
+            except transport.errors:
+                await stack.aclose()
+                self.done(endpoint, False)
+                if last or not self.withdraw():
+                    raise
+                continue
+            success = rsp.status_code not in RETRY_STATUS
+            self.done(endpoint, success)
+            if not success and not last and self.withdraw():
+                await stack.aclose()
+                continue
+            rsp.endpoint_url = endpoint.url
+            async with stack:
+                yield rsp
+            return
+
+
+def _build_endpoint_pool():
+    endpoints = [
+        Endpoint(
+            endpoint["url"],
+            endpoint.get("api_key", settings.API_KEY),
+            endpoint.get("weight", 1),
+        )
+        for endpoint in settings.API_ENDPOINTS
+    ] or [Endpoint(settings.API_URL, settings.API_KEY)]
+    return EndpointPool(
+        endpoints,
+        failure_threshold=settings.ENDPOINT_FAILURE_THRESHOLD,
+        cooldown=settings.ENDPOINT_COOLDOWN,
+        max_retries=settings.ENDPOINT_MAX_RETRIES,
+        retry_budget=settings.ENDPOINT_RETRY_BUDGET,
+        backoff_base=settings.ENDPOINT_BACKOFF_BASE,
+        backoff_max=settings.ENDPOINT_BACKOFF_MAX,
+        hedge=settings.ENDPOINT_HEDGE,
+        hedge_quantile=settings.ENDPOINT_HEDGE_QUANTILE,
+    )
+
+
+_endpoint_pool = None
+_endpoint_pool_lock = threading.Lock()
+
+
+def get_endpoint_pool() -> EndpointPool:
+    """
+    获取进程内共享的地址池，首次调用时按`settings.API_ENDPOINTS`创建，未配置时只含`API_URL`
+    """
+    global _endpoint_pool
+    if _endpoint_pool is None:
+        with _endpoint_pool_lock:
+            if _endpoint_pool is None:
+                _endpoint_pool = _build_endpoint_pool()
+    return _endpoint_pool
@@ -0,0 +1,290 @@
+import time
+import queue
+import torch
+import threading
+
+from collections import deque
+from setting import settings
+from transformers import AutoTokenizer, StoppingCriteria, StoppingCriteriaList
+from common.models.DeepseekLocal import IncrementalDecoder, load_model
+
+"""
+本地模型的动态批处理
+短时间内到达的多个请求合并为一个批次交给`generate`，每生成一步就把各请求新生成的文本分发给对应的调用方；
+一个批次中的请求各自结束（遇到结束符、达到最大长度或被取消），全部结束后开始下一个批次
+"""
+
+
+class BatchRequest:
+    """
+    一个批处理请求
+    ----------------
+    迭代该对象可逐段取得生成的文本，请求出错时迭代会抛出该错误
+    """
+
+    def __init__(
+        self,
+        input_ids: list[int],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        tokenizer,
+    ):
+        self.input_ids = input_ids
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+
+        self.decoder = IncrementalDecoder(tokenizer)
+        self.finished = False
+        self.finish_reason = None
+        self.cancelled = False
+        self.error = None
+        self.created = time.perf_counter()
+        self.ttft = None
+        self.__queue = queue.Queue()
+
+    def sampling_key(self):
+        # 采样参数相同的请求才能放在同一个批次中
+        return (self.temperature, self.top_p)
+
+    @property
+    def tokens(self) -> list[int]:
+        return self.decoder.tokens
+
+    def append(self, token: int):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.created
+        delta = self.decoder.put(token)
+        if delta:
+            self.__queue.put(delta)
+
+    def finish(self, reason: str):
+        if self.finished:
+            return
+        self.finished = True
+        self.finish_reason = reason
+        self.__queue.put(None)
+
+    def fail(self, error: Exception):
+        self.error = error
+        self.finish("error")
+
+    def cancel(self):
+        """
+        取消请求，生成下一个token时停止该请求
+        """
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            delta = self.__queue.get()
+            if delta is None:
+                break
+            yield delta
+        if self.error is not None:
+            raise self.error
+
+
+class _BatchStreamer:
+    """
+    `generate`的streamer，将每一步生成的token分发给对应的请求
+    `generate`第一次调用`put`时传入的是输入，之后每次传入每个序列新生成的token
+    """
+
+    def __init__(self, batch: list[BatchRequest], tokenizer):
+        self.batch = batch
+        self.tokenizer = tokenizer
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for request, token in zip(self.batch, value.tolist()):
+            if request.finished:
+                continue
+            if request.cancelled:
+                request.finish("cancelled")
+            elif token == self.tokenizer.eos_token_id:
+                request.finish("stop")
+            else:
+                request.append(token)
+                if len(request.tokens) >= request.max_tokens:
+                    request.finish("length")
+
+    def end(self):
+        # 生成结束时仍未结束的请求：被取消的标记为"cancelled"，其它为达到最大长度
+        for request in self.batch:
+            request.finish("cancelled" if request.cancelled else "length")
+
+
+class _BatchStoppingCriteria(StoppingCriteria):
+    # 已结束的请求不再生成，所有请求都结束时`generate`提前返回
+    def __init__(self, batch: list[BatchRequest]):
+        self.batch = batch
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor(
+            [request.finished or request.cancelled for request in self.batch],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+class BatchScheduler:
+    """
+    动态批处理调度器
+    ----------------
+    :param model: 已加载的模型
+    :param tokenizer: 分词器
+    :param max_batch_size: 每个批次最多的请求数
+    :param max_wait: 收到第一个请求后最多等待多久（秒）以凑满一个批次
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, max_wait: float = 0.02):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.__cond = threading.Condition()
+        self.__pending: deque[BatchRequest] = deque()
+        self.__batches = 0
+        self.__requests = 0
+        self.__generated_tokens = 0
+        self.__busy_time = 0.0
+        threading.Thread(target=self.__loop, daemon=True).start()
+
+    def submit(
+        self,
+        messages: list[dict],
+        max_tokens: int = 1024,
+        temperature: float = 0.7,
+        top_p: float = 1.0,
+    ) -> BatchRequest:
+        """
+        提交一个对话请求
+        -----------------
+        :param messages: 对话
+        :param max_tokens: 最大生成token数
+        :param temperature: 温度，为0时使用贪心解码
+        :param top_p: top_p
+        :return: 请求对象，迭代可逐段取得生成的文本
+        """
+        input_ids = self.tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True
+        )
+        request = BatchRequest(input_ids, max_tokens, temperature, top_p, self.tokenizer)
+        with self.__cond:
+            self.__pending.append(request)
+            self.__cond.notify()
+        return request
+
+    def __loop(self):
+        while True:
+            batch = self.__collect()
+            if not batch:
+                continue
+            start = time.perf_counter()
+            try:
+                self.__generate(batch)
+            except Exception as e:
+                for request in batch:
+                    request.fail(e)
+            with self.__cond:
+                self.__batches += 1
+                self.__requests += len(batch)
+                self.__generated_tokens += sum(len(request.tokens) for request in batch)
+                self.__busy_time += time.perf_counter() - start
+
+    def __collect(self) -> list[BatchRequest]:
+        # 等待第一个请求，之后在`max_wait`内继续收集，直到凑满一个批次
+        with self.__cond:
+            while not self.__pending:
+                self.__cond.wait()
+            deadline = time.monotonic() + self.max_wait
+            while len(self.__pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__cond.wait(remaining)
+            key = self.__pending[0].sampling_key()
+            batch, rest = [], deque()
+            for request in self.__pending:
+                if request.cancelled:
+                    request.finish("cancelled")
+                elif request.sampling_key() == key and len(batch) < self.max_batch_size:
+                    batch.append(request)
+                else:
+                    rest.append(request)
+            self.__pending = rest
+            return batch
+
+    def __generate(self, batch: list[BatchRequest]):
+        # 左侧填充，使每个序列的最后一个token对齐
+        length = max(len(request.input_ids) for request in batch)
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        input_ids, attention_mask = [], []
+        for request in batch:
+            padding = length - len(request.input_ids)
+            input_ids.append([pad_token_id] * padding + request.input_ids)
+            attention_mask.append([0] * padding + [1] * len(request.input_ids))
+        temperature, top_p = batch[0].sampling_key()
+        sampling = (
+            {"do_sample": True, "temperature": temperature, "top_p": top_p, "top_k": 0}
+            if temperature > 0
+            else {"do_sample": False}
+        )
+        with torch.no_grad():
+            self.model.generate(
+                input_ids=torch.tensor(input_ids, device=self.model.device),
+                attention_mask=torch.tensor(attention_mask, device=self.model.device),
+                max_new_tokens=max(request.max_tokens for request in batch),
+                eos_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=pad_token_id,
+                streamer=_BatchStreamer(batch, self.tokenizer),
+                stopping_criteria=StoppingCriteriaList([_BatchStoppingCriteria(batch)]),
+                **sampling,
+            )
+
+    def stats(self):
+        with self.__cond:
+            return {
+                "pending": len(self.__pending),
+                "batches": self.__batches,
+                "requests": self.__requests,
+                "avg_batch_size": self.__requests / self.__batches if self.__batches else 0,
+                "generated_tokens": self.__generated_tokens,
+                "tokens_per_second": self.__generated_tokens / self.__busy_time
+                if self.__busy_time
+                else 0,
+            }
+
+
+_batch_scheduler = None
+_batch_scheduler_lock = threading.Lock()
+
+
+def get_batch_scheduler() -> BatchScheduler:
+    """
+    获取进程内共享的批处理调度器，首次调用时按`settings`中的配置加载模型
+    """
+    global _batch_scheduler
+    if _batch_scheduler is None:
+        with _batch_scheduler_lock:
+            if _batch_scheduler is None:
+                # 只加载主模型，批处理不使用草稿模型
+                _batch_scheduler = BatchScheduler(
+                    load_model(
+                        settings.LOCAL_MODEL_PATH,
+                        settings.LOCAL_MODEL_DEVICE,
+                        settings.LOCAL_MODEL_QUANTIZATION,
+                    ),
+                    AutoTokenizer.from_pretrained(settings.LOCAL_MODEL_PATH),
+                    max_batch_size=settings.LOCAL_BATCH_MAX_SIZE,
+                    max_wait=settings.LOCAL_BATCH_MAX_WAIT,
+                )
+    return _batch_scheduler
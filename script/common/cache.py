@@ -0,0 +1,362 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from pathlib import Path
+from collections import OrderedDict
+from setting import settings
+
+"""
+模型回复缓存，用于输入完全相同的请求（如标题生成、附件总结、RAG片段总结）
+内存中使用LRU缓存，SQLite中持久化保存，重启后仍可命中
+
+附件分析缓存以文件内容的哈希、处理模型与提示为键，同一文件再次被引用（重新发送、重新生成回答）时
+直接返回上次的图片描述、文本总结或转写结果
+"""
+
+
+def make_key(payload: dict) -> str:
+    """
+    根据请求参数生成缓存键，参数中与输出无关的字段（如`stream`）应在调用前去除
+    """
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    两级回复缓存
+    ----------------
+    :param path: SQLite数据库路径
+    :param memory_size: 内存LRU缓存的条目数
+    :param max_entries: SQLite中最多保存的条目数，超出时淘汰最久未访问的条目
+    :param ttl: 过期时间（秒），为0时不过期
+    """
+
+    def __init__(
+        self,
+        path: str,
+        memory_size: int = 256,
+        max_entries: int = 10000,
+        ttl: float = 0,
+    ):
+        self.path = path
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.__lock = threading.Lock()
+        self.__memory = OrderedDict()
+        self.__hits_memory = 0
+        self.__hits_db = 0
+        self.__misses = 0
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.create_cache_database()
+
+    def create_cache_database(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        cursor = conn.cursor()
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS completion_cache(
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                created REAL,
+                accessed REAL
+            )
+            """
+        )
+        cursor.execute(
+            """CREATE INDEX IF NOT EXISTS completion_cache_accessed
+            ON completion_cache(accessed)"""
+        )
+        conn.commit()
+        conn.close()
+
+    def __expired(self, created: float, now: float):
+        return self.ttl and now - created > self.ttl
+
+    def get(self, key: str):
+        """
+        读取缓存，未命中或已过期时返回None
+        """
+        now = time.time()
+        with self.__lock:
+            item = self.__memory.get(key)
+            if item is not None:
+                if not self.__expired(item[1], now):
+                    self.__memory.move_to_end(key)
+                    self.__hits_memory += 1
+                    return item[0]
+                del self.__memory[key]
+
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        cursor = conn.cursor()
+        row = cursor.execute(
+            "SELECT value, created FROM completion_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None and self.__expired(row[1], now):
+            cursor.execute("DELETE FROM completion_cache WHERE key = ?", (key,))
+            row = None
+        elif row is not None:
+            cursor.execute(
+                "UPDATE completion_cache SET accessed = ? WHERE key = ?", (now, key)
+            )
+        conn.commit()
+        conn.close()
+
+        with self.__lock:
+            if row is None:
+                self.__misses += 1
+                return None
+            self.__hits_db += 1
+            self.__remember(key, row[0], row[1])
+        return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self.__lock:
+            self.__remember(key, value, now)
+
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO completion_cache(key, value, created, accessed) VALUES (?, ?, ?, ?)",
+            (key, value, now, now),
+        )
+        count = cursor.execute("SELECT COUNT(*) FROM completion_cache").fetchone()[0]
+        if count > self.max_entries:
+            # 淘汰最久未访问的条目
+            cursor.execute(
+                """DELETE FROM completion_cache WHERE key IN (
+                    SELECT key FROM completion_cache ORDER BY accessed ASC LIMIT ?
+                )""",
+                (count - self.max_entries,),
+            )
+        if self.ttl:
+            cursor.execute(
+                "DELETE FROM completion_cache WHERE created < ?", (now - self.ttl,)
+            )
+        conn.commit()
+        conn.close()
+
+    def __remember(self, key: str, value: str, created: float):
+        # 调用时需持有锁
+        self.__memory[key] = (value, created)
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.memory_size:
+            self.__memory.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__memory.clear()
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("DELETE FROM completion_cache")
+        conn.commit()
+        conn.close()
+
+    def stats(self):
+        with self.__lock:
+            hits = self.__hits_memory + self.__hits_db
+            total = hits + self.__misses
+            return {
+                "hits_memory": self.__hits_memory,
+                "hits_db": self.__hits_db,
+                "misses": self.__misses,
+                "hit_rate": hits / total if total else 0,
+                "memory_entries": len(self.__memory),
+            }
+
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+
+def get_completion_cache() -> CompletionCache:
+    """
+    获取进程内共享的回复缓存，首次调用时按`settings`中的配置创建
+    """
+    global _completion_cache
+    if _completion_cache is None:
+        with _completion_cache_lock:
+            if _completion_cache is None:
+                _completion_cache = CompletionCache(
+                    settings.COMPLETION_CACHE_PATH,
+                    memory_size=settings.COMPLETION_CACHE_MEMORY_SIZE,
+                    max_entries=settings.COMPLETION_CACHE_MAX_ENTRIES,
+                    ttl=settings.COMPLETION_CACHE_TTL,
+                )
+    return _completion_cache
+
+
+def hash_file(path: str) -> str:
+    """
+    计算文件内容的sha256
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AttachmentCache:
+    """
+    附件分析缓存
+    ----------------
+    以内容寻址，文件改名或重新上传后只要内容不变仍可命中
+    :param path: SQLite数据库路径
+    :param max_bytes: 缓存结果的总大小上限（字节），超出时淘汰最久未访问的条目
+    """
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024**2):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self.__lock = threading.Lock()
+        # 文件路径、大小与修改时间不变时复用上次计算的哈希，避免每次都读取整个文件
+        self.__digests = {}
+        self.__hits = 0
+        self.__misses = 0
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.create_cache_database()
+
+    def create_cache_database(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        cursor = conn.cursor()
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS attachment_cache(
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                size INTEGER,
+                created REAL,
+                accessed REAL
+            )
+            """
+        )
+        cursor.execute(
+            """CREATE INDEX IF NOT EXISTS attachment_cache_accessed
+            ON attachment_cache(accessed)"""
+        )
+        conn.commit()
+        conn.close()
+
+    def digest(self, path: str) -> str:
+        """
+        文件内容的哈希
+        """
+        stat = Path(path).stat()
+        signature = (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+        with self.__lock:
+            digest = self.__digests.get(signature)
+        if digest is None:
+            digest = hash_file(path)
+            with self.__lock:
+                self.__digests[signature] = digest
+        return digest
+
+    def make_key(self, path: str, model: str, prompt: str | None = None, **options):
+        """
+        生成缓存键
+        -----------------
+        :param path: 附件路径
+        :param model: 处理模型
+        :param prompt: 处理时使用的提示（系统提示、用户问题等）
+        :param options: 其它影响结果的参数（如音频的切分方式）
+        """
+        return make_key(
+            {"digest": self.digest(path), "model": model, "prompt": prompt, **options}
+        )
+
+    def get(self, key: str):
+        """
+        读取缓存，未命中时返回None
+        """
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        cursor = conn.cursor()
+        row = cursor.execute(
+            "SELECT value FROM attachment_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            cursor.execute(
+                "UPDATE attachment_cache SET accessed = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        conn.commit()
+        conn.close()
+
+        with self.__lock:
+            if row is None:
+                self.__misses += 1
+                return None
+            self.__hits += 1
+        return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO attachment_cache(key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, value, size, now, now),
+        )
+        total = cursor.execute("SELECT SUM(size) FROM attachment_cache").fetchone()[0]
+        if total > self.max_bytes:
+            # 按访问时间从旧到新淘汰，直到总大小不超过上限
+            rows = cursor.execute(
+                "SELECT key, size FROM attachment_cache ORDER BY accessed ASC"
+            ).fetchall()
+            evict = []
+            for row_key, row_size in rows:
+                if total <= self.max_bytes:
+                    break
+                evict.append((row_key,))
+                total -= row_size
+            cursor.executemany("DELETE FROM attachment_cache WHERE key = ?", evict)
+        conn.commit()
+        conn.close()
+
+    def clear(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("DELETE FROM attachment_cache")
+        conn.commit()
+        conn.close()
+
+    def stats(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        entries, size = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM attachment_cache"
+        ).fetchone()
+        conn.close()
+        with self.__lock:
+            total = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / total if total else 0,
+                "entries": entries,
+                "bytes": size,
+            }
+
+
+_attachment_cache = None
+_attachment_cache_lock = threading.Lock()
+
+
+def get_attachment_cache() -> AttachmentCache:
+    """
+    获取进程内共享的附件分析缓存，首次调用时按`settings`中的配置创建
+    """
+    global _attachment_cache
+    if _attachment_cache is None:
+        with _attachment_cache_lock:
+            if _attachment_cache is None:
+                _attachment_cache = AttachmentCache(
+                    settings.ATTACHMENT_CACHE_PATH,
+                    max_bytes=settings.ATTACHMENT_CACHE_MAX_BYTES,
+                )
+    return _attachment_cache
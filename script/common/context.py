@@ -0,0 +1,308 @@
+import re
+import json
+import math
+import hashlib
+import threading
+
+from functools import lru_cache
+from collections import OrderedDict
+from setting import settings, prompt
+
+"""
+对话上下文管理，按token预算裁剪发送给模型的对话
+系统提示始终保留，较早的对话按滑动窗口丢弃，或总结为摘要放在系统提示之后
+"""
+
+# 中日韩文字大致一字一个token，其它文字大致四个字符一个token
+_CJK = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+# 每条消息的角色等格式开销
+MESSAGE_OVERHEAD = 4
+# 一张图片的估计token数
+IMAGE_TOKENS = 1000
+
+SUMMARY_PREFIX = "此前对话的摘要：\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估计文本的token数，不依赖具体模型的分词器，偏保守
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+@lru_cache(maxsize=8192)
+def __count_text(role: str, content: str) -> int:
+    return MESSAGE_OVERHEAD + estimate_tokens(role) + estimate_tokens(content)
+
+
+def count_message_tokens(message: dict) -> int:
+    """
+    估计一条消息的token数，结果按消息内容缓存，同一条消息在每轮对话中只计算一次
+    """
+    content = message.get("content")
+    role = message.get("role", "")
+    if content is None or isinstance(content, str):
+        tokens = __count_text(role, content or "")
+    else:
+        # 多模态消息，文本部分按文本计算，图片按固定数量计算
+        tokens = MESSAGE_OVERHEAD
+        for part in content:
+            if part.get("type") == "text":
+                tokens += estimate_tokens(part.get("text", ""))
+            else:
+                tokens += IMAGE_TOKENS
+    if message.get("tool_calls"):
+        tokens += __count_text("", json.dumps(message["tool_calls"], ensure_ascii=False))
+    return tokens
+
+
+class ContextWindow:
+    """
+    按token预算裁剪对话
+    ----------------
+    :param budgets: 各模型的输入token预算
+    :param default_budget: 未配置预算的模型使用的默认预算
+    :param strategy: 超出预算时的处理方式，"window"为滑动窗口，"summary"为将较早的对话总结为摘要
+    :param summarizer: 总结函数，输入对话文本，返回摘要，"summary"时必须提供
+    :param summary_tokens: 为摘要预留的token数
+    """
+
+    def __init__(
+        self,
+        budgets: dict | None = None,
+        default_budget: int = 16000,
+        strategy: str = "window",
+        summarizer=None,
+        summary_tokens: int = 600,
+    ):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.strategy = strategy
+        self.summarizer = summarizer
+        self.summary_tokens = summary_tokens
+
+        self.__lock = threading.Lock()
+        # 已被总结的对话前缀的哈希 -> 摘要，后续对话只需在已有摘要的基础上继续总结
+        self.__summaries = OrderedDict()
+        self.__requests = 0
+        self.__trimmed = 0
+        self.__tokens_saved = 0
+
+    def get_budget(self, model: str) -> int:
+        return self.budgets.get(model, self.default_budget)
+
+    def fit(self, messages: list[dict], model: str):
+        """
+        裁剪对话使其不超过模型的预算，不修改传入的列表
+        -----------------
+        :param messages: 完整对话
+        :param model: 模型名称
+        :return: (裁剪后的对话, 报告)，报告中含有裁剪前后的token数与节省的token数
+        """
+        budget = self.get_budget(model)
+        counts = [count_message_tokens(message) for message in messages]
+        total = sum(counts)
+        report = {
+            "model": model,
+            "budget": budget,
+            "tokens_before": total,
+            "tokens_after": total,
+            "tokens_saved": 0,
+            "dropped_messages": 0,
+            "summarized": False,
+        }
+        if total <= budget:
+            return messages, report
+
+        # 开头的系统提示始终保留
+        start = 0
+        while start < len(messages) and messages[start].get("role") == "system":
+            start += 1
+        available = budget - sum(counts[:start])
+        if self.strategy == "summary":
+            available -= self.summary_tokens
+
+        # 从最新的对话向前保留，至少保留最后一条
+        keep_from = len(messages)
+        used = 0
+        while keep_from > start and used + counts[keep_from - 1] <= available:
+            keep_from -= 1
+            used += counts[keep_from]
+        keep_from = max(min(keep_from, len(messages) - 1), start)
+        # 工具结果不能脱离发起调用的消息单独存在
+        while keep_from < len(messages) - 1 and messages[keep_from].get("role") == "tool":
+            keep_from += 1
+
+        dropped = messages[start:keep_from]
+        result = list(messages[:start])
+        if self.strategy == "summary" and dropped:
+            summary = self.__summarize(dropped)
+            if summary:
+                result.append({"role": "system", "content": SUMMARY_PREFIX + summary})
+                report["summarized"] = True
+        result.extend(messages[keep_from:])
+
+        tokens_after = sum(count_message_tokens(message) for message in result)
+        report["tokens_after"] = tokens_after
+        report["tokens_saved"] = total - tokens_after
+        report["dropped_messages"] = len(dropped)
+        return result, report
+
+    def record(self, report: dict):
+        """
+        记录一次请求的裁剪报告，用于统计
+        """
+        with self.__lock:
+            self.__requests += 1
+            if report["dropped_messages"]:
+                self.__trimmed += 1
+            self.__tokens_saved += report["tokens_saved"]
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "requests": self.__requests,
+                "trimmed_requests": self.__trimmed,
+                "tokens_saved": self.__tokens_saved,
+                "summaries": len(self.__summaries),
+            }
+
+    def __summarize(self, dropped: list[dict]):
+        # 计算每个前缀的哈希，找到已有摘要的最长前缀，只总结其后的新对话
+        keys = []
+        last = b""
+        for message in dropped:
+            data = json.dumps(message, sort_keys=True, ensure_ascii=False)
+            last = hashlib.sha256(last + data.encode("utf-8")).digest()
+            keys.append(last)
+
+        base, rest = None, dropped
+        with self.__lock:
+            for idx in range(len(keys) - 1, -1, -1):
+                if keys[idx] in self.__summaries:
+                    base, rest = self.__summaries[keys[idx]], dropped[idx + 1 :]
+                    self.__summaries.move_to_end(keys[idx])
+                    break
+        if not rest:
+            return base
+
+        text = ""
+        if base:
+            text += "{}{}\n\n".format(SUMMARY_PREFIX, base)
+        for message in rest:
+            content = message.get("content")
+            if not isinstance(content, str):
+                content = json.dumps(content, ensure_ascii=False)
+            text += "{}: {}\n".format(message.get("role"), content)
+        summary = self.summarizer(text)
+        if not summary or summary.startswith("Request Error:"):
+            return base
+
+        with self.__lock:
+            self.__summaries[keys[-1]] = summary
+            while len(self.__summaries) > 1024:
+                self.__summaries.popitem(last=False)
+        return summary
+
+
+def __summarize_with_text_handler(text: str) -> str:
+    from common.models.OpenAi import OpenAi
+
+    model = OpenAi(
+        settings.API_URL,
+        settings.API_KEY,
+        settings.TEXT_HANDLER,
+        system_prompt=prompt.CONTEXT_SUMMARY_PROMPT,
+        temperature=0.1,
+        enable_cache=True,
+    )
+    return model(text)
+
+
+_context_window = None
+_context_window_lock = threading.Lock()
+
+
+def get_context_window() -> ContextWindow:
+    """
+    获取进程内共享的上下文管理器，首次调用时按`settings`中的配置创建
+    """
+    global _context_window
+    if _context_window is None:
+        with _context_window_lock:
+            if _context_window is None:
+                _context_window = ContextWindow(
+                    budgets=settings.CONTEXT_TOKEN_BUDGET,
+                    default_budget=settings.CONTEXT_DEFAULT_TOKEN_BUDGET,
+                    strategy=settings.CONTEXT_STRATEGY,
+                    summarizer=__summarize_with_text_handler,
+                    summary_tokens=settings.CONTEXT_SUMMARY_TOKENS,
+                )
+    return _context_window
+
+
+def format_rag_documents(rag_result: dict) -> str:
+    """
+    将向量数据库的搜索结果格式化为参考文档，相同位置的片段只保留一次
+    -----------------
+    :param rag_result: `RAG.search`的返回值
+    :return: 参考文档文本，没有结果时为空字符串
+    """
+    documents = ""
+    cmap = {}
+    for idx, doc in enumerate(rag_result["documents"][0]):
+        file_name = rag_result["metadatas"][0][idx]["file_name"]
+        start_line = rag_result["metadatas"][0][idx]["start_line"]
+        end_line = rag_result["metadatas"][0][idx]["end_line"]
+        dis = rag_result["distances"][0][idx]
+        unique = "{}{}{}".format(file_name, start_line, end_line)
+        if unique in cmap:
+            continue
+        cmap[unique] = True
+        documents += "文件名：{}\n".format(file_name)
+        documents += "开始行数：{}\n".format(start_line)
+        documents += "结束行数：{}\n".format(end_line)
+        documents += "相关度：{}\n".format(1 - dis)
+        documents += "内容：\n{}\n\n".format(doc)
+    return documents
+
+
+def layout_rag_prompt(
+    messages: list[dict],
+    system_prompt: str,
+    question: str,
+    documents: str,
+    layout: str | None = None,
+):
+    """
+    组装RAG对话，不修改传入的列表
+    -----------------
+    服务商的前缀缓存只对与上一轮完全相同的开头部分生效：
+    "system": 参考文档拼接在系统提示之后，每轮的参考文档不同，对话的开头随之改变，整个对话都需要重新计算
+    "user": 系统提示与历史对话保持不变，参考文档放在最新的用户消息中，每轮只有最后一条消息是新的
+    :param messages: 历史对话
+    :param system_prompt: 系统提示
+    :param question: 用户最新的问题
+    :param documents: `format_rag_documents`返回的参考文档
+    :param layout: "system"或"user"，默认使用`settings.RAG_PROMPT_LAYOUT`
+    :return: (对话, 提示词)，提示词作为最新的用户消息发送
+    """
+    layout = layout or settings.RAG_PROMPT_LAYOUT
+    if documents:
+        if layout == "system":
+            system_prompt = prompt.RAG_SYSTEM_DOCUMENTS_PROMPT.format(
+                system_prompt=system_prompt, documents=documents
+            )
+        else:
+            question = prompt.RAG_USER_DOCUMENTS_PROMPT.format(
+                documents=documents, question=question
+            )
+    messages = list(messages)
+    if messages and messages[0].get("role") == "system":
+        messages[0] = {**messages[0], "content": system_prompt}
+    elif system_prompt:
+        messages.insert(0, {"role": "system", "content": system_prompt})
+    return messages, question
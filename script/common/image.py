@@ -0,0 +1,175 @@
+import io
+import os
+import mimetypes
+import threading
+
+from pathlib import Path
+from common.cache import hash_file
+from setting import settings
+
+"""
+图片上传前的预处理
+长边超过`IMAGE_MAX_EDGE`的图片按比例缩小，按`IMAGE_QUALITY`重新编码（有透明通道的图片编码为PNG，其它编码为JPEG），
+同时按EXIF中的方向旋转图片并去掉EXIF信息；处理结果以原图内容的哈希与处理参数为文件名缓存在磁盘上
+"""
+
+
+# 缓存文件的扩展名
+EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/bmp": ".bmp",
+}
+
+
+def guess_mime(path: str, data: bytes) -> str:
+    """
+    根据文件头判断图片的MIME类型，无法判断时根据扩展名判断
+    """
+    signatures = [
+        (b"\xff\xd8\xff", "image/jpeg"),
+        (b"\x89PNG\r\n\x1a\n", "image/png"),
+        (b"GIF87a", "image/gif"),
+        (b"GIF89a", "image/gif"),
+        (b"BM", "image/bmp"),
+    ]
+    for signature, mime in signatures:
+        if data.startswith(signature):
+            return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    mime = mimetypes.guess_type(path)[0]
+    return mime if mime and mime.startswith("image/") else "image/jpeg"
+
+
+def encode_image(data: bytes, max_edge: int, quality: int):
+    """
+    缩小并重新编码图片
+    -----------------
+    :param data: 原图
+    :param max_edge: 长边的最大像素数
+    :param quality: JPEG质量
+    :return: `(图片, MIME类型)`，无法处理（如未安装`Pillow`、动图）或无需处理（不需要缩小、没有EXIF且重新编码后反而更大）时返回None
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    try:
+        image = Image.open(io.BytesIO(data))
+        if getattr(image, "is_animated", False):
+            return None
+        resized = max(image.size) > max_edge
+        has_exif = len(image.getexif()) > 0
+        # 按EXIF中的方向旋转，重新编码时不写入EXIF
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+            image.save(buffer, format="PNG", optimize=True)
+            mime = "image/png"
+        else:
+            image.convert("RGB").save(
+                buffer, format="JPEG", quality=quality, optimize=True
+            )
+            mime = "image/jpeg"
+    except Exception:
+        return None
+    if not resized and not has_exif and buffer.tell() >= len(data):
+        return None
+    return buffer.getvalue(), mime
+
+
+class ImagePreprocessor:
+    """
+    图片预处理
+    ----------------
+    :param cache_path: 处理结果的缓存目录，为None时不缓存
+    :param max_edge: 长边的最大像素数
+    :param quality: JPEG质量
+    """
+
+    def __init__(self, cache_path: str | None, max_edge: int = 1280, quality: int = 85):
+        self.cache_path = cache_path
+        self.max_edge = max_edge
+        self.quality = quality
+
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__original_bytes = 0
+        self.__processed_bytes = 0
+        if self.cache_path is not None:
+            Path(self.cache_path).mkdir(parents=True, exist_ok=True)
+
+    def __call__(self, path: str):
+        """
+        预处理图片
+        -----------------
+        :param path: 图片路径
+        :return: `(图片, MIME类型)`
+        """
+        cached = None
+        if self.cache_path is not None:
+            name = "{}-{}-{}".format(hash_file(path), self.max_edge, self.quality)
+            cached = os.path.join(self.cache_path, name)
+            for mime, ext in EXTENSIONS.items():
+                if os.path.exists(cached + ext):
+                    with open(cached + ext, "rb") as f:
+                        data = f.read()
+                    with self.__lock:
+                        self.__hits += 1
+                        self.__processed_bytes += len(data)
+                        self.__original_bytes += os.path.getsize(path)
+                    return data, mime
+
+        with open(path, "rb") as f:
+            original = f.read()
+        encoded = encode_image(original, self.max_edge, self.quality)
+        # 无需处理的图片也写入缓存，下次不必再解码判断
+        data, mime = encoded or (original, guess_mime(path, original))
+        if cached is not None and mime in EXTENSIONS:
+            # 先写入临时文件再改名，避免并发读取到写了一半的文件
+            target = cached + EXTENSIONS[mime]
+            temp = "{}.{}.tmp".format(target, threading.get_ident())
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, target)
+        with self.__lock:
+            self.__misses += 1
+            self.__original_bytes += len(original)
+            self.__processed_bytes += len(data)
+        return data, mime
+
+    def stats(self):
+        with self.__lock:
+            total = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / total if total else 0,
+                "original_bytes": self.__original_bytes,
+                "processed_bytes": self.__processed_bytes,
+            }
+
+
+_image_preprocessor = None
+_image_preprocessor_lock = threading.Lock()
+
+
+def get_image_preprocessor() -> ImagePreprocessor:
+    """
+    获取进程内共享的图片预处理器，首次调用时按`settings`中的配置创建
+    """
+    global _image_preprocessor
+    if _image_preprocessor is None:
+        with _image_preprocessor_lock:
+            if _image_preprocessor is None:
+                _image_preprocessor = ImagePreprocessor(
+                    settings.IMAGE_CACHE_PATH,
+                    max_edge=settings.IMAGE_MAX_EDGE,
+                    quality=settings.IMAGE_QUALITY,
+                )
+    return _image_preprocessor
@@ -0,0 +1,143 @@
+import threading
+
+from collections import OrderedDict
+from setting import settings
+
+"""
+本地模型的KV缓存管理
+每个会话保存已计算过的token序列及其KV缓存，下一轮对话只需计算与缓存不同的部分；
+新会话从共享的系统提示缓存复制一份，不必重新计算系统提示；
+所有缓存的总大小超过上限时淘汰最久未使用的会话
+"""
+
+
+def cache_nbytes(cache) -> int:
+    """
+    计算`DynamicCache`占用的内存（字节）
+    """
+    return sum(
+        tensor.nelement() * tensor.element_size()
+        for tensor in list(cache.key_cache) + list(cache.value_cache)
+    )
+
+
+def common_prefix_length(a: list[int], b: list[int]) -> int:
+    """
+    两个token序列相同前缀的长度
+    """
+    length = min(len(a), len(b))
+    for idx in range(length):
+        if a[idx] != b[idx]:
+            return idx
+    return length
+
+
+class _Entry:
+    def __init__(self, tokens: list[int], cache, nbytes: int):
+        self.tokens = tokens
+        self.cache = cache
+        self.nbytes = nbytes
+
+
+class KVCacheManager:
+    """
+    KV缓存管理
+    ----------------
+    以键（如会话ID）保存(token序列, KV缓存)，总大小超过上限时淘汰最久未使用的条目
+    :param max_bytes: 所有缓存的总大小上限（字节），为0时不限制
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[str, _Entry] = OrderedDict()
+        self.__bytes = 0
+        self.__evictions = 0
+        self.__reused_tokens = 0
+        self.__prefilled_tokens = 0
+
+    def get(self, key: str):
+        """
+        取出缓存，取出后条目不再占用额度，使用完需通过`put`放回
+        -----------------
+        :return: (token序列, KV缓存)，不存在时返回None
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                return None
+            self.__bytes -= entry.nbytes
+            return entry.tokens, entry.cache
+
+    def peek(self, key: str):
+        """
+        读取缓存但不取出，用于多个会话共享的缓存（如系统提示），调用方不能修改返回的缓存
+        -----------------
+        :return: (token序列, KV缓存)，不存在时返回None
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            self.__entries.move_to_end(key)
+            return entry.tokens, entry.cache
+
+    def put(self, key: str, tokens: list[int], cache):
+        """
+        保存缓存，超出上限时淘汰最久未使用的条目（包括刚保存的条目本身）
+        """
+        nbytes = cache_nbytes(cache)
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__bytes -= old.nbytes
+            self.__entries[key] = _Entry(tokens, cache, nbytes)
+            self.__bytes += nbytes
+            while self.max_bytes and self.__bytes > self.max_bytes and self.__entries:
+                _, entry = self.__entries.popitem(last=False)
+                self.__bytes -= entry.nbytes
+                self.__evictions += 1
+
+    def pop(self, key: str):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__bytes -= entry.nbytes
+
+    def record(self, reused_tokens: int, prefilled_tokens: int):
+        """
+        记录一次生成中复用与重新计算的token数，用于统计
+        """
+        with self.__lock:
+            self.__reused_tokens += reused_tokens
+            self.__prefilled_tokens += prefilled_tokens
+
+    def stats(self):
+        with self.__lock:
+            total = self.__reused_tokens + self.__prefilled_tokens
+            return {
+                "entries": len(self.__entries),
+                "bytes": self.__bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.__evictions,
+                "reused_tokens": self.__reused_tokens,
+                "prefilled_tokens": self.__prefilled_tokens,
+                "reused_ratio": self.__reused_tokens / total if total else 0,
+            }
+
+
+_kv_cache_manager = None
+_kv_cache_manager_lock = threading.Lock()
+
+
+def get_kv_cache_manager() -> KVCacheManager:
+    """
+    获取进程内共享的KV缓存管理器，首次调用时按`settings`中的配置创建
+    """
+    global _kv_cache_manager
+    if _kv_cache_manager is None:
+        with _kv_cache_manager_lock:
+            if _kv_cache_manager is None:
+                _kv_cache_manager = KVCacheManager(settings.LOCAL_KV_CACHE_MAX_BYTES)
+    return _kv_cache_manager
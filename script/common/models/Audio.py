@@ -1,10 +1,175 @@
+import io
+import os
 import json
+import wave
+import threading
+import urllib3
 
 from io import BufferedReader
-import requests
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from common.transport import get_transport
+from setting import settings
 
 from .BaseModel import BaseModel
 
+"""
+长音频分段转写
+超过`AUDIO_SEGMENT_SECONDS`或文件超过`AUDIO_SEGMENT_MAX_BYTES`的音频切分为多段（优先在静音处切开），
+通过共享连接池并发转写后按时间顺序拼接，每段带上时间戳；分段前先混为单声道并重采样到`AUDIO_SAMPLE_RATE`，
+每段编码后的大小不超过`AUDIO_SEGMENT_MAX_BYTES`；音频无法解码（如未安装`torchaudio`）时整段上传
+"""
+
+
+def format_timestamp(seconds: float) -> str:
+    seconds = int(seconds)
+    return "{:02d}:{:02d}:{:02d}".format(
+        seconds // 3600, seconds % 3600 // 60, seconds % 60
+    )
+
+
+def load_audio(file: BufferedReader):
+    """
+    解码音频
+    -----------------
+    :param file: 音频文件
+    :return: `(waveform, sample_rate)`，waveform的形状为`[声道数, 采样点数]`；无法解码时返回None
+    """
+    try:
+        import torchaudio
+
+        file.seek(0)
+        return torchaudio.load(file)
+    except Exception:
+        return None
+    finally:
+        file.seek(0)
+
+
+# `wave`模块写入的文件头大小
+WAV_HEADER_BYTES = 44
+
+
+def downmix(waveform, sample_rate: int, target_rate: int):
+    """
+    混为单声道并重采样
+    -----------------
+    :param waveform: 音频，形状为`[声道数, 采样点数]`
+    :param sample_rate: 原采样率
+    :param target_rate: 目标采样率，原采样率高于目标采样率时才重采样
+    :return: `(waveform, sample_rate)`，waveform的形状为`[1, 采样点数]`
+    """
+    waveform = waveform.mean(dim=0, keepdim=True)
+    if target_rate and sample_rate > target_rate:
+        import torchaudio
+
+        waveform = torchaudio.functional.resample(waveform, sample_rate, target_rate)
+        sample_rate = target_rate
+    return waveform, sample_rate
+
+
+def wav_seconds(max_bytes: int, sample_rate: int, channels: int = 1) -> float:
+    """
+    16位PCM的WAV不超过`max_bytes`字节时的最大时长（秒）
+    """
+    return (max_bytes - WAV_HEADER_BYTES) / (sample_rate * channels * 2)
+
+
+def split_audio(
+    waveform,
+    sample_rate: int,
+    segment_seconds: float,
+    mode: str = "silence",
+    overlap: float = 2,
+    search: float = 5,
+    threshold: float = 0.1,
+) -> list[tuple[int, int]]:
+    """
+    切分音频
+    -----------------
+    :param waveform: 音频，形状为`[声道数, 采样点数]`
+    :param sample_rate: 采样率
+    :param segment_seconds: 每段的目标时长（秒）
+    :param mode: "silence"在切分点前后`search`秒内找音量最低的位置，低于静音阈值时在该处切开，否则退回固定窗口；
+    "fixed"为固定窗口
+    :param overlap: 固定窗口切分时相邻两段的重叠时长（秒）
+    :param search: 静音搜索范围（秒）
+    :param threshold: 静音阈值，为整段音频平均音量的比例
+    :return: 每段的`(起始采样点, 结束采样点)`，固定窗口切分的相邻两段有重叠
+    """
+    total = waveform.shape[-1]
+    length = int(segment_seconds * sample_rate)
+    if total <= length:
+        return [(0, total)]
+
+    # 按20ms一帧计算音量
+    frame = max(int(sample_rate * 0.02), 1)
+    mono = waveform.mean(dim=0)
+    rms = mono[: total // frame * frame].reshape(-1, frame).pow(2).mean(dim=1).sqrt()
+    silence = float(rms.mean()) * threshold
+
+    segments = []
+    start = 0
+    while total - start > length:
+        cut = start + length
+        if mode == "silence":
+            lo = max((cut - int(search * sample_rate)) // frame, start // frame + 1)
+            hi = min((cut + int(search * sample_rate)) // frame, len(rms))
+            if hi > lo:
+                idx = int(rms[lo:hi].argmin()) + lo
+                if float(rms[idx]) <= silence:
+                    end = idx * frame + frame // 2
+                    segments.append((start, end))
+                    start = end
+                    continue
+        segments.append((start, cut))
+        # 重叠不超过半段，避免每段只前进很少的采样点
+        start = cut - min(int(overlap * sample_rate), length // 2)
+    segments.append((start, total))
+    return segments
+
+
+def encode_wav(waveform, sample_rate: int) -> bytes:
+    """
+    将一段音频编码为16位PCM的WAV
+    """
+    pcm = (waveform.clamp(-1, 1) * 32767).short().t().contiguous()
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(pcm.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.numpy().tobytes())
+    return buffer.getvalue()
+
+
+def merge_overlap(previous: str, text: str, max_chars: int = 50) -> str:
+    """
+    去掉`text`开头与`previous`结尾重复的文字（重叠的两段音频会转写出相同的内容）
+    """
+    for size in range(min(len(previous), len(text), max_chars), 1, -1):
+        if previous.endswith(text[:size]):
+            return text[size:].lstrip()
+    return text
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_audio_executor() -> ThreadPoolExecutor:
+    """
+    获取进程内共享的转写线程池，线程数由`settings.AUDIO_MAX_WORKERS`限制
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.AUDIO_MAX_WORKERS, thread_name_prefix="audio"
+                )
+    return _executor
+
 
 class AudioModel(BaseModel):
     """
@@ -15,34 +180,140 @@ class AudioModel(BaseModel):
     model: str, 模型名称
     """
 
-    def __init__(self, url, api_key, model):
+    def __init__(self, url, api_key, model, **kwargs):
         """
         音频处理模型
         -----------------
         url: str, 模型地址
         api_key: str, API密钥
         model: str, 模型名称
+        :param segment_seconds: 每段的目标时长（秒），默认为`settings.AUDIO_SEGMENT_SECONDS`
+        :param segment_mode: 切分方式，"silence"或"fixed"，默认为`settings.AUDIO_SEGMENT_MODE`
+        :param segment_max_bytes: 单次上传的最大字节数，默认为`settings.AUDIO_SEGMENT_MAX_BYTES`
+        :param sample_rate: 分段上传的采样率，默认为`settings.AUDIO_SAMPLE_RATE`
+        :param transport: HTTP连接池，默认使用进程内共享的连接池
         """
         super().__init__()
         self.url = url
         self.api_key = api_key
         self.model = model
+        self.segment_seconds = kwargs.get(
+            "segment_seconds", settings.AUDIO_SEGMENT_SECONDS
+        )
+        self.segment_mode = kwargs.get("segment_mode", settings.AUDIO_SEGMENT_MODE)
+        self.segment_max_bytes = kwargs.get(
+            "segment_max_bytes", settings.AUDIO_SEGMENT_MAX_BYTES
+        )
+        self.sample_rate = kwargs.get("sample_rate", settings.AUDIO_SAMPLE_RATE)
+        self.transport = kwargs.get("transport", None) or get_transport()
 
         self.__headers = {
             "Authorization": "Bearer {}".format(self.api_key),
             "mj-api-secret": "{}".format(self.api_key),
         }
 
-    def __call__(self, file: BufferedReader):
-        payload = {"model": self.model}
-        files = [("file", (file.name, file))]
-        rsp = requests.request(
-            "POST",
-            self.url + "/audio/transcriptions",
-            headers=self.__headers,
-            data=payload,
-            files=files,
+    def __call__(
+        self, file: BufferedReader, progress: Callable[[int, int], None] | None = None
+    ):
+        """
+        转写音频
+        -----------------
+        :param file: 音频文件
+        :param progress: 进度回调`progress(已完成段数, 总段数)`
+        :return: 转写文本，分段转写时每段前带有`[开始 - 结束]`时间戳
+        """
+        segments = self.transcribe(file, progress)
+        if len(segments) == 1:
+            return segments[0]["text"]
+        return "\n".join(
+            "[{} - {}] {}".format(
+                format_timestamp(segment["start"]),
+                format_timestamp(segment["end"]),
+                segment["text"],
+            )
+            for segment in segments
+        )
+
+    def transcribe(
+        self, file: BufferedReader, progress: Callable[[int, int], None] | None = None
+    ) -> list[dict]:
+        """
+        分段转写音频
+        -----------------
+        :param file: 音频文件
+        :param progress: 进度回调`progress(已完成段数, 总段数)`，在调用方线程中调用
+        :return: 按时间顺序排列的`{"start": 开始秒数, "end": 结束秒数, "text": 文本}`列表，
+        未切分时只有一项（音频无法解码时end为None）
+        """
+        name = os.path.basename(file.name)
+        loaded = load_audio(file)
+        if loaded is not None:
+            waveform, sample_rate = loaded
+            duration = waveform.shape[-1] / sample_rate
+        oversized = os.fstat(file.fileno()).st_size > self.segment_max_bytes
+        if loaded is None or (duration <= self.segment_seconds and not oversized):
+            text = self.__transcribe(name, file.read())
+            if progress is not None:
+                progress(1, 1)
+            return [
+                {"start": 0, "end": None if loaded is None else duration, "text": text}
+            ]
+
+        waveform, sample_rate = downmix(waveform, sample_rate, self.sample_rate)
+        # 静音切分的段最多比目标时长长出`AUDIO_SILENCE_SEARCH`秒，按此留出余量
+        search = settings.AUDIO_SILENCE_SEARCH if self.segment_mode == "silence" else 0
+        segment_seconds = min(
+            self.segment_seconds,
+            max(wav_seconds(self.segment_max_bytes, sample_rate) - search, 1),
+        )
+        spans = split_audio(
+            waveform,
+            sample_rate,
+            segment_seconds,
+            mode=self.segment_mode,
+            overlap=settings.AUDIO_SEGMENT_OVERLAP,
+            search=search,
+            threshold=settings.AUDIO_SILENCE_THRESHOLD,
+        )
+        base = os.path.splitext(name)[0]
+        futures = {
+            get_audio_executor().submit(
+                self.__transcribe,
+                "{}.{}.wav".format(base, idx),
+                encode_wav(waveform[:, start:end], sample_rate),
+            ): idx
+            for idx, (start, end) in enumerate(spans)
+        }
+        texts = [""] * len(spans)
+        for done, future in enumerate(as_completed(futures), 1):
+            texts[futures[future]] = future.result()
+            if progress is not None:
+                progress(done, len(spans))
+
+        segments = []
+        for idx, (start, end) in enumerate(spans):
+            text = texts[idx].strip()
+            # 与上一段有重叠时去掉重复的文字
+            if idx > 0 and start < spans[idx - 1][1]:
+                text = merge_overlap(segments[-1]["text"], text)
+            segments.append(
+                {"start": start / sample_rate, "end": end / sample_rate, "text": text}
+            )
+        return segments
+
+    def __transcribe(self, name: str, data: bytes) -> str:
+        body, content_type = urllib3.encode_multipart_formdata(
+            {"model": self.model, "file": (name, data)}
         )
-        if rsp.status_code != 200:
-            return "Error: Code{} Reason: {}".format(rsp.status_code, rsp.reason)
-        return json.loads(rsp.text)["text"]
+        headers = dict(self.__headers)
+        headers["Content-Type"] = content_type
+        try:
+            rsp = self.transport.request(
+                "POST", self.url + "/audio/transcriptions", headers=headers, body=body
+            )
+        except self.transport.errors as e:
+            # 单段失败不影响其它段
+            return "Error: {}".format(e)
+        if rsp.status != 200:
+            return "Error: Code{} Reason: {}".format(rsp.status, rsp.reason)
+        return json.loads(rsp.data)["text"]
@@ -1,13 +1,112 @@
+import copy
+import json
+import time
+import uuid
+import queue
+import torch
+import hashlib
+import weakref
+import threading
+
 from .BaseModel import BaseModel
 
+from common.kvcache import KVCacheManager, common_prefix_length, get_kv_cache_manager
+from common.telemetry import CallTrace, get_telemetry
+from setting import settings
+
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
+    DynamicCache,
     Qwen2ForCausalLM,
     GenerationConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
 )
 
 
+def load_model(path: str, device: str = "cpu", quantization: str | None = None):
+    """
+    加载模型
+    -----------------
+    :param path: 模型路径
+    :param device: 设备
+    :param quantization: 量化方式
+        None: 不量化（fp32）
+        "bf16": 以bfloat16加载，内存减半，需要CPU支持bfloat16运算（如AVX512_BF16/AMX）才能加速
+        "int8": 加载后将所有线性层动态量化为int8（权重int8，激活在运行时量化），仅支持CPU
+        "4bit": 使用bitsandbytes以4bit（nf4）加载，需要安装bitsandbytes，CPU上需要其多后端版本
+    """
+    if quantization not in (None, "bf16", "int8", "4bit"):
+        raise ValueError("unknown quantization: {}".format(quantization))
+    if quantization == "int8" and device != "cpu":
+        raise ValueError("int8 dynamic quantization only supports cpu")
+    if quantization == "bf16":
+        model = AutoModelForCausalLM.from_pretrained(path, torch_dtype=torch.bfloat16)
+    elif quantization == "4bit":
+        from transformers import BitsAndBytesConfig
+
+        return AutoModelForCausalLM.from_pretrained(
+            path,
+            quantization_config=BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            ),
+            device_map=device,
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(path)
+    if quantization == "int8":
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    if device == "cuda":
+        model = model.to("cuda")
+    return model
+
+
+_fingerprints = weakref.WeakKeyDictionary()
+_fingerprints_lock = threading.Lock()
+
+
+def model_fingerprint(model) -> str:
+    """
+    已加载权重的指纹，由配置、数据类型与各层的类型（量化后线性层的类型会改变）得到，
+    相同路径以不同量化方式加载的模型指纹不同，KV缓存不能互相复用
+    """
+    with _fingerprints_lock:
+        fingerprint = _fingerprints.get(model)
+    if fingerprint is None:
+        layers = sorted(
+            {"{}.{}".format(type(m).__module__, type(m).__name__) for m in model.modules()}
+        )
+        fingerprint = hashlib.sha256(
+            json.dumps(
+                [model.config.to_json_string(), str(model.dtype), layers]
+            ).encode("utf-8")
+        ).hexdigest()
+        with _fingerprints_lock:
+            _fingerprints[model] = fingerprint
+    return fingerprint
+
+
+class CancellationToken:
+    """
+    取消令牌，调用`cancel`后生成会在下一个token之前停止
+    """
+
+    def __init__(self):
+        self.__event = threading.Event()
+
+    def cancel(self):
+        self.__event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__event.is_set()
+
+
 class DeepseekLocal(BaseModel):
     """
     从本地加载Deepseek模型
@@ -29,11 +128,22 @@ class DeepseekLocal(BaseModel):
         :param path: 模型路径
         :param device: 设备
         :param tempture: 温度，默认为0.7
-        :param max_tokens: 最大token数，默认为1024
-        :param max_new_tokens: 最大新token数，默认为100
+        :param max_tokens: 每轮回复的最大token数，默认为1024
+        :param max_new_tokens: 每次调用`generate`生成的最大token数，默认为100
         :param frequency_penalty: 频率惩罚，默认为0
         :param presence_penalty: 出现惩罚，默认为0
         :param system_prompt: 系统提示
+        :param telemetry: 遥测对象，默认使用进程内共享的遥测对象
+        :param session_id: 会话ID，用于保存该会话的KV缓存，默认随机生成
+        :param kv_cache: KV缓存管理器，默认使用进程内共享的管理器
+        :param prefix_cache: 新会话是否复用共享的系统提示KV缓存，默认为`settings.LOCAL_PREFIX_CACHE`
+        :param quantization: 量化方式，默认为`settings.LOCAL_MODEL_QUANTIZATION`，可选值见`load_model`
+        :param model: 已加载的模型，多个会话共享同一个模型时使用，此时不再从`path`加载
+        :param tokenizer: 已加载的分词器，同上
+        :param draft_path: 草稿模型路径，设置后使用投机解码，默认为`settings.LOCAL_DRAFT_MODEL_PATH`
+        :param draft_tokens: 草稿模型每次预测的token数，默认为`settings.LOCAL_DRAFT_TOKENS`
+        :param draft_model: 已加载的草稿模型，此时不再从`draft_path`加载
+        :param draft_tokenizer: 已加载的草稿模型分词器，同上
         """
         super().__init__()
         self.model_path = path
@@ -42,43 +152,393 @@ class DeepseekLocal(BaseModel):
         self.max_tokens = kwargs.get("max_tokens", 1024)
         self.max_new_tokens = kwargs.get("max_new_tokens", 100)
         self.system_prompt = kwargs.get("system_prompt", "You are a helpful assistant.")
+        self.telemetry = kwargs.get("telemetry", None) or get_telemetry()
+        self.session_id = kwargs.get("session_id", None) or str(uuid.uuid4())
+        self.kv_cache: KVCacheManager = (
+            kwargs.get("kv_cache", None) or get_kv_cache_manager()
+        )
+        self.prefix_cache = kwargs.get("prefix_cache", settings.LOCAL_PREFIX_CACHE)
+        self.quantization = kwargs.get(
+            "quantization", settings.LOCAL_MODEL_QUANTIZATION
+        )
 
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
-        self.model: Qwen2ForCausalLM = AutoModelForCausalLM.from_pretrained(
+        self.tokenizer = kwargs.get("tokenizer", None) or AutoTokenizer.from_pretrained(
             self.model_path
         )
+        self.model: Qwen2ForCausalLM = kwargs.get("model", None)
+        if self.model is None:
+            self.model = load_model(self.model_path, self.device, self.quantization)
 
-        if self.device == "cuda":
-            self.model = self.model.to("cuda")
+        # 投机解码：草稿模型一次预测多个token，主模型一次前向计算验证，接受其中相同的部分
+        self.draft_path = kwargs.get("draft_path", settings.LOCAL_DRAFT_MODEL_PATH)
+        self.draft_tokens = kwargs.get("draft_tokens", settings.LOCAL_DRAFT_TOKENS)
+        self.draft_model = kwargs.get("draft_model", None)
+        self.draft_tokenizer = kwargs.get("draft_tokenizer", None)
+        if self.draft_model is None and self.draft_path:
+            self.draft_model = load_model(self.draft_path, self.device, self.quantization)
+        if self.draft_model is not None:
+            if self.draft_tokenizer is None:
+                self.draft_tokenizer = AutoTokenizer.from_pretrained(
+                    self.draft_path or self.model_path
+                )
+            self.draft_model.generation_config.num_assistant_tokens = self.draft_tokens
+            self.draft_model.generation_config.num_assistant_tokens_schedule = (
+                settings.LOCAL_DRAFT_SCHEDULE
+            )
 
         self.messages = []
+        # 最近一次调用的预填充与解码耗时
+        self.generation_report = None
 
     def __call__(self, prompt: str, **kwargs):
+        """
+        调用模型，生成结束后返回完整回复
+        -----------------
+        :param prompt: 提示词
+        :param cancel: 取消令牌，取消后返回已生成的部分
+        """
         super().__call__(prompt, **kwargs)
+        return "".join(self.stream(prompt, kwargs.get("cancel", None)))
+
+    def stream(self, prompt: str, cancel: CancellationToken | None = None):
+        """
+        流式调用模型
+        -----------------
+        在后台线程中生成，每生成一个token就返回新增的文本；调用方提前停止迭代（如客户端断开连接）时取消生成
+        :param prompt: 提示词
+        :param cancel: 取消令牌，取消后在生成下一个token之前停止
+        :return: 生成器，逐段返回新生成的文本，结束后（包括被取消）已生成的回复会被记录到对话中
+        """
+        cancel = cancel or CancellationToken()
         if self.messages == [] and self.system_prompt != "":
             self.messages.append({"role": "system", "content": self.system_prompt})
         self.messages.append({"role": "user", "content": prompt})
 
-        input_tokens = self.tokenizer.apply_chat_template(
-            self.messages, add_generation_prompt=True, return_tensors="pt"
-        )
-        old_tokens_length = input_tokens.shape[1]
-        final_result = ""
-        while True:
-            output_tokens = self.model.generate(
-                input_tokens,
-                do_sample=True,
-                temperature=self.tempture,
-                max_new_tokens=self.max_new_tokens,
-                top_p=1,
-                top_k=0,
-                eos_token_id=self.tokenizer.eos_token_id,
-                pad_token_id=self.tokenizer.pad_token_id,
+        chunks = queue.Queue()
+        errors = []
+
+        def run():
+            try:
+                self.__generate(cancel, chunks.put)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                chunks.put(None)
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            if worker.is_alive():
+                cancel.cancel()
+            worker.join()
+        if errors:
+            raise errors[0]
+
+    def __generate(self, cancel: CancellationToken, emit):
+        # 生成一轮回复，新生成的文本通过`emit`逐段返回
+        trace = self.telemetry.trace(self.model_path, self.device, True)
+        decoder = IncrementalDecoder(self.tokenizer)
+
+        def on_token(token: int):
+            delta = decoder.put(token)
+            if delta:
+                emit(delta)
+
+        report = {
+            "prompt_tokens": 0,
+            "reused_tokens": 0,
+            "prefix_cache_hit": False,
+            "prefill_tokens": 0,
+            "prefill_time": 0.0,
+            "decode_tokens": 0,
+            "decode_time": 0.0,
+            "decode_tokens_per_second": None,
+            "ttft": None,
+            "cancelled": False,
+            "draft_tokens": 0,
+            "accepted_tokens": 0,
+            "acceptance_rate": None,
+        }
+        rounds = 0
+        new_tokens = []
+        try:
+            input_tokens = self.tokenizer.apply_chat_template(
+                self.messages, add_generation_prompt=True, return_tensors="pt"
+            ).to(self.model.device)
+            old_tokens_length = input_tokens.shape[1]
+            report["prompt_tokens"] = old_tokens_length
+            cache = self.__restore_cache(input_tokens[0].tolist(), report)
+            while True:
+                rounds += 1
+                # 已在缓存中的token不再计算，之后每次继续生成时只需计算上次最后生成的一个token
+                cached_length = cache.get_seq_length()
+                streamer = _TimingStreamer(trace, on_token)
+                counter = _ForwardCounter(self.model, self.draft_model)
+                with counter:
+                    output_tokens = self.model.generate(
+                        input_tokens,
+                        past_key_values=cache,
+                        do_sample=True,
+                        temperature=self.tempture,
+                        max_new_tokens=min(
+                            self.max_new_tokens,
+                            self.max_tokens
+                            - (input_tokens.shape[1] - old_tokens_length),
+                        ),
+                        top_p=1,
+                        top_k=0,
+                        eos_token_id=self.tokenizer.eos_token_id,
+                        pad_token_id=self.tokenizer.pad_token_id,
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList(
+                            [_CancelStoppingCriteria(cancel)]
+                        ),
+                        **self.__draft_kwargs(),
+                    )
+                if self.draft_model is not None:
+                    # 主模型每次前向计算得到被接受的草稿token与一个自己生成的token
+                    report["draft_tokens"] += counter.draft_calls
+                    report["accepted_tokens"] += max(
+                        streamer.tokens - counter.target_calls, 0
+                    )
+                report["prefill_tokens"] += input_tokens.shape[1] - cached_length
+                report["prefill_time"] += streamer.prefill_time()
+                report["decode_tokens"] += max(streamer.tokens - 1, 0)
+                report["decode_time"] += streamer.decode_time()
+                new_tokens = output_tokens[0, old_tokens_length:]
+                # 只检查新生成的部分，历史对话中也含有结束符
+                if (
+                    self.tokenizer.eos_token_id in new_tokens
+                    or len(new_tokens) >= self.max_tokens
+                    or cancel.cancelled
+                ):
+                    break
+                input_tokens = output_tokens
+            final_result = self.tokenizer.decode(new_tokens, skip_special_tokens=True)
+            report["cancelled"] = cancel.cancelled
+            # 最后生成的token还没有计算KV，缓存长度比输出少一个
+            self.kv_cache.put(
+                self.session_id,
+                output_tokens[0, : cache.get_seq_length()].tolist(),
+                cache,
             )
-            if self.tokenizer.eos_token_id in output_tokens[0]:
-                final_result = self.tokenizer.decode(
-                    output_tokens[0, old_tokens_length:], skip_special_tokens=True
+            self.kv_cache.record(report["reused_tokens"], report["prefill_tokens"])
+            if report["decode_time"] > 0:
+                report["decode_tokens_per_second"] = (
+                    report["decode_tokens"] / report["decode_time"]
                 )
-                break
-            input_tokens = output_tokens
+            if report["draft_tokens"]:
+                report["acceptance_rate"] = (
+                    report["accepted_tokens"] / report["draft_tokens"]
+                )
+            trace.add_usage(
+                {
+                    "prompt_tokens": old_tokens_length,
+                    "completion_tokens": len(new_tokens),
+                    "prompt_cache_hit_tokens": report["reused_tokens"],
+                }
+            )
+        except Exception as e:
+            trace.fail(e)
+            raise
+        finally:
+            report["ttft"] = trace.event["ttft"]
+            self.generation_report = report
+            trace.finish(rounds=rounds)
+        self.messages.append({"role": "assistant", "content": final_result})
         return final_result
+
+    def __draft_kwargs(self):
+        if self.draft_model is None:
+            return {}
+        kwargs = {"assistant_model": self.draft_model}
+        if self.draft_model.config.vocab_size != self.model.config.vocab_size:
+            # 词表大小不同（如1.5B与7B的蒸馏模型）时按文本对齐两个模型的token
+            kwargs["tokenizer"] = self.tokenizer
+            kwargs["assistant_tokenizer"] = self.draft_tokenizer
+        return kwargs
+
+    def __restore_cache(self, tokens: list[int], report: dict) -> DynamicCache:
+        """
+        取出该会话的KV缓存，只保留与本轮输入相同的前缀部分，
+        没有可用的会话缓存时使用共享的系统提示缓存
+        """
+        entry = self.kv_cache.get(self.session_id)
+        if entry is not None:
+            cached_tokens, cache = entry
+            # 至少留下一个token需要计算，生成第一个token时需要其输出
+            length = min(common_prefix_length(cached_tokens, tokens), len(tokens) - 1)
+            if length > 0:
+                cache.crop(length)
+                report["reused_tokens"] = length
+                return cache
+        if not self.prefix_cache:
+            return DynamicCache()
+        return self.__restore_prefix_cache(tokens, report)
+
+    def __restore_prefix_cache(self, tokens: list[int], report: dict) -> DynamicCache:
+        """
+        复制共享的系统提示KV缓存，不存在时先计算并保存
+        """
+        if not self.messages or self.messages[0]["role"] != "system":
+            return DynamicCache()
+        prefix_tokens = self.tokenizer.apply_chat_template(self.messages[:1])
+        length = min(common_prefix_length(prefix_tokens, tokens), len(tokens) - 1)
+        if length <= 0:
+            return DynamicCache()
+        prefix_tokens = tokens[:length]
+        key = "prefix:" + hashlib.sha256(
+            json.dumps(
+                [self.model_path, self.device, model_fingerprint(self.model), prefix_tokens]
+            ).encode("utf-8")
+        ).hexdigest()
+        entry = self.kv_cache.peek(key)
+        if entry is not None:
+            report["reused_tokens"] = length
+            report["prefix_cache_hit"] = True
+            # 共享的缓存不能被修改，生成时会向缓存中追加内容，因此复制一份
+            return copy.deepcopy(entry[1])
+        start = time.perf_counter()
+        cache = DynamicCache()
+        with torch.no_grad():
+            self.model(
+                input_ids=torch.tensor([prefix_tokens], device=self.model.device),
+                past_key_values=cache,
+                use_cache=True,
+            )
+        report["prefill_tokens"] += length
+        report["prefill_time"] += time.perf_counter() - start
+        self.kv_cache.put(key, prefix_tokens, cache)
+        return copy.deepcopy(cache)
+
+    def reset(self):
+        """
+        清空对话与该会话的KV缓存
+        """
+        self.messages = []
+        self.kv_cache.pop(self.session_id)
+
+
+class IncrementalDecoder:
+    """
+    增量解码，每次传入一个新生成的token，返回新增的文本
+    只解码末尾的一小段token：`prefix_offset`之后的token作为上下文（保证空格、多字节字符等与整体解码一致），
+    `read_offset`之后为尚未输出的token，解码出完整的文本后两个位置一起前移，每次解码的长度与已生成的长度无关；
+    末尾是不完整的多字节字符（如被拆成多个token的汉字）时先返回空字符串，等下一个token
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def __decode(self, tokens: list[int]) -> str:
+        # 不做分词清理（如去掉标点前的空格），否则分段解码的结果可能与整体解码不一致
+        return self.tokenizer.decode(
+            tokens, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+
+    def put(self, token: int) -> str:
+        self.tokens.append(token)
+        prefix = self.__decode(self.tokens[self.prefix_offset : self.read_offset])
+        text = self.__decode(self.tokens[self.prefix_offset :])
+        if len(text) <= len(prefix) or text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        return text[len(prefix) :]
+
+
+class _CancelStoppingCriteria(StoppingCriteria):
+    def __init__(self, cancel: CancellationToken):
+        self.cancel = cancel
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],),
+            self.cancel.cancelled,
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+class _ForwardCounter:
+    """
+    统计一次`generate`中主模型与草稿模型的前向计算次数，草稿模型每次前向计算预测一个token
+    """
+
+    def __init__(self, model, draft_model=None):
+        self.model = model
+        self.draft_model = draft_model
+        self.target_calls = 0
+        self.draft_calls = 0
+        self.__handles = []
+
+    def __target_hook(self, module, args):
+        self.target_calls += 1
+
+    def __draft_hook(self, module, args):
+        self.draft_calls += 1
+
+    def __enter__(self):
+        if self.draft_model is not None:
+            self.__handles = [
+                self.model.register_forward_pre_hook(self.__target_hook),
+                self.draft_model.register_forward_pre_hook(self.__draft_hook),
+            ]
+        return self
+
+    def __exit__(self, *args):
+        for handle in self.__handles:
+            handle.remove()
+        self.__handles = []
+
+
+class _TimingStreamer:
+    """
+    `generate`的streamer，用于记录预填充与解码的耗时，并将新生成的token交给`on_token`
+    `generate`第一次调用`put`时传入的是输入，之后每次传入新生成的token
+    """
+
+    def __init__(self, trace: CallTrace, on_token):
+        self.trace = trace
+        self.on_token = on_token
+        self.prompt_seen = False
+        self.tokens = 0
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.end_time = None
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        # 投机解码时一次传入多个被接受的token
+        tokens = value.flatten().tolist()
+        self.tokens += len(tokens)
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            self.trace.first_token()
+        for token in tokens:
+            self.on_token(token)
+
+    def end(self):
+        self.end_time = time.perf_counter()
+
+    def prefill_time(self):
+        # 预填充包括计算输入与生成第一个token
+        if self.first_token is None:
+            return 0.0
+        return self.first_token - self.start
+
+    def decode_time(self):
+        if self.first_token is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.first_token
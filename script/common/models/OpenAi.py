@@ -1,14 +1,29 @@
 from .BaseModel import BaseModel
 
-import urllib3
 import json
-import copy
+import time
+import asyncio
 
 from typing import List
-from urllib3 import request
+from common import sse
+from common.cache import make_key, get_completion_cache
+from common.agent import AgentLoop, AgentRound
+from common.balancer import EndpointPool, get_endpoint_pool
+from common.ratelimit import RateLimiter, get_rate_limiter
+from common.singleflight import SingleFlight, get_single_flight
+from common.telemetry import CallTrace, Telemetry, get_telemetry
+from common.context import (
+    ContextWindow,
+    count_message_tokens,
+    estimate_tokens,
+    get_context_window,
+)
+from common.transport import get_transport, get_async_transport
+from setting import settings
 import tools
 
-urllib3.disable_warnings()
+REQUEST_ERROR = "Request Error:\n {}"
+RATE_LIMIT_ERROR = REQUEST_ERROR.format("Rate limit exceeded")
 
 
 class OpenAi(BaseModel):
@@ -38,15 +53,30 @@ class OpenAi(BaseModel):
         :param frequency_penalty: 频率惩罚，默认为0
         :param presence_penalty: 存在惩罚，默认为0
         :param enable_tools: 是否启用工具，默认为False
-        :param stream: 是否流式输出，默认为False，当工具启用且工具数量不为0时，流式传输会被强制关闭
+        :param stream: 是否流式输出，默认为False。启用工具时同样可以流式输出，工具调用会在流中被拼接并执行，执行后继续流式输出
         :param stream_callback: 流式回调函数，默认为None
+        :param transport: HTTP连接池，默认使用进程内共享的连接池
+        :param tool_timeout: 单个工具调用的超时时间（秒），默认使用`settings.TOOL_TIMEOUT`
+        :param enable_cache: 是否缓存回复，默认为False。适用于输入相同时输出也应相同的调用（如总结、标题），启用工具时不缓存
+        :param cache: 回复缓存，默认使用进程内共享的缓存
+        :param context_window: 上下文管理器，按token预算裁剪发送的对话，为True时使用进程内共享的上下文管理器，默认为None（不裁剪）
+        :param max_rounds: 启用工具时一次调用中模型与工具交替执行的最大轮数，默认使用`settings.AGENT_MAX_ROUNDS`
+        :param deadline: 一次调用（含所有轮次）的最长时间（秒），未指定时只有启用工具的调用使用`settings.AGENT_DEADLINE`，
+        不使用工具的调用（如标题、总结）只受连接池超时时间的限制
+        :param token_budget: 一次调用（含所有轮次）最多消耗的token数，默认使用`settings.AGENT_TOKEN_BUDGET`
+        :param endpoints: 地址池，请求在池中的地址间负载均衡，此时`url`与`api_key`不再使用。
+        未指定时，若`url`为`settings.API_URL`且配置了`settings.API_ENDPOINTS`，使用进程内共享的地址池
+        :param rate_limiter: 限流器，默认使用进程内共享的限流器（按`settings.RATE_LIMITS`限流）
+        :param single_flight: 是否合并同时发出的相同请求，默认使用`settings.SINGLE_FLIGHT`，启用工具时不合并
+        :param telemetry: 遥测对象，每次调用结束时发送耗时与用量事件，默认使用进程内共享的遥测对象
         """
         super().__init__()
 
         self.url = url
         self.api_key = api_key
         self.model = model
-        self.tempture = kwargs.get("tempture", 0.7)
+        # 兼容OpenAI的参数名`temperature`（前端设置与RAG均使用该名称）
+        self.tempture = kwargs.get("tempture", kwargs.get("temperature", 0.7))
         self.max_tokens = kwargs.get("max_tokens", 1024)
         self.top_p = kwargs.get("top_p", 1)
         self.frequency_penalty = kwargs.get("frequency_penalty", 0)
@@ -55,33 +85,240 @@ class OpenAi(BaseModel):
         self.enable_tools = kwargs.get("enable_tools", False)
         self.tools = tools.get_tool_description() if self.enable_tools else []
         self.stream = kwargs.get("stream", False)
-        if self.tools != []:
-            # 不要在调用工具时使用流式传输
-            self.stream = False
         self.stream_callback = kwargs.get("stream_callback", None)
+        self.tool_timeout = kwargs.get("tool_timeout", None)
+        self.transport = kwargs.get("transport", None) or get_transport()
+        self.enable_cache = kwargs.get("enable_cache", False)
+        self.cache = kwargs.get("cache", None)
+        if self.enable_cache and self.cache is None:
+            self.cache = get_completion_cache()
+        self.context_window: ContextWindow | None = kwargs.get("context_window", None)
+        if self.context_window is True:
+            self.context_window = get_context_window()
+        # 最近一次请求的上下文裁剪报告
+        self.context_report = None
+        self.max_rounds = kwargs.get("max_rounds", None)
+        self.deadline = kwargs.get("deadline", None)
+        self.token_budget = kwargs.get("token_budget", None)
+        # 最近一次请求的轮次报告（每轮耗时、token数与结束原因）
+        self.agent_report = None
+
+        self.endpoints: EndpointPool | None = kwargs.get("endpoints", None)
+        if self.endpoints is None and url == settings.API_URL and settings.API_ENDPOINTS:
+            self.endpoints = get_endpoint_pool()
+
+        self.rate_limiter: RateLimiter = (
+            kwargs.get("rate_limiter", None) or get_rate_limiter()
+        )
+
+        self.single_flight: SingleFlight | None = (
+            get_single_flight()
+            if kwargs.get("single_flight", settings.SINGLE_FLIGHT)
+            else None
+        )
+
+        self.telemetry: Telemetry = kwargs.get("telemetry", None) or get_telemetry()
+        # 当前调用的遥测记录
+        self.__trace: CallTrace | None = None
 
         self.messages = []
 
-        self.__headers = {
-            "Authorization": "Bearer {}".format(self.api_key),
-            "mj-api-secret": "{}".format(self.api_key),
+        self.__headers = self.__make_headers(self.api_key)
+
+    def __make_headers(self, api_key: str):
+        return {
+            "Authorization": "Bearer {}".format(api_key),
+            "mj-api-secret": "{}".format(api_key),
             "Content-Type": "application/json",
         }
 
+    def __send(
+        self,
+        method: str,
+        path: str,
+        body: str | None = None,
+        stream: bool = False,
+        timeout: float | None = None,
+    ):
+        # 发送请求，设置了地址池时由地址池选择地址并负责重试
+        if self.endpoints is None:
+            return self.transport.request(
+                method,
+                self.url + path,
+                headers=self.__headers,
+                body=body,
+                stream=stream,
+                timeout=timeout,
+            )
+        return self.endpoints.request(
+            self.transport, method, path, self.__make_headers, body, stream, timeout
+        )
+
+    async def __asend(
+        self, transport, method: str, path: str, body: str | None = None, timeout=None
+    ):
+        if self.endpoints is None:
+            return await transport.request(
+                method, self.url + path, headers=self.__headers, body=body, timeout=timeout
+            )
+        return await self.endpoints.arequest(
+            transport, method, path, self.__make_headers, body, timeout
+        )
+
+    def __astream_send(self, transport, path: str, body: str, timeout=None):
+        if self.endpoints is None:
+            return transport.stream(
+                "POST", self.url + path, headers=self.__headers, body=body, timeout=timeout
+            )
+        return self.endpoints.astream(
+            transport, "POST", path, self.__make_headers, body, timeout
+        )
+
+    def __begin_trace(self, stream: bool):
+        self.__trace = self.telemetry.trace(self.model, self.url, stream)
+        return self.__trace
+
+    def __end_trace(self, trace: CallTrace, answer=None, **fields):
+        # 请求出错时回复为错误信息
+        if isinstance(answer, str) and answer.startswith("Request Error:"):
+            trace.fail(answer)
+        trace.finish(**fields)
+
+    def __acquire(self, estimated: int):
+        # 取得限流额度，记录排队时间
+        start = time.perf_counter()
+        acquired = self.rate_limiter.acquire(self.model, estimated)
+        self.__trace.add_queue_time(time.perf_counter() - start)
+        return acquired
+
+    async def __aacquire(self, estimated: int):
+        start = time.perf_counter()
+        acquired = await self.rate_limiter.aacquire(self.model, estimated)
+        self.__trace.add_queue_time(time.perf_counter() - start)
+        return acquired
+
+    def __record_usage(self, trace: CallTrace, usage, messages: list[dict], answer: str):
+        trace.add_usage(
+            usage,
+            sum(count_message_tokens(message) for message in messages),
+            estimate_tokens(answer),
+        )
+
     def __parse(self, message: str):
         obj = json.loads(message)
         return obj["choices"][0]["message"]["content"]
 
-    def __parse_stream(self, message: str):
-        if not message:
+    def __parse_stream(self, obj: dict):
+        if not obj or not obj.get("choices"):
+            # 部分服务最后会单独返回一个只含`usage`的数据块
             return ""
-        obj = json.loads(message)
         if obj["choices"][0]["finish_reason"] == "stop":
             return ""
         if obj["choices"][0]["delta"].get("content") is None:
             return ""
         return obj["choices"][0]["delta"]["content"]
 
+    def __append_prompt(self, prompt: str | object):
+        if self.messages == [] and self.system_prompt != "":
+            self.messages.append({"role": "system", "content": self.system_prompt})
+        self.messages.append({"role": "user", "content": prompt})
+
+    def __context_messages(self, report: bool = False):
+        """
+        实际发送的对话，设置了上下文管理器时按预算裁剪
+        """
+        if self.context_window is None:
+            return self.messages
+        messages, context_report = self.context_window.fit(self.messages, self.model)
+        if report:
+            self.context_report = context_report
+            self.context_window.record(context_report)
+        return messages
+
+    async def __acontext_messages(self, report: bool = False):
+        if self.context_window is None:
+            return self.messages
+        # 使用摘要时需要请求模型，放到线程中执行
+        return await asyncio.to_thread(self.__context_messages, report)
+
+    def __build_payload(
+        self, stream: bool | None = None, messages=None, use_tools: bool = True
+    ):
+        return {
+            "model": self.model,
+            "messages": self.__context_messages() if messages is None else messages,
+            "temperature": self.tempture,
+            "max_tokens": self.max_tokens,
+            "top_p": self.top_p,
+            "frequency_penalty": self.frequency_penalty,
+            "presence_penalty": self.presence_penalty,
+            "stream": self.stream if stream is None else stream,
+            "tools": None if self.tools == [] or not use_tools else self.tools,
+        }
+
+    def __build_body(
+        self, stream: bool | None = None, messages=None, use_tools: bool = True
+    ):
+        if messages is None:
+            messages = self.__context_messages(report=True)
+        return json.dumps(self.__build_payload(stream, messages, use_tools))
+
+    def __cache_key(self, parse_message: bool = True, messages=None):
+        """
+        生成当前请求的缓存键，不可缓存时返回None
+        """
+        if not self.enable_cache or not parse_message or self.tools != []:
+            return None
+        return self.__request_key(messages)
+
+    def __flight_key(self, messages=None):
+        """
+        生成合并请求用的键，不合并时返回None
+        """
+        if self.single_flight is None or self.tools != []:
+            return None
+        return self.__request_key(messages)
+
+    def __request_key(self, messages=None):
+        payload = self.__build_payload(messages=messages)
+        # 是否流式输出不影响回复内容
+        payload.pop("stream")
+        payload["url"] = self.url
+        return make_key(payload)
+
+    def __cache_get(self, cache_key: str | None, bypass_cache: bool = False):
+        if cache_key is None or bypass_cache:
+            return None
+        return self.cache.get(cache_key)
+
+    def __cache_set(self, cache_key: str | None, answer: str):
+        if cache_key is None or not answer:
+            return
+        if answer.startswith("Request Error:"):
+            # 请求出错时返回的是错误信息，不缓存
+            return
+        self.cache.set(cache_key, answer)
+
+    def __replay(self, answer: str, parse_message: bool = True):
+        # 以流的形式返回缓存的回复，原样转发时构造与上游一致的SSE数据
+        self.messages.append({"role": "assistant", "content": answer})
+        if parse_message:
+            yield answer
+            return
+        chunk = {
+            "object": "chat.completion.chunk",
+            "model": self.model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": answer},
+                    "finish_reason": None,
+                }
+            ],
+        }
+        yield sse.SSEEvent(json.dumps(chunk, ensure_ascii=False).encode("utf-8")).encode()
+        yield sse.SSEEvent(b"[DONE]").encode()
+
     def __call__(self, prompt: str | object, **kwargs) -> str:
         """
         调用模型
@@ -90,119 +327,630 @@ class OpenAi(BaseModel):
         :param parse_message: 是否解析消息，默认为True
         :param stream: 是否流式输出，默认为False
         :param stream_callback: 流式回调函数，默认为None
+        :param bypass_cache: 是否跳过缓存读取（结果仍会写入缓存），默认为False
         :return: 模型返回结果
         """
-        if self.messages == [] and self.system_prompt != "":
-            self.messages.append({"role": "system", "content": self.system_prompt})
-        self.messages.append({"role": "user", "content": prompt})
+        self.__append_prompt(prompt)
+        self.agent_report = None
+        trace = self.__begin_trace(self.stream)
 
         parse_message = kwargs.get("parse_message", True)
-        answer = self.__request_main(parse_message)
+        answer, cached, coalesced = None, False, False
+        try:
+            cache_key = self.__cache_key(parse_message)
+            answer = self.__cache_get(cache_key, kwargs.get("bypass_cache", False))
+            cached = answer is not None
+            if answer is None:
+                flight_key = self.__flight_key()
+                if flight_key is None:
+                    answer = self.__request_main(parse_message)
+                else:
+                    answer, leader = self.single_flight.do(
+                        "{}:{}".format(flight_key, parse_message),
+                        lambda: self.__request_main(parse_message),
+                    )
+                    coalesced = not leader
+                self.__cache_set(cache_key, answer)
+        except Exception as e:
+            trace.fail(e)
+            raise
+        finally:
+            self.__end_trace(trace, answer, cached=cached, coalesced=coalesced)
+        if (cached or coalesced) and self.stream and self.stream_callback is not None:
+            # 回复来自缓存或其它相同的请求时没有逐字回调，同样通过回调输出，流式调用方无需区分
+            self.stream_callback(answer)
         self.messages.append({"role": "assistant", "content": answer})
         return answer
 
-    def __request_main(self, parse_message: bool = True):
-        body = json.dumps(
-            {
-                "model": self.model,
-                "messages": self.messages,
-                "temperature": self.tempture,
-                "max_tokens": self.max_tokens,
-                "top_p": self.top_p,
-                "frequency_penalty": self.frequency_penalty,
-                "presence_penalty": self.presence_penalty,
-                "stream": self.stream,
-                "tools": None if self.tools == [] else self.tools,
-            }
+    def __new_agent_loop(self):
+        return AgentLoop(
+            max_rounds=self.max_rounds,
+            deadline=self.deadline,
+            token_budget=self.token_budget,
         )
 
-        rsp = urllib3.request(
+    def __bounded(self):
+        # 截止时间只用于工具调用循环，或调用方显式指定了`deadline`时
+        return self.tools != [] or self.deadline is not None
+
+    def __round_timeout(self, agent_loop: AgentLoop, timeout: float):
+        # 单次请求的超时时间不超过整个请求剩余的时间
+        if not self.__bounded():
+            return timeout
+        return min(timeout, agent_loop.remaining())
+
+    def __estimate_request_tokens(self, messages: list[dict]):
+        # 限流时预约的token数：输入与最大输出之和
+        return sum(count_message_tokens(message) for message in messages) + self.max_tokens
+
+    def __round_tokens(self, usage: dict | None, messages: list[dict], answer: str):
+        # 优先使用上游返回的`usage`，未返回时（如部分服务的流式响应）按文本估计
+        if usage and usage.get("total_tokens"):
+            return usage["total_tokens"]
+        return sum(count_message_tokens(message) for message in messages) + estimate_tokens(
+            answer
+        )
+
+    def __request_main(self, parse_message: bool = True):
+        # 模型与工具交替执行，直到模型不再调用工具或超出预算
+        agent_loop = self.__new_agent_loop()
+        answer = ""
+        for agent_round in agent_loop:
+            try:
+                with agent_round.timing("model"):
+                    answer, tool_message = self.__request_round(
+                        agent_round,
+                        parse_message,
+                        timeout=self.__round_timeout(agent_loop, self.transport.timeout),
+                    )
+            except self.transport.timeout_errors:
+                # 因截止时间缩短了超时时间导致的超时按超出预算处理，其它超时照常抛出
+                if not self.__bounded() or agent_loop.remaining() > 0:
+                    raise
+                agent_loop.stop("deadline")
+                break
+            if tool_message is None:
+                agent_loop.finish()
+                break
+            agent_round.tool_calls = len(tool_message["tool_calls"])
+            self.__trace.tool_round()
+            with agent_round.timing("tool"):
+                self.__append_tools_calling(tool_message)
+        if not agent_loop.finished:
+            answer = self.__request_final(agent_loop, parse_message)
+        self.agent_report = agent_loop.report()
+        return answer
+
+    def __request_final(self, agent_loop: AgentLoop, parse_message: bool = True):
+        # 超出轮数或token预算时不再提供工具，要求模型根据已有的工具结果直接回答；超时时直接返回错误信息
+        if agent_loop.stop_reason == "deadline":
+            return REQUEST_ERROR.format("Deadline exceeded")
+        agent_round = agent_loop.add_round()
+        with agent_round.timing("model"):
+            answer, _ = self.__request_round(
+                agent_round, parse_message, use_tools=False, timeout=self.transport.timeout
+            )
+        return answer
+
+    def __request_round(
+        self,
+        agent_round: AgentRound,
+        parse_message: bool = True,
+        use_tools: bool = True,
+        timeout: float | None = None,
+    ):
+        """
+        一轮请求
+        -----------------
+        :return: (回复, 带有工具调用的assistant消息)，没有调用工具时后者为None，请求出错时回复为错误信息
+        """
+        messages = self.__context_messages(report=True)
+        estimated = self.__estimate_request_tokens(messages)
+        if not self.__acquire(estimated):
+            return RATE_LIMIT_ERROR, None
+        try:
+            return self.__send_round(
+                agent_round, messages, parse_message, use_tools, timeout
+            )
+        finally:
+            # 按实际用量修正预约的token数，请求出错时全部返还
+            self.rate_limiter.settle(self.model, estimated, agent_round.tokens)
+
+    def __send_round(self, agent_round, messages, parse_message, use_tools, timeout):
+        rsp = self.__send(
             "POST",
-            self.url + "/chat/completions",
-            headers=self.__headers,
-            body=body,
-            timeout=300,
-            preload_content=False if self.stream else True,
+            "/chat/completions",
+            body=self.__build_body(messages=messages, use_tools=use_tools),
+            stream=self.stream,
+            timeout=timeout,
         )
+        trace = self.__trace
+        trace.first_byte(getattr(rsp, "endpoint_url", None))
 
         if rsp.status != 200:
-            return "Request Error:\n {}".format(rsp.reason)
+            if self.stream:
+                self.transport.release(rsp)
+            return REQUEST_ERROR.format(rsp.reason), None
 
-        rsp_message = ""
         if self.stream:
             rsp_message = []
-            for line in rsp.stream():
-                line = line.decode("utf-8").strip()
-                if line.startswith("data:"):
-                    line = line[5:]
-                    if line.find("[DONE]") != -1:
-                        break
+            content = []
+            tool_calls = {}
+            usage = None
+            for event in sse.iter_events(self.transport.iter_stream(rsp)):
+                if event.is_done:
+                    # 不在此处中断，读完剩余的数据后连接才能被复用
+                    continue
+                obj = event.json()
+                usage = obj.get("usage") or usage
+                if use_tools and self.enable_tools:
+                    self.__merge_tool_calls(tool_calls, obj)
+                content.append(self.__parse_stream(obj))
+                if content[-1]:
+                    trace.first_token()
+                if parse_message:
+                    rsp_message.append(content[-1])
+                else:
+                    rsp_message.append(event.text)
+                if self.stream_callback is not None:
+                    self.stream_callback(rsp_message[-1])
+            content = "".join(content)
+            agent_round.tokens = self.__round_tokens(usage, messages, content)
+            self.__record_usage(trace, usage, messages, content)
+            return "".join(rsp_message), self.__tool_message(content, tool_calls)
+
+        msg_obj = json.loads(rsp.data.decode("utf-8"))
+        message = msg_obj["choices"][0]["message"]
+        if message.get("content"):
+            trace.first_token()
+        agent_round.tokens = self.__round_tokens(
+            msg_obj.get("usage"), messages, message.get("content") or ""
+        )
+        self.__record_usage(trace, msg_obj.get("usage"), messages, message.get("content") or "")
+        if use_tools and self.__is_tools_calling(msg_obj):
+            return message.get("content") or "", message
+        if parse_message:
+            return message["content"], None
+        return rsp.data.decode("utf-8"), None
+
+    def __tool_message(self, content: str, tool_calls: dict):
+        # 由流中拼接出的工具调用构造assistant消息
+        if not tool_calls:
+            return None
+        return {
+            "role": "assistant",
+            "content": content or None,
+            "tool_calls": [tool_calls[idx] for idx in sorted(tool_calls)],
+        }
+
+    def __merge_tool_calls(self, tool_calls: dict, obj: dict):
+        """
+        拼接流式响应中的工具调用
+        流式响应中一个工具调用会被拆分为多个增量，首个增量带有ID与工具名，后续增量只带有参数片段，按`index`拼接
+        """
+        if not obj or not obj.get("choices"):
+            return
+        delta = obj["choices"][0].get("delta") or {}
+        for tool_delta in delta.get("tool_calls") or []:
+            tool_call = tool_calls.setdefault(
+                tool_delta.get("index", 0),
+                {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+            )
+            if tool_delta.get("id"):
+                tool_call["id"] = tool_delta["id"]
+            function = tool_delta.get("function") or {}
+            if function.get("name"):
+                tool_call["function"]["name"] = function["name"]
+            if function.get("arguments"):
+                tool_call["function"]["arguments"] += function["arguments"]
+
+    def __append_tools_calling(self, tool_message: dict):
+        # 将工具调用及其执行结果加入对话
+        self.messages.append(tool_message)
+        for tool_result in self.__get_tools_calling(tool_message["tool_calls"]):
+            self.messages.append(tool_result)
+
+    def call_stream(
+        self, prompt, parse_message: bool = True, bypass_cache: bool = False
+    ):
+        """
+        流式调用模型
+        -----------------
+        :param prompt: 提示词（或对象，用于多模态）
+        :param parse_message: 是否解析消息，为True时逐个返回模型生成的文本，否则原样返回上游的SSE数据（可直接转发给前端）
+        :param bypass_cache: 是否跳过缓存读取，默认为False
+        :return: 生成器，请求出错时返回错误信息
+        """
+        self.__append_prompt(prompt)
+        trace = self.__begin_trace(True)
+        try:
+            messages = self.__context_messages(report=True)
+            cache_key = self.__cache_key(messages=messages)
+            answer = self.__cache_get(cache_key, bypass_cache)
+            if answer is not None:
+                trace.first_token()
+                self.__end_trace(trace, cached=True)
+                return self.__replay(answer, parse_message)
+
+            flight_key = self.__flight_key(messages)
+            if flight_key is None:
+                chunks = self.__open_stream(messages)
+            else:
+                # 相同的请求共享同一个上游流
+                chunks = self.single_flight.stream(
+                    flight_key, lambda: self.__open_stream(messages)
+                )
+            chunk, events = next(chunks, (b"", []))
+        except Exception as e:
+            trace.fail(e)
+            self.__end_trace(trace)
+            raise
+        if events is None:
+            chunks.close()
+            self.__end_trace(trace, chunk)
+            return chunk
+        return self.__relay_stream(
+            chunk, events, chunks, parse_message, cache_key, trace
+        )
+
+    def __open_stream(self, messages: list[dict]):
+        """
+        发送流式请求，逐块返回上游数据与其中完整的SSE事件
+        请求出错时只返回一项，事件为None，数据块为错误信息
+        """
+        trace = self.__trace
+        estimated = self.__estimate_request_tokens(messages)
+        if not self.__acquire(estimated):
+            yield RATE_LIMIT_ERROR, None
+            return
+        try:
+            rsp = self.__send(
+                "POST",
+                "/chat/completions",
+                body=self.__build_body(stream=True, messages=messages),
+                stream=True,
+            )
+        except Exception:
+            # 请求未发出或连接出错时归还预留的额度
+            self.rate_limiter.settle(self.model, estimated, 0)
+            raise
+        trace.first_byte(getattr(rsp, "endpoint_url", None))
+        if rsp.status != 200:
+            self.transport.release(rsp)
+            self.rate_limiter.settle(self.model, estimated, 0)
+            yield REQUEST_ERROR.format(rsp.reason), None
+            return
+        decoder = sse.SSEDecoder()
+        content = []
+        usage = None
+        try:
+            for chunk in self.transport.iter_stream(rsp):
+                events = [event for event in decoder.feed(chunk) if not event.is_done]
+                for event in events:
+                    usage = event.json().get("usage") or usage
+                    content.append(self.__parse_stream(event.json()))
+                yield chunk, events
+            events = [event for event in decoder.flush() if not event.is_done]
+            content.extend(self.__parse_stream(event.json()) for event in events)
+            if events:
+                yield b"", events
+        finally:
+            content = "".join(content)
+            self.rate_limiter.settle(
+                self.model, estimated, self.__round_tokens(usage, messages, content)
+            )
+            self.__record_usage(trace, usage, messages, content)
+
+    def __relay_stream(
+        self,
+        chunk,
+        events,
+        chunks,
+        parse_message: bool = True,
+        cache_key=None,
+        trace: CallTrace | None = None,
+    ):
+        # 逐块返回上游数据（或解析出的文本），结束后将完整回复记录到对话中
+        rsp_message = []
+        try:
+            while events is not None:
+                tokens = [self.__parse_stream(event.json()) for event in events]
+                rsp_message.extend(tokens)
+                if any(tokens):
+                    trace.first_token()
+                if parse_message:
+                    yield from tokens
+                elif chunk:
+                    yield chunk
+                chunk, events = next(chunks, (None, None))
+        except Exception as e:
+            trace.fail(e)
+            raise
+        finally:
+            chunks.close()
+            # 没有请求过上游的订阅者，回复来自其它相同的请求
+            self.__end_trace(trace, coalesced=trace.event["rounds"] == 0)
+        rsp_message = "".join(rsp_message)
+        self.__cache_set(cache_key, rsp_message)
+        self.messages.append({"role": "assistant", "content": rsp_message})
+
+    async def acall(self, prompt: str | object, **kwargs) -> str:
+        """
+        异步调用模型，参数与返回值同`__call__`
+        -----------------
+        等待上游响应与执行工具时不阻塞事件循环
+        :param prompt: 提示词（或对象，用于多模态）
+        :param parse_message: 是否解析消息，默认为True
+        :param bypass_cache: 是否跳过缓存读取（结果仍会写入缓存），默认为False
+        :return: 模型返回结果
+        """
+        self.__append_prompt(prompt)
+        self.agent_report = None
+        trace = self.__begin_trace(self.stream)
+
+        parse_message = kwargs.get("parse_message", True)
+        answer, cached, coalesced = None, False, False
+        try:
+            cache_key, flight_key = None, None
+            if self.enable_cache or (self.single_flight is not None and self.tools == []):
+                messages = await self.__acontext_messages()
+                cache_key = self.__cache_key(parse_message, messages)
+                flight_key = self.__flight_key(messages)
+            answer = self.__cache_get(cache_key, kwargs.get("bypass_cache", False))
+            cached = answer is not None
+            if answer is None:
+                if flight_key is None:
+                    answer = await self.__arequest_main(parse_message)
+                else:
+                    answer, leader = await self.single_flight.ado(
+                        "{}:{}".format(flight_key, parse_message),
+                        lambda: self.__arequest_main(parse_message),
+                    )
+                    coalesced = not leader
+                self.__cache_set(cache_key, answer)
+        except Exception as e:
+            trace.fail(e)
+            raise
+        finally:
+            self.__end_trace(trace, answer, cached=cached, coalesced=coalesced)
+        if (cached or coalesced) and self.stream and self.stream_callback is not None:
+            self.stream_callback(answer)
+        self.messages.append({"role": "assistant", "content": answer})
+        return answer
+
+    async def __arequest_main(self, parse_message: bool = True):
+        transport = get_async_transport()
+        agent_loop = self.__new_agent_loop()
+        answer = ""
+        for agent_round in agent_loop:
+            try:
+                with agent_round.timing("model"):
+                    answer, tool_message = await self.__arequest_round(
+                        transport,
+                        agent_round,
+                        parse_message,
+                        timeout=self.__round_timeout(agent_loop, transport.timeout),
+                    )
+            except transport.timeout_errors:
+                if not self.__bounded() or agent_loop.remaining() > 0:
+                    raise
+                agent_loop.stop("deadline")
+                break
+            if tool_message is None:
+                agent_loop.finish()
+                break
+            agent_round.tool_calls = len(tool_message["tool_calls"])
+            self.__trace.tool_round()
+            with agent_round.timing("tool"):
+                # 工具多为阻塞调用，放到线程中执行
+                await asyncio.to_thread(self.__append_tools_calling, tool_message)
+        if not agent_loop.finished:
+            if agent_loop.stop_reason == "deadline":
+                answer = REQUEST_ERROR.format("Deadline exceeded")
+            else:
+                agent_round = agent_loop.add_round()
+                with agent_round.timing("model"):
+                    answer, _ = await self.__arequest_round(
+                        transport, agent_round, parse_message, use_tools=False
+                    )
+        self.agent_report = agent_loop.report()
+        return answer
+
+    async def __arequest_round(
+        self,
+        transport,
+        agent_round: AgentRound,
+        parse_message: bool = True,
+        use_tools: bool = True,
+        timeout: float | None = None,
+    ):
+        # 一轮请求，返回值同`__request_round`
+        messages = await self.__acontext_messages(report=True)
+        estimated = self.__estimate_request_tokens(messages)
+        if not await self.__aacquire(estimated):
+            return RATE_LIMIT_ERROR, None
+        try:
+            return await self.__asend_round(
+                transport, agent_round, messages, parse_message, use_tools, timeout
+            )
+        finally:
+            self.rate_limiter.settle(self.model, estimated, agent_round.tokens)
+
+    async def __asend_round(
+        self, transport, agent_round, messages, parse_message, use_tools, timeout
+    ):
+        trace = self.__trace
+        if self.stream:
+            rsp_message = []
+            content = []
+            tool_calls = {}
+            usage = None
+            async for chunk, events in self.__astream_request(
+                transport, messages, use_tools, timeout
+            ):
+                if events is None:
+                    return chunk, None
+                for event in events:
+                    obj = event.json()
+                    usage = obj.get("usage") or usage
+                    if use_tools and self.enable_tools:
+                        self.__merge_tool_calls(tool_calls, obj)
+                    content.append(self.__parse_stream(obj))
+                    if content[-1]:
+                        trace.first_token()
                     if parse_message:
-                        rsp_message.append(copy.deepcopy(self.__parse_stream(line)))
+                        rsp_message.append(content[-1])
                     else:
-                        rsp_message.append(copy.deepcopy(line))
+                        rsp_message.append(event.text)
                     if self.stream_callback is not None:
                         self.stream_callback(rsp_message[-1])
-            rsp_message = "".join(rsp_message)
-        else:
-            msg_obj = json.loads(rsp.data.decode("utf-8"))
-            if self.enable_tools and self.__is_tools_calling(msg_obj):
-                # 如果调用了工具，递归调用，返回最终结果
-                self.messages.append(msg_obj["choices"][0]["message"])
-                calling_results = self.__get_tools_calling(msg_obj)
-                for tool_result in calling_results:
-                    self.messages.append(tool_result)
-                return self.__request_main(parse_message)
-            if parse_message:
-                rsp_message = msg_obj["choices"][0]["message"]["content"]
-            else:
-                rsp_message = rsp.data.decode("utf-8")
-        return rsp_message
+            content = "".join(content)
+            agent_round.tokens = self.__round_tokens(usage, messages, content)
+            self.__record_usage(trace, usage, messages, content)
+            return "".join(rsp_message), self.__tool_message(content, tool_calls)
 
-    def call_stream(self, prompt, parse_message: bool = True):
-        if self.messages == [] and self.system_prompt != "":
-            self.messages.append({"role": "system", "content": self.system_prompt})
-        self.messages.append({"role": "user", "content": prompt})
-        body = json.dumps(
-            {
-                "model": self.model,
-                "messages": self.messages,
-                "temperature": self.tempture,
-                "max_tokens": self.max_tokens,
-                "top_p": self.top_p,
-                "frequency_penalty": self.frequency_penalty,
-                "presence_penalty": self.presence_penalty,
-                "stream": self.stream,
-                "tools": None if self.tools == [] else self.tools,
-            }
-        )
-
-        rsp = urllib3.request(
+        rsp = await self.__asend(
+            transport,
             "POST",
-            self.url + "/chat/completions",
-            headers=self.__headers,
-            body=body,
-            timeout=300,
-            preload_content=False if self.stream else True,
+            "/chat/completions",
+            body=self.__build_body(messages=messages, use_tools=use_tools),
+            timeout=timeout,
+        )
+        trace.first_byte(getattr(rsp, "endpoint_url", None))
+        if rsp.status_code != 200:
+            return REQUEST_ERROR.format(rsp.reason_phrase), None
+        msg_obj = rsp.json()
+        message = msg_obj["choices"][0]["message"]
+        if message.get("content"):
+            trace.first_token()
+        agent_round.tokens = self.__round_tokens(
+            msg_obj.get("usage"), messages, message.get("content") or ""
         )
+        self.__record_usage(trace, msg_obj.get("usage"), messages, message.get("content") or "")
+        if use_tools and self.__is_tools_calling(msg_obj):
+            return message.get("content") or "", message
+        if parse_message:
+            return message["content"], None
+        return rsp.text, None
 
-        if rsp.status != 200:
-            return "Request Error:\n {}".format(rsp.reason)
-        return rsp.stream()
-        # rsp_message = []
-        # for line in rsp.stream():
-        # line = line.decode("utf-8").strip()
-        # if line.startswith("data:"):
-        #     line = line[5:]
-        # if line.find("[DONE]") != -1:
-        #     break
-        # if parse_message:
-        #     rsp_message.append(copy.deepcopy(self.__parse_stream(line)))
-        # else:
-        #     rsp_message.append(copy.deepcopy(line))
-        # yield "{}\n".format(line)
-        # "".join(rsp_message)
-        # self.messages.append({"role":"assistant", "content": rsp_message})
+    async def __astream_request(
+        self, transport, messages, use_tools: bool = True, timeout: float | None = None
+    ):
+        # 逐块返回上游数据与其中完整的SSE事件，请求出错时事件为None，数据块为错误信息
+        trace = self.__trace
+        async with self.__astream_send(
+            transport,
+            "/chat/completions",
+            body=self.__build_body(stream=True, messages=messages, use_tools=use_tools),
+            timeout=timeout,
+        ) as rsp:
+            trace.first_byte(getattr(rsp, "endpoint_url", None))
+            if rsp.status_code != 200:
+                await rsp.aread()
+                yield REQUEST_ERROR.format(rsp.reason_phrase), None
+                return
+            decoder = sse.SSEDecoder()
+            async for chunk in rsp.aiter_bytes():
+                events = decoder.feed(chunk)
+                yield chunk, [event for event in events if not event.is_done]
+            events = decoder.flush()
+            if events:
+                yield b"", [event for event in events if not event.is_done]
+
+    async def astream(
+        self,
+        prompt: str | object,
+        parse_message: bool = True,
+        bypass_cache: bool = False,
+    ):
+        """
+        异步流式调用模型
+        -----------------
+        :param prompt: 提示词（或对象，用于多模态）
+        :param parse_message: 是否解析消息，为True时逐个返回模型生成的文本，否则原样返回上游的SSE数据（可直接转发给前端）
+        :param bypass_cache: 是否跳过缓存读取，默认为False
+        :return: 异步生成器，结束后完整回复会被记录到对话中
+        """
+        self.__append_prompt(prompt)
+        trace = self.__begin_trace(True)
+        try:
+            messages = await self.__acontext_messages(report=True)
+            cache_key = self.__cache_key(messages=messages)
+            answer = self.__cache_get(cache_key, bypass_cache)
+        except Exception as e:
+            trace.fail(e)
+            self.__end_trace(trace)
+            raise
+        if answer is not None:
+            trace.first_token()
+            self.__end_trace(trace, cached=True)
+            for chunk in self.__replay(answer, parse_message):
+                yield chunk
+            return
+        transport = get_async_transport()
+        flight_key = self.__flight_key(messages)
+        if flight_key is None:
+            chunks = self.__aopen_stream(transport, messages)
+        else:
+            # 相同的请求共享同一个上游流
+            chunks = self.single_flight.astream(
+                flight_key, lambda: self.__aopen_stream(transport, messages)
+            )
+        rsp_message = []
+        answer = None
+        try:
+            async for chunk, events in chunks:
+                if events is None:
+                    answer = chunk
+                    yield chunk
+                    return
+                tokens = [self.__parse_stream(event.json()) for event in events]
+                rsp_message.extend(tokens)
+                if any(tokens):
+                    trace.first_token()
+                if parse_message:
+                    for token in tokens:
+                        yield token
+                elif chunk:
+                    yield chunk
+        except Exception as e:
+            trace.fail(e)
+            raise
+        finally:
+            await chunks.aclose()
+            self.__end_trace(trace, answer, coalesced=trace.event["rounds"] == 0)
+        rsp_message = "".join(rsp_message)
+        self.__cache_set(cache_key, rsp_message)
+        self.messages.append({"role": "assistant", "content": rsp_message})
+
+    async def __aopen_stream(self, transport, messages: list[dict]):
+        # `__open_stream`的异步版本
+        trace = self.__trace
+        estimated = self.__estimate_request_tokens(messages)
+        if not await self.__aacquire(estimated):
+            yield RATE_LIMIT_ERROR, None
+            return
+        content = []
+        usage = None
+        failed = False
+        try:
+            async for chunk, events in self.__astream_request(transport, messages):
+                if events is None:
+                    failed = True
+                else:
+                    for event in events:
+                        usage = event.json().get("usage") or usage
+                        content.append(self.__parse_stream(event.json()))
+                yield chunk, events
+        finally:
+            content = "".join(content)
+            self.rate_limiter.settle(
+                self.model,
+                estimated,
+                0 if failed else self.__round_tokens(usage, messages, content),
+            )
+            if not failed:
+                self.__record_usage(trace, usage, messages, content)
 
     def __is_tools_calling(self, message: object):
         """
@@ -211,40 +959,40 @@ class OpenAi(BaseModel):
         """
         if not message or not self.enable_tools:
             return False
-        if "tool_calls" not in message["choices"][0]["message"]:
+        if not message["choices"][0]["message"].get("tool_calls"):
             return False
         return True
 
-    def __get_tools_calling(self, message: object):
+    def __get_tools_calling(self, tool_calls: list[dict]):
         """
-        获取工具调用
+        执行工具调用
         适用于可使用funciton calling的模型，如不支持请使用参数`enable_tools = False`
         """
-        if not message:
+        if not tool_calls:
             return []
-        tool_results = []
-        if "tool_calls" not in message["choices"][0]["message"]:
-            return tool_results
-        for tool in message["choices"][0]["message"]["tool_calls"]:
-            tool_name = tool["function"]["name"]
-            tool_arg = json.loads(tool["function"]["arguments"])
-            if type(tool_arg) == str:
-                tool_arg = json.loads(tool_arg)
-            tool_id = tool["id"]
-            tool_results.append(
-                {
-                    "role": "tool",
-                    "content": tools.call_tool_by_name(tool_name, **tool_arg),
-                    "tool_call_id": tool_id,
-                }
-            )
-        return tool_results
+        # 同一轮中的多个工具并发执行，结果按原顺序返回
+        tool_callings = [
+            {
+                "name": tool["function"]["name"],
+                "args": tool["function"]["arguments"],
+                "id": tool["id"],
+            }
+            for tool in tool_calls
+        ]
+        return [
+            {
+                "role": "tool",
+                "content": str(result["result"]),
+                "tool_call_id": result["id"],
+            }
+            for result in tools.call_tools(tool_callings, timeout=self.tool_timeout)
+        ]
 
     def get_models(self):
         """
         获取模型列表
         """
-        rsp = request("GET", self.url + "/models?type=text", headers=self.__headers)
+        rsp = self.__send("GET", "/models?type=text")
         data = rsp.data.decode("utf-8")
         models = json.loads(data)["data"]
         model_list = [model["id"] for model in models]
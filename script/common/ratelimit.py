@@ -0,0 +1,205 @@
+import time
+import asyncio
+import threading
+
+from setting import settings
+
+"""
+客户端限流，按模型限制每分钟的请求数（RPM）与token数（TPM），避免突发请求触发上游的429
+每个请求到达时按顺序预约额度，额度不足时排队等待，先到的请求先得到额度
+"""
+
+
+class TokenBucket:
+    """
+    令牌桶，允许余量为负，负值表示已被排队的请求预约
+    ----------------
+    :param per_minute: 每分钟补充的数量
+    :param capacity: 桶容量，即允许的突发量，默认为一分钟的补充量
+    """
+
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self.rate = per_minute / 60
+        self.capacity = per_minute if capacity is None else capacity
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        预约`amount`的额度，返回需要等待的秒数
+        """
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        if self.level >= 0:
+            return 0
+        return -self.level / self.rate
+
+    def refund(self, amount: float):
+        # 实际用量少于预约时返还，多于预约时`amount`为负，扣除差额
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ModelLimiter:
+    """
+    单个模型的限流器
+    ----------------
+    :param rpm: 每分钟请求数，为0时不限制
+    :param tpm: 每分钟token数，为0时不限制
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+        self.count = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.tokens_estimated = 0
+        self.tokens_actual = 0
+
+    def reserve(self, tokens: int, now: float) -> float:
+        wait = 0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens, now))
+        return wait
+
+    def cancel(self, tokens: int):
+        if self.requests is not None:
+            self.requests.refund(1)
+        if self.tokens is not None:
+            self.tokens.refund(tokens)
+
+    def to_dict(self):
+        return {
+            "requests": self.count,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+            "waiting": self.waiting,
+            "wait_avg": self.wait_total / self.count if self.count else 0,
+            "wait_max": self.wait_max,
+            "tokens_estimated": self.tokens_estimated,
+            "tokens_actual": self.tokens_actual,
+        }
+
+
+class RateLimiter:
+    """
+    按模型限流
+    ----------------
+    :param limits: 各模型的限制，如{"模型名称": {"rpm": 1000, "tpm": 50000}}
+    :param default: 未配置的模型使用的限制
+    :param max_wait: 最长排队时间（秒），需要等待更久时放弃请求，为0时不限制
+    """
+
+    def __init__(
+        self, limits: dict | None = None, default: dict | None = None, max_wait: float = 0
+    ):
+        self.limits = limits or {}
+        self.default = default or {}
+        self.max_wait = max_wait
+
+        self.__lock = threading.Lock()
+        self.__models: dict[str, ModelLimiter] = {}
+
+    def __get(self, model: str) -> ModelLimiter:
+        # 调用时需持有锁
+        limiter = self.__models.get(model)
+        if limiter is None:
+            limit = self.limits.get(model, self.default)
+            limiter = ModelLimiter(limit.get("rpm", 0), limit.get("tpm", 0))
+            self.__models[model] = limiter
+        return limiter
+
+    def __reserve(self, model: str, tokens: int):
+        # 预约额度，返回需要等待的秒数，超过最长排队时间时取消预约并返回None
+        with self.__lock:
+            limiter = self.__get(model)
+            wait = limiter.reserve(tokens, time.monotonic())
+            if self.max_wait and wait > self.max_wait:
+                limiter.cancel(tokens)
+                limiter.rejected += 1
+                return None
+            limiter.count += 1
+            limiter.tokens_estimated += tokens
+            limiter.wait_total += wait
+            limiter.wait_max = max(limiter.wait_max, wait)
+            if wait > 0:
+                limiter.throttled += 1
+                limiter.waiting += 1
+            return wait
+
+    def __leave(self, model: str):
+        with self.__lock:
+            self.__get(model).waiting -= 1
+
+    def acquire(self, model: str, tokens: int) -> bool:
+        """
+        取得一次请求的额度，额度不足时阻塞等待
+        -----------------
+        :param model: 模型名称
+        :param tokens: 估计的token数（输入与最大输出之和）
+        :return: 是否取得额度，需要等待超过最长排队时间时返回False
+        """
+        wait = self.__reserve(model, tokens)
+        if wait is None:
+            return False
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self.__leave(model)
+        return True
+
+    async def aacquire(self, model: str, tokens: int) -> bool:
+        """
+        `acquire`的异步版本，等待时不阻塞事件循环
+        """
+        wait = self.__reserve(model, tokens)
+        if wait is None:
+            return False
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.__leave(model)
+        return True
+
+    def settle(self, model: str, estimated: int, actual: int):
+        """
+        请求结束后按实际用量（如`usage.total_tokens`）修正预约的token数
+        """
+        with self.__lock:
+            limiter = self.__get(model)
+            limiter.tokens_actual += actual
+            if limiter.tokens is not None:
+                limiter.tokens.refund(estimated - actual)
+
+    def stats(self):
+        with self.__lock:
+            return {model: limiter.to_dict() for model, limiter in self.__models.items()}
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """
+    获取进程内共享的限流器，首次调用时按`settings`中的配置创建
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter(
+                    settings.RATE_LIMITS,
+                    default=settings.RATE_LIMIT_DEFAULT,
+                    max_wait=settings.RATE_LIMIT_MAX_WAIT,
+                )
+    return _rate_limiter
@@ -0,0 +1,290 @@
+import asyncio
+import weakref
+import threading
+
+"""
+合并相同的并发请求（single-flight）
+同一时刻输入完全相同的请求（如重复提交、多个标签页打开同一对话）只向上游发送一次，结果由所有调用方共享；
+流式请求由后台统一读取上游数据，分发给每个订阅者，后加入的订阅者会先收到已缓冲的数据
+"""
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _StreamFlight:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.subscribers = 1
+
+
+class _AsyncStreamFlight:
+    def __init__(self):
+        self.changed = asyncio.Event()
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.subscribers = 1
+        self.task = None
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class SingleFlight:
+    """
+    请求合并
+    ----------------
+    以请求的哈希为键，同步与异步调用分别合并，流式与非流式请求分别合并；
+    异步的任务与事件绑定在创建时的事件循环上，因此异步调用只与同一事件循环中的调用合并
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls: dict[str, _Call] = {}
+        self.__streams: dict[str, _StreamFlight] = {}
+        # 事件循环 -> {请求的哈希: 任务}
+        self.__atasks = weakref.WeakKeyDictionary()
+        self.__astreams = weakref.WeakKeyDictionary()
+        self.__leaders = 0
+        self.__followers = 0
+
+    @staticmethod
+    def __loop_flights(flights: weakref.WeakKeyDictionary) -> dict:
+        # 当前事件循环的请求表，调用时需持有锁
+        loop = asyncio.get_running_loop()
+        current = flights.get(loop)
+        if current is None:
+            current = flights[loop] = {}
+        return current
+
+    def __count(self, leader: bool):
+        # 调用时需持有锁
+        if leader:
+            self.__leaders += 1
+        else:
+            self.__followers += 1
+
+    def do(self, key: str, fn):
+        """
+        执行`fn`，相同键的并发调用只执行一次
+        -----------------
+        :param key: 请求的哈希
+        :param fn: 无参数的函数
+        :return: (结果, 是否为实际执行的调用)，`fn`抛出异常时所有调用方都会抛出该异常
+        """
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.__calls[key] = call
+            self.__count(leader)
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, False
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.event.set()
+        return call.result, True
+
+    async def ado(self, key: str, fn):
+        """
+        `do`的异步版本
+        -----------------
+        :param fn: 无参数的异步函数
+        :return: (结果, 是否为实际执行的调用)；某个调用方被取消时不影响其它调用方
+        """
+        with self.__lock:
+            atasks = self.__loop_flights(self.__atasks)
+            task = atasks.get(key)
+            leader = task is None
+            if leader:
+                task = asyncio.ensure_future(fn())
+                atasks[key] = task
+                task.add_done_callback(lambda _: self.__pop(atasks, key, task))
+            self.__count(leader)
+        return await asyncio.shield(task), leader
+
+    def stream(self, key: str, open_stream):
+        """
+        合并流式请求
+        -----------------
+        首个调用方在后台线程中读取上游数据并缓冲，所有调用方（包括后加入的）都从头依次读取缓冲的数据。
+        所有调用方都退出时停止读取上游
+        :param key: 请求的哈希
+        :param open_stream: 无参数的函数，返回上游数据块的迭代器
+        :return: 生成器，依次返回上游的数据块
+        """
+        with self.__lock:
+            flight = self.__streams.get(key)
+            leader = flight is None
+            if leader:
+                flight = _StreamFlight()
+                self.__streams[key] = flight
+            else:
+                flight.subscribers += 1
+            self.__count(leader)
+        if leader:
+            threading.Thread(
+                target=self.__pump, args=(key, flight, open_stream), daemon=True
+            ).start()
+        return self.__subscribe(key, flight)
+
+    def __pump(self, key: str, flight: _StreamFlight, open_stream):
+        chunks = None
+        try:
+            chunks = iter(open_stream())
+            for chunk in chunks:
+                with flight.cond:
+                    if flight.subscribers == 0:
+                        break
+                    flight.chunks.append(chunk)
+                    flight.cond.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            if hasattr(chunks, "close"):
+                # 提前结束时关闭上游连接
+                chunks.close()
+            with self.__lock:
+                if self.__streams.get(key) is flight:
+                    del self.__streams[key]
+            with flight.cond:
+                flight.finished = True
+                flight.cond.notify_all()
+
+    def __subscribe(self, key: str, flight: _StreamFlight):
+        idx = 0
+        try:
+            while True:
+                with flight.cond:
+                    while idx >= len(flight.chunks) and not flight.finished:
+                        flight.cond.wait()
+                    chunks = flight.chunks[idx:]
+                    finished = flight.finished
+                idx += len(chunks)
+                yield from chunks
+                if finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            with self.__lock:
+                with flight.cond:
+                    flight.subscribers -= 1
+                    abandoned = flight.subscribers == 0 and not flight.finished
+                # 没有订阅者后不再接受新的订阅者，后续相同的请求重新发起
+                if abandoned and self.__streams.get(key) is flight:
+                    del self.__streams[key]
+
+    def astream(self, key: str, open_stream):
+        """
+        `stream`的异步版本
+        -----------------
+        :param open_stream: 无参数的函数，返回上游数据块的异步迭代器
+        :return: 异步生成器，依次返回上游的数据块
+        """
+        with self.__lock:
+            astreams = self.__loop_flights(self.__astreams)
+            flight = astreams.get(key)
+            leader = flight is None
+            if leader:
+                flight = _AsyncStreamFlight()
+                astreams[key] = flight
+                flight.task = asyncio.ensure_future(
+                    self.__apump(astreams, key, flight, open_stream)
+                )
+            else:
+                flight.subscribers += 1
+            self.__count(leader)
+        return self.__asubscribe(astreams, key, flight)
+
+    def __pop(self, flights: dict, key: str, flight):
+        with self.__lock:
+            if flights.get(key) is flight:
+                del flights[key]
+
+    async def __apump(
+        self, astreams: dict, key: str, flight: _AsyncStreamFlight, open_stream
+    ):
+        try:
+            async for chunk in open_stream():
+                flight.chunks.append(chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            flight.error = e
+        finally:
+            self.__pop(astreams, key, flight)
+            flight.finished = True
+            flight.notify()
+
+    async def __asubscribe(self, astreams: dict, key: str, flight: _AsyncStreamFlight):
+        idx = 0
+        try:
+            while True:
+                if idx < len(flight.chunks):
+                    idx += 1
+                    yield flight.chunks[idx - 1]
+                    continue
+                if flight.finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.changed.wait()
+        finally:
+            with self.__lock:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.finished
+                if abandoned and astreams.get(key) is flight:
+                    del astreams[key]
+            if abandoned:
+                # 所有订阅者都已退出，取消读取上游（会关闭上游连接）
+                flight.task.cancel()
+
+    def stats(self):
+        with self.__lock:
+            total = self.__leaders + self.__followers
+            return {
+                "upstream_requests": self.__leaders,
+                "coalesced_requests": self.__followers,
+                "coalesced_rate": self.__followers / total if total else 0,
+                "in_flight": len(self.__calls)
+                + len(self.__streams)
+                + sum(len(atasks) for atasks in self.__atasks.values())
+                + sum(len(astreams) for astreams in self.__astreams.values()),
+            }
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """
+    获取进程内共享的请求合并器
+    """
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight()
+    return _single_flight
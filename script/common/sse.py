@@ -0,0 +1,186 @@
+import json
+
+"""
+增量SSE（Server-Sent Events）解析
+上游返回的数据块边界与SSE事件边界无关，一个事件可能被拆到多个数据块中，一个数据块中也可能含有多个事件，
+因此需要先按行缓存，遇到空行时才组成完整的事件
+"""
+
+
+class SSEEvent:
+    """
+    一个完整的SSE事件
+    ----------------
+    :param data: 事件数据（多行`data`字段以换行拼接），保持为bytes，需要时再解码
+    :param event: 事件类型，未指定时为None
+    :param id: 事件ID，未指定时为最近一次出现的ID
+    :param retry: 重连间隔（毫秒），未指定时为None
+    """
+
+    __slots__ = ("data", "event", "id", "retry", "__json")
+
+    def __init__(self, data: bytes, event=None, id=None, retry=None):
+        self.data = data
+        self.event = event
+        self.id = id
+        self.retry = retry
+        self.__json = None
+
+    @property
+    def is_done(self):
+        # OpenAI风格的流结束标记
+        return self.data == b"[DONE]"
+
+    @property
+    def text(self):
+        return self.data.decode("utf-8")
+
+    def json(self):
+        """
+        解析事件数据，结果会被缓存，多次调用不会重复解析
+        """
+        if self.__json is None:
+            self.__json = json.loads(self.data)
+        return self.__json
+
+    def encode(self):
+        """
+        重新编码为SSE格式，用于转发
+        """
+        lines = []
+        if self.event is not None:
+            lines.append(b"event: " + self.event.encode("utf-8"))
+        if self.id is not None:
+            lines.append(b"id: " + self.id.encode("utf-8"))
+        for line in self.data.split(b"\n"):
+            lines.append(b"data: " + line)
+        return b"\n".join(lines) + b"\n\n"
+
+    def __repr__(self):
+        return "SSEEvent(event={!r}, id={!r}, data={!r})".format(
+            self.event, self.id, self.data
+        )
+
+
+class SSEDecoder:
+    """
+    增量SSE解析器
+    ----------------
+    通过`feed`不断喂入原始数据块，返回其中已完整的事件；未完整的行与事件会留在缓冲区中等待后续数据。
+    行结束符支持`\\n`与`\\r\\n`
+    """
+
+    def __init__(self):
+        self.__buffer = b""
+        self.__data = []
+        self.__event = None
+        self.__retry = None
+        self.last_event_id = None
+
+    def feed(self, chunk: bytes) -> list[SSEEvent]:
+        """
+        喂入一个数据块
+        -----------------
+        :param chunk: 原始数据块
+        :return: 该数据块中完成的事件列表
+        """
+        if self.__buffer:
+            chunk = self.__buffer + chunk
+        lines = chunk.split(b"\n")
+        # 最后一段没有换行符，是未完整的行
+        self.__buffer = lines.pop()
+        events = []
+        data = self.__data
+        for line in lines:
+            if line[-1:] == b"\r":
+                line = line[:-1]
+            if not line:
+                event = self.__dispatch()
+                if event is not None:
+                    events.append(event)
+                data = self.__data
+            elif line[:5] == b"data:":
+                # 绝大多数行都是`data`字段，单独处理
+                data.append(line[6:] if line[5:6] == b" " else line[5:])
+            else:
+                self.__process_line(line)
+        return events
+
+    def flush(self) -> list[SSEEvent]:
+        """
+        数据流结束时调用，处理缓冲区中剩余的数据
+        严格来说未以空行结束的事件应被丢弃，但部分服务在最后一个事件后不发送空行，这里仍然将其返回
+        """
+        events = []
+        if self.__buffer:
+            line = self.__buffer.rstrip(b"\r")
+            self.__buffer = b""
+            event = self.__process_line(line)
+            if event is not None:
+                events.append(event)
+        event = self.__dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def __process_line(self, line: bytes):
+        if not line:
+            return self.__dispatch()
+        if line[0] == 0x3A:
+            # 以冒号开头的是注释（常用作心跳），忽略
+            return None
+        colon = line.find(b":")
+        if colon == -1:
+            field, value = line, b""
+        else:
+            field = line[:colon]
+            value = line[colon + 1 :]
+            if value[:1] == b" ":
+                value = value[1:]
+        if field == b"data":
+            self.__data.append(value)
+        elif field == b"event":
+            self.__event = value.decode("utf-8")
+        elif field == b"id":
+            if b"\0" not in value:
+                self.last_event_id = value.decode("utf-8")
+        elif field == b"retry":
+            if value.isdigit():
+                self.__retry = int(value)
+        return None
+
+    def __dispatch(self):
+        data, event, retry = self.__data, self.__event, self.__retry
+        self.__data = []
+        self.__event = None
+        self.__retry = None
+        if not data:
+            return None
+        return SSEEvent(
+            data[0] if len(data) == 1 else b"\n".join(data),
+            event=event,
+            id=self.last_event_id,
+            retry=retry,
+        )
+
+
+def iter_events(chunks):
+    """
+    将原始数据块的迭代器转换为SSE事件的迭代器
+    """
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+async def aiter_events(chunks):
+    """
+    `iter_events`的异步版本
+    """
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
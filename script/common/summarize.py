@@ -0,0 +1,167 @@
+import threading
+
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from common.context import estimate_tokens
+from setting import settings, prompt
+
+"""
+文本附件的自适应总结
+较短的文本不必总结，直接放入对话；较长的文本按`TEXT_CHUNK_TOKENS`切分为多段并发总结（map），
+再将相邻的摘要逐层合并（reduce），直到只剩一份摘要
+"""
+
+
+def split_line(line: str, chunk_tokens: int) -> list[str]:
+    """
+    将超长的单行切分为多段，每段取不超过`chunk_tokens`个token的最长前缀
+    """
+    pieces = []
+    start = 0
+    while start < len(line):
+        # 一个token至少对应一个字符，至多对应4个字符（非中日韩文字），在此范围内二分查找
+        lo, hi = start + 1, min(len(line), start + chunk_tokens * 4)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if estimate_tokens(line[start:mid]) <= chunk_tokens:
+                lo = mid
+            else:
+                hi = mid - 1
+        pieces.append(line[start:lo])
+        start = lo
+    return pieces
+
+
+def split_text(text: str, chunk_tokens: int) -> list[str]:
+    """
+    按行切分文本，每段不超过`chunk_tokens`个token，超长的单行按token数切分
+    """
+    chunks, lines, tokens = [], [], 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = estimate_tokens(line)
+        if lines and tokens + line_tokens > chunk_tokens:
+            chunks.append("".join(lines))
+            lines, tokens = [], 0
+        if line_tokens > chunk_tokens:
+            chunks.extend(split_line(line, chunk_tokens))
+            continue
+        lines.append(line)
+        tokens += line_tokens
+    if lines:
+        chunks.append("".join(lines))
+    return chunks
+
+
+class TextSummarizer:
+    """
+    自适应的map-reduce总结
+    ----------------
+    :param summarizer: 总结函数`summarizer(系统提示, 文本)`，返回摘要
+    :param inline_tokens: 不超过该token数的文本直接返回原文
+    :param chunk_tokens: 每段（以及每次合并的输入）的最大token数
+    :param max_workers: 并发总结的最大线程数
+    """
+
+    def __init__(
+        self,
+        summarizer: Callable[[str, str], str],
+        inline_tokens: int = 1500,
+        chunk_tokens: int = 6000,
+        max_workers: int = 4,
+    ):
+        self.summarizer = summarizer
+        self.inline_tokens = inline_tokens
+        self.chunk_tokens = chunk_tokens
+        self.max_workers = max_workers
+
+    def needs_summary(self, text: str) -> bool:
+        return estimate_tokens(text) > self.inline_tokens
+
+    def __call__(self, text: str) -> str:
+        """
+        总结文本
+        -----------------
+        :return: 较短的文本返回原文，否则返回摘要；请求出错时返回错误信息
+        """
+        if not self.needs_summary(text):
+            return text
+        chunks = split_text(text, self.chunk_tokens)
+        if len(chunks) == 1:
+            return self.summarizer(prompt.TEXT_PROMPT, text)
+
+        summaries = self.__map(
+            [
+                (prompt.TEXT_CHUNK_PROMPT.format(index=idx, total=len(chunks)), chunk)
+                for idx, chunk in enumerate(chunks, 1)
+            ]
+        )
+        while len(summaries) > 1:
+            for summary in summaries:
+                if summary.startswith("Request Error:"):
+                    return summary
+            summaries = self.__map(
+                [
+                    (prompt.TEXT_REDUCE_PROMPT, "\n\n".join(group))
+                    for group in self.__group(summaries)
+                ]
+            )
+        return summaries[0]
+
+    def __group(self, summaries: list[str]) -> list[list[str]]:
+        # 相邻的摘要按token数分组，每组至少两份，保证每一层的摘要数都会减少
+        groups, tokens = [], 0
+        for summary in summaries:
+            summary_tokens = estimate_tokens(summary)
+            if groups and (
+                len(groups[-1]) < 2 or tokens + summary_tokens <= self.chunk_tokens
+            ):
+                groups[-1].append(summary)
+                tokens += summary_tokens
+            else:
+                groups.append([summary])
+                tokens = summary_tokens
+        if len(groups) > 1 and len(groups[-1]) == 1:
+            groups[-2].extend(groups.pop())
+        return groups
+
+    def __map(self, jobs: list[tuple[str, str]]) -> list[str]:
+        if len(jobs) == 1:
+            return [self.summarizer(*jobs[0])]
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(jobs)), thread_name_prefix="summarize"
+        ) as executor:
+            return list(executor.map(lambda job: self.summarizer(*job), jobs))
+
+
+def __summarize_with_text_handler(system_prompt: str, text: str) -> str:
+    from common.models.OpenAi import OpenAi
+
+    model = OpenAi(
+        settings.API_URL,
+        settings.API_KEY,
+        settings.TEXT_HANDLER,
+        system_prompt=system_prompt,
+        enable_cache=True,
+    )
+    return model(text)
+
+
+_text_summarizer = None
+_text_summarizer_lock = threading.Lock()
+
+
+def get_text_summarizer() -> TextSummarizer:
+    """
+    获取进程内共享的文本总结器，首次调用时按`settings`中的配置创建
+    """
+    global _text_summarizer
+    if _text_summarizer is None:
+        with _text_summarizer_lock:
+            if _text_summarizer is None:
+                _text_summarizer = TextSummarizer(
+                    __summarize_with_text_handler,
+                    inline_tokens=settings.TEXT_INLINE_TOKENS,
+                    chunk_tokens=settings.TEXT_CHUNK_TOKENS,
+                    max_workers=settings.TEXT_MAX_WORKERS,
+                )
+    return _text_summarizer
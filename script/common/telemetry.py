@@ -0,0 +1,272 @@
+import time
+import bisect
+import threading
+
+"""
+模型调用的遥测数据
+每次调用结束时生成一个事件（字典），交给注册的钩子函数处理，默认的汇总器按模型统计耗时分布与token用量
+"""
+
+# 耗时分布的桶上界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class CallTrace:
+    """
+    记录一次调用的各个时间点与用量，结束时生成事件
+    ----------------
+    事件字段：
+    model: 模型名称
+    endpoint: 实际请求的地址（本地模型为模型路径）
+    stream: 是否流式
+    queue_time: 在限流器中排队的时间（秒）
+    ttfb: 从调用开始到收到首个响应（流式为响应头）的时间（秒）
+    ttft: 从调用开始到收到首个生成文本的时间（秒）
+    total: 调用总时间（秒）
+    tokens_per_second: 流式调用中首个生成文本之后的输出速度
+    prompt_tokens / completion_tokens / cached_tokens: token用量，服务未返回`usage`时为估计值
+    rounds / tool_rounds: 请求轮数与其中调用了工具的轮数
+    cached: 是否命中回复缓存
+    coalesced: 是否与其它相同的请求合并（未实际请求上游）
+    error: 错误信息，成功时为None
+    """
+
+    def __init__(self, telemetry, model: str, endpoint: str, stream: bool = False):
+        self.telemetry = telemetry
+        self.__start = time.perf_counter()
+        self.__finished = False
+        self.event = {
+            "model": model,
+            "endpoint": endpoint,
+            "stream": stream,
+            "queue_time": 0.0,
+            "ttfb": None,
+            "ttft": None,
+            "total": None,
+            "tokens_per_second": None,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "rounds": 0,
+            "tool_rounds": 0,
+            "cached": False,
+            "coalesced": False,
+            "error": None,
+        }
+
+    def elapsed(self):
+        return time.perf_counter() - self.__start
+
+    def add_queue_time(self, seconds: float):
+        self.event["queue_time"] += seconds
+
+    def first_byte(self, endpoint: str | None = None):
+        # 每轮请求收到响应时调用，只记录第一次
+        self.event["rounds"] += 1
+        if endpoint is not None:
+            self.event["endpoint"] = endpoint
+        if self.event["ttfb"] is None:
+            self.event["ttfb"] = self.elapsed()
+
+    def first_token(self):
+        if self.event["ttft"] is None:
+            self.event["ttft"] = self.elapsed()
+
+    def tool_round(self):
+        self.event["tool_rounds"] += 1
+
+    def add_usage(
+        self,
+        usage: dict | None,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+    ):
+        """
+        累加一轮请求的用量，`usage`缺失时使用估计值
+        """
+        if usage:
+            prompt_tokens = usage.get("prompt_tokens", prompt_tokens)
+            completion_tokens = usage.get("completion_tokens", completion_tokens)
+            # OpenAI返回`prompt_tokens_details.cached_tokens`，DeepSeek返回`prompt_cache_hit_tokens`
+            details = usage.get("prompt_tokens_details") or {}
+            self.event["cached_tokens"] += (
+                details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens") or 0
+            )
+        self.event["prompt_tokens"] += prompt_tokens
+        self.event["completion_tokens"] += completion_tokens
+
+    def fail(self, error):
+        if self.event["error"] is None:
+            self.event["error"] = str(error)
+
+    def finish(self, **fields):
+        """
+        结束调用并发送事件，多次调用只发送一次
+        """
+        if self.__finished:
+            return
+        self.__finished = True
+        self.event.update(fields)
+        self.event["total"] = self.elapsed()
+        ttft = self.event["ttft"]
+        if self.event["stream"] and ttft is not None and self.event["completion_tokens"]:
+            decode_time = self.event["total"] - ttft
+            if decode_time > 0:
+                self.event["tokens_per_second"] = (
+                    self.event["completion_tokens"] / decode_time
+                )
+        self.telemetry.emit(self.event)
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def quantile(self, q: float):
+        # 取所在桶的上界，最后一个桶没有上界时返回最大的桶界
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[min(idx, len(LATENCY_BUCKETS) - 1)]
+        return LATENCY_BUCKETS[-1]
+
+    def to_dict(self):
+        return {
+            "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+inf"], self.counts)),
+            "avg": self.sum / self.total if self.total else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+class _ModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.coalesced = 0
+        self.tool_rounds = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.queue_time = 0.0
+        self.total = _Histogram()
+        self.ttft = _Histogram()
+        self.tokens_per_second = []
+
+    def add(self, event: dict):
+        self.calls += 1
+        self.errors += event["error"] is not None
+        self.coalesced += event["coalesced"]
+        self.tool_rounds += event["tool_rounds"]
+        self.prompt_tokens += event["prompt_tokens"]
+        self.completion_tokens += event["completion_tokens"]
+        self.cached_tokens += event["cached_tokens"]
+        self.queue_time += event["queue_time"]
+        self.total.add(event["total"])
+        if event["ttft"] is not None:
+            self.ttft.add(event["ttft"])
+        if event["tokens_per_second"] is not None:
+            self.tokens_per_second.append(event["tokens_per_second"])
+            del self.tokens_per_second[:-1000]
+
+    def to_dict(self):
+        speeds = self.tokens_per_second
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "coalesced": self.coalesced,
+            "tool_rounds": self.tool_rounds,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": self.cached_tokens / self.prompt_tokens
+            if self.prompt_tokens
+            else 0,
+            "queue_time_avg": self.queue_time / self.calls if self.calls else 0,
+            "total": self.total.to_dict(),
+            "ttft": self.ttft.to_dict(),
+            "tokens_per_second_avg": sum(speeds) / len(speeds) if speeds else None,
+        }
+
+
+class TelemetryAggregator:
+    """
+    进程内的遥测汇总，按模型统计调用数、错误数、token用量与耗时分布，可作为钩子注册
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__models: dict[str, _ModelStats] = {}
+
+    def __call__(self, event: dict):
+        with self.__lock:
+            self.__models.setdefault(event["model"], _ModelStats()).add(event)
+
+    def stats(self):
+        with self.__lock:
+            return {model: stats.to_dict() for model, stats in self.__models.items()}
+
+
+class Telemetry:
+    """
+    遥测钩子
+    ----------------
+    通过`add_hook`注册钩子函数，每次调用结束时以事件字典为参数调用，钩子抛出的异常会被忽略
+    """
+
+    def __init__(self):
+        self.aggregator = TelemetryAggregator()
+        self.__hooks = [self.aggregator]
+        self.__lock = threading.Lock()
+
+    def add_hook(self, hook):
+        with self.__lock:
+            self.__hooks = self.__hooks + [hook]
+
+    def remove_hook(self, hook):
+        with self.__lock:
+            self.__hooks = [h for h in self.__hooks if h is not hook]
+
+    def trace(self, model: str, endpoint: str, stream: bool = False) -> CallTrace:
+        """
+        开始记录一次调用
+        """
+        return CallTrace(self, model, endpoint, stream)
+
+    def emit(self, event: dict):
+        for hook in self.__hooks:
+            try:
+                hook(event)
+            except Exception:
+                # 遥测不能影响调用本身
+                pass
+
+    def stats(self):
+        return self.aggregator.stats()
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry() -> Telemetry:
+    """
+    获取进程内共享的遥测对象
+    """
+    global _telemetry
+    if _telemetry is None:
+        with _telemetry_lock:
+            if _telemetry is None:
+                _telemetry = Telemetry()
+    return _telemetry
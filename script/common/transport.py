@@ -0,0 +1,309 @@
+import threading
+import weakref
+import asyncio
+import urllib3
+
+from urllib3.util import parse_url
+from setting import settings
+
+urllib3.disable_warnings()
+
+
+class HttpTransport:
+    """
+    进程内共享的HTTP连接池
+    ----------------------
+    对`urllib3.PoolManager`的简单封装，同一主机的请求复用长连接，避免每次请求都重新进行TCP与TLS握手；
+    不使用urllib3的自动重试，每次请求只尝试一次，重试由调用方（如`EndpointPool`）负责
+    :param num_pools: 连接池数量，每个主机占用一个连接池
+    :param maxsize: 每个主机保持的长连接数量
+    :param timeout: 默认超时时间（秒）
+    :param connect_timeout: 建立连接的超时时间（秒）
+    """
+
+    # 请求超时时抛出的异常
+    timeout_errors = (urllib3.exceptions.TimeoutError,)
+    # 连接失败、超时等可以换一个地址重试的异常
+    errors = (urllib3.exceptions.HTTPError,)
+
+    def __init__(
+        self,
+        num_pools: int = 10,
+        maxsize: int = 16,
+        timeout: float = 300,
+        connect_timeout: float = 10,
+    ):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.manager = urllib3.PoolManager(num_pools=num_pools, maxsize=maxsize)
+
+        self.__lock = threading.Lock()
+        self.__requests = 0
+        # 建立连接（TCP/TLS握手）的次数
+        self.__connects = 0
+        # 用到过的连接池，每个连接池只替换一次连接类
+        self.__pools = {}
+        # 原连接类 -> 统计握手次数的子类
+        self.__connection_classes = {}
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: dict | None = None,
+        body: str | bytes | None = None,
+        stream: bool = False,
+        timeout: float | None = None,
+    ):
+        """
+        发送请求
+        -----------------
+        :param method: 请求方法
+        :param url: 完整地址
+        :param headers: 请求头
+        :param body: 请求体
+        :param stream: 是否流式读取，流式读取时不预加载响应体，读取完毕后需调用`release`归还连接
+        :param timeout: 读取超时时间，默认使用连接池的超时时间；建立连接的超时时间不超过`connect_timeout`
+        :return: `urllib3.BaseHTTPResponse`
+        """
+        timeout = self.timeout if timeout is None else timeout
+        headers = dict(headers) if headers else {}
+        if not stream:
+            # 非流式响应体一次性返回，使用gzip压缩减少传输量；流式响应压缩会导致逐字输出被缓冲
+            headers.setdefault("Accept-Encoding", "gzip")
+        u = parse_url(url)
+        pool = self.manager.connection_from_host(u.host, port=u.port, scheme=u.scheme)
+        with self.__lock:
+            self.__requests += 1
+            if id(pool) not in self.__pools:
+                self.__pools[id(pool)] = pool
+                pool.ConnectionCls = self.__counting(pool.ConnectionCls)
+        return pool.urlopen(
+            method,
+            u.request_uri,
+            headers=headers,
+            body=body,
+            timeout=urllib3.Timeout(
+                connect=min(self.connect_timeout, timeout), read=timeout
+            ),
+            preload_content=not stream,
+            release_conn=not stream,
+            assert_same_host=False,
+            redirect=False,
+            retries=False,
+        )
+
+    def iter_stream(self, rsp):
+        """
+        逐块读取流式响应，读取结束（包括提前中断）后归还连接
+        """
+        finished = False
+        try:
+            for chunk in rsp.stream():
+                yield chunk
+            finished = True
+        finally:
+            self.release(rsp, reuse=finished)
+
+    def release(self, rsp, reuse: bool = True):
+        """
+        归还流式响应占用的连接
+        -----------------
+        :param reuse: 是否复用该连接，复用时丢弃未读完的响应体；提前中断的流（如客户端断开）应直接关闭连接，
+        否则会一直读到上游生成结束
+        """
+        try:
+            if reuse:
+                rsp.drain_conn()
+            else:
+                rsp.close()
+        finally:
+            rsp.release_conn()
+
+    def __counting(self, cls):
+        """
+        返回`cls`的子类，每次`connect`都计入握手次数
+        连接池中的长连接被服务端关闭后，urllib3会在同一个连接对象上重新`connect`，重试时也会建立新连接，
+        只统计连接池新建的连接对象数会漏掉这些握手，因此在`connect`处统计
+        """
+        counting = self.__connection_classes.get(cls)
+        if counting is None:
+            count = self.__count_connect
+
+            class CountingConnection(cls):
+                def connect(self):
+                    count()
+                    return super().connect()
+
+            counting = self.__connection_classes[cls] = CountingConnection
+        return counting
+
+    def __count_connect(self):
+        with self.__lock:
+            self.__connects += 1
+
+    def stats(self):
+        """
+        连接池统计信息
+        -----------------
+        hits: 复用已有长连接的请求数
+        misses: 建立连接（即需要握手）的次数，包括长连接失效后的重连与重试时的新建连接
+        """
+        with self.__lock:
+            requests = self.__requests
+            misses = self.__connects
+            pools = list(self.__pools.values())
+        return {
+            "requests": requests,
+            "hits": max(requests - misses, 0),
+            "misses": misses,
+            "hit_rate": max(requests - misses, 0) / requests if requests else 0,
+            "pools": len(pools),
+        }
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> HttpTransport:
+    """
+    获取进程内共享的连接池，首次调用时按`settings`中的配置创建
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = HttpTransport(
+                    num_pools=settings.HTTP_NUM_POOLS,
+                    maxsize=settings.HTTP_POOL_MAXSIZE,
+                    timeout=settings.HTTP_TIMEOUT,
+                    connect_timeout=settings.HTTP_CONNECT_TIMEOUT,
+                )
+    return _transport
+
+
+class AsyncHttpTransport:
+    """
+    进程内共享的异步HTTP连接池
+    ----------------------
+    基于`httpx.AsyncClient`，供异步接口使用，等待上游响应时不会阻塞事件循环
+    :param max_connections: 最大并发连接数
+    :param maxsize: 每个主机保持的长连接数量
+    :param timeout: 默认超时时间（秒）
+    :param connect_timeout: 建立连接的超时时间（秒）
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 512,
+        maxsize: int = 16,
+        timeout: float = 300,
+        connect_timeout: float = 10,
+    ):
+        import httpx
+
+        self.__httpx = httpx
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        # 请求超时时抛出的异常
+        self.timeout_errors = (httpx.TimeoutException,)
+        # 连接失败、超时等可以换一个地址重试的异常
+        self.errors = (httpx.TransportError,)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=maxsize,
+            ),
+            timeout=self.__timeout(None),
+        )
+        self.__requests = 0
+
+    def __timeout(self, timeout: float | None):
+        # 读取超时时间为`timeout`，建立连接的超时时间不超过`connect_timeout`
+        timeout = self.timeout if timeout is None else timeout
+        return self.__httpx.Timeout(timeout, connect=min(self.connect_timeout, timeout))
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        headers: dict | None = None,
+        body: str | bytes | None = None,
+        timeout: float | None = None,
+    ):
+        """
+        发送请求并读取完整响应体
+        -----------------
+        :return: `httpx.Response`
+        """
+        self.__requests += 1
+        return await self.client.request(
+            method,
+            url,
+            headers=headers,
+            content=body,
+            timeout=self.__timeout(timeout),
+        )
+
+    def stream(
+        self,
+        method: str,
+        url: str,
+        headers: dict | None = None,
+        body: str | bytes | None = None,
+        timeout: float | None = None,
+    ):
+        """
+        发送流式请求，返回异步上下文管理器，退出时归还连接
+        -----------------
+        :return: `AsyncContextManager[httpx.Response]`
+        """
+        self.__requests += 1
+        headers = dict(headers) if headers else {}
+        # 流式响应不压缩，避免逐字输出被缓冲
+        headers.setdefault("Accept-Encoding", "identity")
+        return self.client.stream(
+            method,
+            url,
+            headers=headers,
+            content=body,
+            timeout=self.__timeout(timeout),
+        )
+
+    async def aclose(self):
+        # 关闭所有连接，需在创建该连接池的事件循环中调用
+        await self.client.aclose()
+
+    def stats(self):
+        return {"requests": self.__requests}
+
+
+# `httpx.AsyncClient`的连接绑定在创建时的事件循环上，因此每个事件循环各用一个
+_async_transports = weakref.WeakKeyDictionary()
+
+
+def get_async_transport() -> AsyncHttpTransport:
+    """
+    获取当前事件循环共享的异步连接池，需在事件循环中调用
+    """
+    loop = asyncio.get_running_loop()
+    transport = _async_transports.get(loop)
+    if transport is None:
+        transport = AsyncHttpTransport(
+            max_connections=settings.HTTP_ASYNC_MAX_CONNECTIONS,
+            maxsize=settings.HTTP_POOL_MAXSIZE,
+            timeout=settings.HTTP_TIMEOUT,
+            connect_timeout=settings.HTTP_CONNECT_TIMEOUT,
+        )
+        _async_transports[loop] = transport
+    return transport
+
+
+async def close_async_transport():
+    """
+    关闭当前事件循环的异步连接池，应在应用关闭时（如FastAPI的lifespan中）调用
+    """
+    transport = _async_transports.pop(asyncio.get_running_loop(), None)
+    if transport is not None:
+        await transport.aclose()
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import uuid
+import uvicorn
+
+from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from common.batching import BatchRequest, get_batch_scheduler
+from setting.settings import *
+
+"""
+本地模型服务，提供兼容OpenAI的`/v1/chat/completions`接口，并发请求由动态批处理合并生成
+运行：python local_server.py，之后将`API_URL`设置为"http://127.0.0.1:{LOCAL_SERVER_PORT}/v1"
+不支持工具调用，请求中带有`tools`时返回400
+"""
+
+app = FastAPI()
+
+MODEL_NAME = os.path.basename(os.path.normpath(LOCAL_MODEL_PATH))
+
+
+class ChatCompletionRequest(BaseModel):
+    model: str = MODEL_NAME
+    messages: list[dict]
+    max_tokens: int | None = None
+    temperature: float = 0.7
+    top_p: float | None = None
+    stream: bool = False
+    # 仅用于拒绝带有工具的请求，避免工具被静默忽略
+    tools: list[dict] | None = None
+
+
+def make_chunk(completion_id: str, created: int, delta: dict, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": MODEL_NAME,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def make_usage(request: BatchRequest):
+    return {
+        "prompt_tokens": len(request.input_ids),
+        "completion_tokens": len(request.tokens),
+        "total_tokens": len(request.input_ids) + len(request.tokens),
+    }
+
+
+def stream_response(request: BatchRequest):
+    completion_id = "chatcmpl-{}".format(uuid.uuid4().hex)
+    created = int(time.time())
+    try:
+        first = True
+        for delta in request:
+            message = {"content": delta}
+            if first:
+                message["role"] = "assistant"
+                first = False
+            chunk = make_chunk(completion_id, created, message)
+            yield "data: {}\n\n".format(json.dumps(chunk, ensure_ascii=False))
+        chunk = make_chunk(completion_id, created, {}, request.finish_reason)
+        chunk["usage"] = make_usage(request)
+        yield "data: {}\n\n".format(json.dumps(chunk, ensure_ascii=False))
+        yield "data: [DONE]\n\n"
+    finally:
+        # 客户端断开连接时停止生成
+        request.cancel()
+
+
+@app.post("/v1/chat/completions")
+def chat_completions(body: ChatCompletionRequest):
+    if body.tools:
+        raise HTTPException(
+            status_code=400, detail="tools are not supported by the local model"
+        )
+    request = get_batch_scheduler().submit(
+        body.messages,
+        max_tokens=body.max_tokens or 1024,
+        temperature=body.temperature,
+        top_p=body.top_p or 1.0,
+    )
+    if body.stream:
+        return StreamingResponse(stream_response(request), media_type="text/event-stream")
+    content = "".join(request)
+    return {
+        "id": "chatcmpl-{}".format(uuid.uuid4().hex),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": MODEL_NAME,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": request.finish_reason,
+            }
+        ],
+        "usage": make_usage(request),
+    }
+
+
+@app.get("/v1/models")
+def get_models():
+    return {"object": "list", "data": [{"id": MODEL_NAME, "object": "model"}]}
+
+
+@app.get("/stats")
+def get_stats():
+    return get_batch_scheduler().stats()
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=LOCAL_SERVER_PORT)
@@ -247,7 +247,8 @@ class RAGTree:
                                             api_key=settings.API_KEY,
                                             model=settings.TEXT_HANDLER,
                                             prompt=prompt.TEXT_PROMPT,
-                                            temperature=0.1,)
+                                            temperature=0.1,
+                                            enable_cache=True,)
                 node_des = self.summary_chunk(node_list, summary_model)
                 embedding = self.embedding_model.create_embedding(node_des)["data"][0]["embedding"]
                 root.data = list(embedding)
@@ -270,7 +271,8 @@ class RAGTree:
                                             api_key=settings.API_KEY,
                                             model=settings.TEXT_HANDLER,
                                             prompt=prompt.TEXT_PROMPT,
-                                            temperature=0.1,)
+                                            temperature=0.1,
+                                            enable_cache=True,)
                 node_des = self.summary_chunk(child_list, summary_model)
                 embedding = self.embedding_model.create_embedding(node_des)["data"][0]["embedding"]
                 node_data = list(embedding)
@@ -293,7 +295,8 @@ class RAGTree:
                                             api_key=settings.API_KEY,
                                             model=settings.TEXT_HANDLER,
                                             prompt=prompt.TEXT_PROMPT,
-                                            temperature=0.1,)
+                                            temperature=0.1,
+                                            enable_cache=True,)
                 node_des = self.summary_chunk(node_list, summary_model)
                 embedding = self.embedding_model.create_embedding(node_des)["data"][0]["embedding"]
                 root.data = list(embedding)
@@ -315,7 +318,8 @@ class RAGTree:
                                             api_key=settings.API_KEY,
                                             model=settings.TEXT_HANDLER,
                                             prompt=prompt.TEXT_PROMPT,
-                                            temperature=0.1,)
+                                            temperature=0.1,
+                                            enable_cache=True,)
                 node_des = self.summary_chunk(child_list, summary_model)
                 embedding = self.embedding_model.create_embedding(node_des)["data"][0]["embedding"]
                 node_data = list(embedding)
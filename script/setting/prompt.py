@@ -69,14 +69,36 @@ TITLE_PROMPT = (
 
 IMAGE_PROMPT = """描述图片中的内容并总结。如果含有数据，必须详细列出数据的内容；如果有表格，必须将表格以Markdown表格的格式列出"""
 
+IMAGE_BATCH_PROMPT = """用户发来了{count}张图片，按顺序分别描述每张图片中的内容并总结。如果含有数据，必须详细列出数据的内容；如果有表格，必须将表格以Markdown表格的格式列出。
+每张图片的描述以单独一行的"[图片序号]"开头，序号从1开始，不要遗漏任何一张图片，例如：
+[图片1]
+第一张图片的描述
+[图片2]
+第二张图片的描述"""
+
+CONTEXT_SUMMARY_PROMPT = """总结以下对话的要点，保留用户的需求、关键的事实与数据以及已经得出的结论，不要多于300字，直接给出总结即可，不必给出其它内容"""
+
 TEXT_PROMPT = (
     """总结用户发来的文本内容，不要多于300字，直接给出总结即可，不必给出其它内容"""
 )
 
+TEXT_CHUNK_PROMPT = """用户发来的是一个长文本的第{index}部分（共{total}部分），总结这一部分的内容，保留关键的事实、数据与结论，不要多于300字，直接给出总结即可，不必给出其它内容"""
+
+TEXT_REDUCE_PROMPT = """用户发来的是一个长文本各部分按顺序排列的摘要，将它们合并为一份完整连贯的总结，保留关键的事实、数据与结论，不要多于300字，直接给出总结即可，不必给出其它内容"""
+
 IMAGE_CLASSIFICATION_PROMPT = """根据图片内容，给出图片的分类结果，不要多于20字，直接给出分类结果即可，不需要给出其它内容"""
 
 TEXT_CLASSIFICATION_PROMPT = """根据文本内容，给出文本的分类结果，不要多于20字，直接给出分类结果即可，不需要给出其它内容"""
 
 RAG_PROMPT = """你是一个智能客服，回答用户的各项问题。如果用户的问题与某些文件相关，这里会附上相关的信息，请总结其中的信息并根据你已有的知识回复用户相关问题。
 如果用户的问题与参考资料无关，请不要按照参考资料回答。你的回复显示支持Markdown，请在有需要时附上相关链接与图片。
-如果没有参考资料，直接回答用户的问题。"""
\ No newline at end of file
+如果没有参考资料，直接回答用户的问题。"""
+# 参考文档放在系统提示之后
+RAG_SYSTEM_DOCUMENTS_PROMPT = """{system_prompt}参考文档：
+{documents}"""
+
+# 参考文档放在用户最新的消息中，系统提示与历史对话保持不变，便于服务商的前缀缓存命中
+RAG_USER_DOCUMENTS_PROMPT = """参考文档：
+{documents}
+用户的问题：
+{question}"""
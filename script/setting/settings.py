@@ -19,6 +19,204 @@ VOICE_HANDLER = "FunAudioLLM/SenseVoiceSmall"
 # 文件上传位置
 UPLOAD_PATH = "./uploads"
 
+# ENDPOINT_SETTINGS
+
+# 多个兼容OpenAI的服务地址，配置后使用`API_URL`的模型会在这些地址间负载均衡，为空时只使用`API_URL`
+# 例：{"url": "https://api.siliconflow.cn/v1", "api_key": "xxx", "weight": 2}，api_key省略时使用`API_KEY`
+API_ENDPOINTS = []
+
+# 连续失败多少次后熔断该地址
+ENDPOINT_FAILURE_THRESHOLD = 5
+
+# 熔断持续时间（秒），之后放行一个试探请求，成功则恢复
+ENDPOINT_COOLDOWN = 30
+
+# 请求失败（连接错误、429、5xx）时换一个地址重试的最大次数
+ENDPOINT_MAX_RETRIES = 2
+
+# 重试预算，每个请求积累的重试次数，限制重试数约为请求数的该比例，避免上游故障时重试放大流量
+ENDPOINT_RETRY_BUDGET = 0.2
+
+# 重试退避的基础时间与最长时间（秒），第n次重试在[0, 基础时间 * 2^n]内随机等待
+ENDPOINT_BACKOFF_BASE = 0.2
+ENDPOINT_BACKOFF_MAX = 5
+
+# 非流式请求等待超过近期耗时的该分位数后，向另一个地址发出对冲请求，取先返回的结果
+ENDPOINT_HEDGE = False
+ENDPOINT_HEDGE_QUANTILE = 0.95
+
+# SINGLE_FLIGHT_SETTINGS
+
+# 合并同时发出的相同请求（如重复提交、多个标签页打开同一对话），只向上游请求一次，流式回复分发给所有调用方
+SINGLE_FLIGHT = True
+
+# RATE_LIMIT_SETTINGS
+
+# 各模型每分钟的请求数（rpm）与token数（tpm）限制，按服务商给出的额度配置，超出时在本地排队等待而不是被上游返回429
+# token数按输入与`max_tokens`之和预估，请求结束后按返回的`usage`修正；未配置的模型使用默认值，为0时不限制
+RATE_LIMITS = {
+    "Qwen/Qwen2.5-32B-Instruct": {"rpm": 1000, "tpm": 50000},
+    "deepseek-ai/DeepSeek-V2.5": {"rpm": 1000, "tpm": 50000},
+    "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B": {"rpm": 1000, "tpm": 50000},
+    "Pro/Qwen/Qwen2-VL-7B-Instruct": {"rpm": 1000, "tpm": 50000},
+}
+RATE_LIMIT_DEFAULT = {"rpm": 0, "tpm": 0}
+
+# 最长排队时间（秒），需要等待更久时直接返回错误，为0时不限制
+RATE_LIMIT_MAX_WAIT = 120
+
+# HTTP_SETTINGS
+
+# 连接池数量，每个主机（如`API_URL`）占用一个连接池
+HTTP_NUM_POOLS = 10
+
+# 每个主机保持的长连接数量，并发请求超过该数量时会临时新建连接（用完即关闭）
+HTTP_POOL_MAXSIZE = 16
+
+# 请求超时时间（秒）
+HTTP_TIMEOUT = 300
+
+# 建立连接的超时时间（秒），上游地址不可达时尽快失败，由地址池换一个地址重试
+HTTP_CONNECT_TIMEOUT = 10
+
+# 异步连接池（`acall`/`astream`使用）的最大并发连接数，流式对话会长时间占用连接，因此需要设置得较大
+HTTP_ASYNC_MAX_CONNECTIONS = 512
+
+# TOOL_SETTINGS
+
+# 同时执行的工具调用数上限（进程内共享），超出时排队等待；超时的调用在后台执行完毕前仍占用名额，因此同时存活的工具线程数不超过该值
+TOOL_MAX_WORKERS = 8
+
+# 单个工具调用的超时时间（秒），超时后返回超时信息，不再等待其结果
+TOOL_TIMEOUT = 30
+
+# COMPLETION_CACHE_SETTINGS
+
+# 回复缓存数据库，缓存需要在创建模型时通过`enable_cache=True`开启
+COMPLETION_CACHE_PATH = "./data/cache.db"
+
+# 内存中LRU缓存的条目数
+COMPLETION_CACHE_MEMORY_SIZE = 256
+
+# 数据库中最多保存的条目数，超出时淘汰最久未访问的条目
+COMPLETION_CACHE_MAX_ENTRIES = 10000
+
+# 缓存过期时间（秒），为0时不过期
+COMPLETION_CACHE_TTL = 7 * 24 * 3600
+
+# ATTACHMENT_SETTINGS
+
+# 一次请求中并发处理附件的最大数量，多张图片、文本与音频同时处理，总耗时约为最慢的一个
+ATTACHMENT_MAX_WORKERS = 4
+
+# 一次请求中的多张图片合并为一次图片模型调用，每次最多包含的图片数，为1时每张图片单独调用
+ATTACHMENT_IMAGE_BATCH_SIZE = 4
+
+# 图片上传前的预处理：长边超过`IMAGE_MAX_EDGE`像素时按比例缩小，重新编码为质量为`IMAGE_QUALITY`的JPEG
+# （有透明通道时为PNG）并去掉EXIF信息，为False时上传原图
+IMAGE_PREPROCESS = True
+IMAGE_MAX_EDGE = 1280
+IMAGE_QUALITY = 85
+
+# 预处理结果的缓存目录，以原图内容的哈希与处理参数为文件名
+IMAGE_CACHE_PATH = "./data/images"
+
+# 文本附件不超过`TEXT_INLINE_TOKENS`个token时直接放入对话，不再总结；更长的文本按`TEXT_CHUNK_TOKENS`切分为多段，
+# 以最多`TEXT_MAX_WORKERS`个线程并发总结后逐层合并为一份摘要
+TEXT_INLINE_TOKENS = 1500
+TEXT_CHUNK_TOKENS = 6000
+TEXT_MAX_WORKERS = 4
+
+# 附件分析缓存数据库，以文件内容的哈希、处理模型与提示为键缓存图片描述、文本总结与音频转写的结果
+ATTACHMENT_CACHE_PATH = "./data/attachment.db"
+
+# 缓存结果的总大小上限（字节），超出时淘汰最久未访问的条目
+ATTACHMENT_CACHE_MAX_BYTES = 64 * 1024**2
+
+# AGENT_SETTINGS
+
+# 一次请求中模型与工具交替执行的最大轮数，超出后不再调用工具，要求模型根据已有信息直接回答
+AGENT_MAX_ROUNDS = 8
+
+# 一次请求（含所有轮次）的最长时间（秒）
+AGENT_DEADLINE = 180
+
+# 一次请求（含所有轮次）最多消耗的token数，为0时不限制
+AGENT_TOKEN_BUDGET = 100000
+
+# CONTEXT_SETTINGS
+
+# 各模型每次请求的输入token预算，超出时按`CONTEXT_STRATEGY`处理较早的对话，未配置的模型使用默认值
+CONTEXT_TOKEN_BUDGET = {
+    "Qwen/Qwen2.5-32B-Instruct": 24000,
+    "deepseek-ai/DeepSeek-V2.5": 24000,
+    "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B": 24000,
+    "Pro/Qwen/Qwen2-VL-7B-Instruct": 24000,
+}
+CONTEXT_DEFAULT_TOKEN_BUDGET = 16000
+
+# 超出预算时的处理方式，"window"为滑动窗口，直接丢弃较早的对话；"summary"将较早的对话总结为摘要（使用文本总结模型）
+CONTEXT_STRATEGY = "window"
+
+# 使用"summary"时为摘要预留的token数
+CONTEXT_SUMMARY_TOKENS = 600
+
+# AUDIO_SETTINGS
+
+# 长音频分段转写，时长不超过该值（秒）的音频直接整段上传，超过时切分为多段并发转写
+AUDIO_SEGMENT_SECONDS = 60
+
+# 切分方式，"silence"在每个切分点附近寻找静音处切开，找不到静音时退回固定窗口；"fixed"为固定窗口
+AUDIO_SEGMENT_MODE = "silence"
+
+# 固定窗口切分时相邻两段的重叠时长（秒），避免切断的词丢失，拼接时去掉重复的文字
+AUDIO_SEGMENT_OVERLAP = 2
+
+# 静音切分时在切分点前后多少秒内寻找静音
+AUDIO_SILENCE_SEARCH = 5
+
+# 音量（RMS）低于整段音频平均音量的该比例时视为静音
+AUDIO_SILENCE_THRESHOLD = 0.1
+
+# 并发转写的最大线程数
+AUDIO_MAX_WORKERS = 4
+
+# 分段上传前先混为单声道并重采样到该采样率（Hz），语音识别模型通常以16kHz处理音频，更高的采样率只会增大上传体积
+AUDIO_SAMPLE_RATE = 16000
+
+# 单次上传的最大字节数（转写接口的上传限制，OpenAI为25MB），超过时即使时长不超过`AUDIO_SEGMENT_SECONDS`也会切分，
+# 每段的时长同时受该值限制
+AUDIO_SEGMENT_MAX_BYTES = 24 * 1024**2
+
+# LOCAL_MODEL_SETTINGS
+
+# 本地模型路径与设备，`local_server.py`加载该模型并提供兼容OpenAI的接口
+LOCAL_MODEL_PATH = "./model/DeepSeek-R1-Distill-Qwen-1.5B"
+LOCAL_MODEL_DEVICE = "cpu"
+
+# 本地模型的量化方式，None为不量化（fp32），"bf16"、"int8"（CPU动态量化）或"4bit"（bitsandbytes），
+# 量化可以减少内存占用并加快CPU上的解码，输出会与fp32略有差异，可用`benchmark/local_quantization.py`比较
+LOCAL_MODEL_QUANTIZATION = None
+
+# 投机解码的草稿模型路径，如主模型为7B蒸馏模型时使用"./model/DeepSeek-R1-Distill-Qwen-1.5B"，为None时不使用
+# 草稿模型每次预测`LOCAL_DRAFT_TOKENS`个token交给主模型验证；"constant"为固定数量，"heuristic"为根据接受情况动态调整
+LOCAL_DRAFT_MODEL_PATH = None
+LOCAL_DRAFT_TOKENS = 5
+LOCAL_DRAFT_SCHEDULE = "heuristic"
+
+# `local_server.py`的端口，将`API_URL`设置为"http://127.0.0.1:8001/v1"即可使用本地模型
+LOCAL_SERVER_PORT = 8001
+
+# 动态批处理：每个批次最多的请求数，以及收到第一个请求后为凑满批次最多等待的时间（秒）
+LOCAL_BATCH_MAX_SIZE = 8
+LOCAL_BATCH_MAX_WAIT = 0.02
+
+# 本地模型（`DeepseekLocal`）各会话KV缓存的总大小上限（字节），超出时淘汰最久未使用的会话，为0时不限制
+LOCAL_KV_CACHE_MAX_BYTES = 2 * 1024**3
+
+# 相同的系统提示只计算一次KV缓存，新会话复制该缓存后再计算之后的对话
+LOCAL_PREFIX_CACHE = True
+
 # RAG_SETTINGS
 
 # 单独使用一个SQLITE数据库，方便测试.....
@@ -56,4 +254,7 @@ RAG_CLUSTER_SIZE = 5
 RAG_CLSSIFICATION_ALG = "kmeans"
 
 # 生成树时是否生成描述（描述使用文本总结模型生成）
-RAG_INIT_TREE_WITH_DES = True
\ No newline at end of file
+RAG_INIT_TREE_WITH_DES = True
+# RAG对话中参考文档的位置，"user"为放在用户最新的消息中，系统提示与历史对话每轮保持不变，服务商的前缀缓存可以命中；
+# "system"为拼接在系统提示之后（每轮都会改变对话开头，前缀缓存无法命中）
+RAG_PROMPT_LAYOUT = "user"
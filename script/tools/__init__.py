@@ -1,8 +1,13 @@
 import sys
+import json
+import time
 import inspect
+import threading
 import tools.tools as tools
 
 from typing import List
+from collections import deque
+from setting import settings
 
 
 def get_all_tool_names():
@@ -59,6 +64,117 @@ def call_tool_by_name(tool_name, *args, **kwargs):
             return tool["obj"](*args, **kwargs)
 
 
+class _ToolSlots:
+    """
+    进程内共享的工具并发数限制
+    名额在工具线程实际退出时才归还，因此同时存活的工具线程数不超过上限；
+    超时只是不再等待结果，超时的工具在后台执行完毕前仍占用名额
+    """
+
+    def __init__(self, max_workers: int):
+        self.cond = threading.Condition()
+        self.free = max_workers
+
+
+class _ToolCall:
+    def __init__(self, tool_calling: dict, slots: _ToolSlots):
+        self.tool_calling = tool_calling
+        self.slots = slots
+        self.queued = time.monotonic()
+        self.started = None
+        self.finished = False
+        self.result = None
+
+    def start(self):
+        # 调用时需持有`slots.cond`，计时从开始执行时算起，排队的时间不计入超时
+        self.started = time.monotonic()
+        threading.Thread(target=self.__run, name="tool", daemon=True).start()
+
+    def running(self):
+        return self.started is not None and not self.finished
+
+    def expire(self, result: str):
+        # 调用时需持有`slots.cond`；线程无法被强制终止，超时的工具会在后台继续执行，但结果不再被使用
+        self.finished = True
+        self.result = result
+
+    def __run(self):
+        try:
+            result = _call_tool(self.tool_calling["name"], self.tool_calling.get("args"))
+        except Exception as e:
+            result = "工具调用出错：{}".format(e)
+        with self.slots.cond:
+            # 无论是否已超时，线程退出时都归还名额
+            self.slots.free += 1
+            self.slots.cond.notify_all()
+            if not self.finished:
+                self.finished = True
+                self.result = result
+
+
+_slots = None
+_slots_lock = threading.Lock()
+
+
+def get_tool_slots() -> _ToolSlots:
+    """
+    获取进程内共享的工具并发数限制，同时执行的工具数由`settings.TOOL_MAX_WORKERS`限制
+    """
+    global _slots
+    if _slots is None:
+        with _slots_lock:
+            if _slots is None:
+                _slots = _ToolSlots(settings.TOOL_MAX_WORKERS)
+    return _slots
+
+
+def _call_tool(tool_name, tool_arg):
+    if tool_arg is None:
+        tool_arg = {}
+    # 部分模型会将参数编码两次
+    while type(tool_arg) == str:
+        tool_arg = json.loads(tool_arg) if tool_arg.strip() else {}
+    return call_tool_by_name(tool_name, **tool_arg)
+
+
+def call_tools(tool_callings: list[dict], timeout: float | None = None):
+    """
+    并发调用同一轮中的多个工具
+    ---------------------
+    :param tool_callings: 工具调用列表，每项为`{"name": 工具名, "args": 参数（对象或JSON字符串）, "id": 调用ID（可选）}`
+    :param timeout: 单个工具调用的超时时间（秒），从该调用开始执行时计时（等待并发名额的时间不计入），
+    默认为`settings.TOOL_TIMEOUT`；等待并发名额的时间同样不超过该值（名额都被超时仍未退出的工具占用时不会一直等待）
+    :return: 与调用列表顺序一致的结果列表，每项为`{"name": 工具名, "id": 调用ID, "result": 结果}`，
+    出错或超时的调用以错误信息作为结果，不影响其它调用
+    """
+    timeout = settings.TOOL_TIMEOUT if timeout is None else timeout
+    slots = get_tool_slots()
+    calls = [_ToolCall(tool_calling, slots) for tool_calling in tool_callings]
+    pending = deque(calls)
+    with slots.cond:
+        while True:
+            now = time.monotonic()
+            for call in calls:
+                if call.running() and now - call.started >= timeout:
+                    call.expire("工具调用超时（{}秒）".format(timeout))
+            while pending and slots.free > 0:
+                slots.free -= 1
+                pending.popleft().start()
+            while pending and now - pending[0].queued >= timeout:
+                pending.popleft().expire("工具调用排队超时（{}秒）".format(timeout))
+            running = [call for call in calls if call.running()]
+            if not pending and not running:
+                break
+            # 等待某个调用结束、超时，或其它调用归还名额
+            deadlines = [call.started + timeout for call in running]
+            deadlines.extend(call.queued + timeout for call in pending)
+            slots.cond.wait(max(min(deadlines) - now, 0))
+    return [
+        {"name": call.tool_calling["name"], "id": call.tool_calling.get("id"), "result": call.result}
+        for call in calls
+    ]
+
+
 def get_tool_description():
     """
     生成所有工具的描述，只对如下格式的工具有效：
@@ -1,14 +1,28 @@
 import os
+import re
 import json
+import time
 import tools
 import do
 import asyncio
+import threading
 from rag import RAG
 from setting import prompt
 from datetime import datetime
 from pathlib import Path
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from common.models import OpenAi, Audio
 from common import systemInfo
+from common.transport import get_transport, close_async_transport
+from common.cache import get_completion_cache, get_attachment_cache
+from common.image import guess_mime, get_image_preprocessor
+from common.summarize import get_text_summarizer
+from common.context import get_context_window, format_rag_documents, layout_rag_prompt
+from common.balancer import get_endpoint_pool
+from common.ratelimit import get_rate_limiter
+from common.singleflight import get_single_flight
+from common.telemetry import get_telemetry
 from pydantic import BaseModel
 from fastapi import FastAPI, UploadFile, Body
 from setting.settings import *
@@ -17,7 +31,14 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from sse_starlette import EventSourceResponse
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # 关闭服务所在事件循环的异步连接池
+    await close_async_transport()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
@@ -42,25 +63,34 @@ class ImagePromptInitializer:
         self.images = []
 
     def __to_base_64(self, image_url: str, is_url=False):
+        """
+        返回`(MIME类型, base64编码)`，本地图片按`IMAGE_PREPROCESS`缩小并重新编码
+        """
         import base64
 
         if is_url:
             rsp = self.request("GET", image_url)
-            return base64.b64encode(rsp.data).decode("utf-8")
+            data, mime = rsp.data, guess_mime(image_url, rsp.data)
+        elif IMAGE_PREPROCESS:
+            data, mime = get_image_preprocessor()(image_url)
         else:
             with open(image_url, "rb") as f:
-                return base64.b64encode(f.read()).decode("utf-8")
-
-    def add(self, image_url: str, is_url=False):
+                data = f.read()
+            mime = guess_mime(image_url, data)
+        return mime, base64.b64encode(data).decode("utf-8")
+
+    def add(self, image_url: str, is_url=False, label: str | None = None):
+        if label is not None:
+            # 多张图片时在每张图片前加上序号，便于模型分别描述
+            self.images.append({"type": "text", "text": label})
         if is_url:
             self.images.append({"type": "image_url", "image_url": image_url})
         else:
+            mime, data = self.__to_base_64(image_url, is_url)
             self.images.append(
                 {
                     "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{self.__to_base_64(image_url, is_url)}"
-                    },
+                    "image_url": {"url": f"data:{mime};base64,{data}"},
                 }
             )
 
@@ -71,6 +101,49 @@ class ImagePromptInitializer:
         return content
 
 
+def split_image_descriptions(text: str, count: int) -> list[str | None]:
+    """
+    按"[图片n]"标记拆分多张图片的描述
+    -----------------
+    :param text: 图片模型的回复
+    :param count: 图片数量
+    :return: 每张图片的描述，缺少某张图片的描述时该项为None
+    """
+    parts = re.split(r"^[#>*\s]*\[图片\s*(\d+)\][*]*[:：]?[*]*", text, flags=re.M)
+    descriptions = {}
+    for idx in range(1, len(parts) - 1, 2):
+        description = parts[idx + 1].strip()
+        if description:
+            descriptions[int(parts[idx])] = description
+    return [descriptions.get(idx) for idx in range(1, count + 1)]
+
+
+def attachment_kind(attachment: dict):
+    """
+    附件类型，"image"、"text"、"audio"或None（不支持的类型）
+    """
+    for kind in ("image", "text", "audio"):
+        if str(attachment["type"]).find(kind) != -1:
+            return kind
+    return None
+
+
+# 正在处理的附件的进度，`{附件名: {"done": 已完成段数, "total": 总段数}}`，处理完成后移除
+attachment_progress = {}
+attachment_progress_lock = threading.Lock()
+
+
+def set_attachment_progress(name: str, done: int | None, total: int | None = None):
+    """
+    更新附件的处理进度，done为None时移除
+    """
+    with attachment_progress_lock:
+        if done is None:
+            attachment_progress.pop(name, None)
+        else:
+            attachment_progress[name] = {"done": done, "total": total}
+
+
 class ChatRequest(BaseModel):
     model: str
     prompt: str
@@ -79,53 +152,226 @@ class ChatRequest(BaseModel):
     settings: dict
 
     def attachment_handler(self):
-        results = []
+        """
+        并发处理本次请求的所有附件
+        -----------------
+        :return: 与附件顺序一致的结果列表（跳过不支持的附件），每项为`{"type": 类型, "result": 结果, "time": 耗时（秒）}`，
+        处理出错的附件另有`error`字段，不影响其它附件
+        """
+        attachments = []
         for attachment in self.attachments:
-            if str(attachment["type"]).find("image") != -1:
-                model = OpenAi.OpenAi(API_URL, API_KEY, IMAGE_HANDLER)
-                model.system_prompt = prompt.IMAGE_PROMPT
-                image_prompt = ImagePromptInitializer(self.prompt)
-                image_prompt.add(os.path.join(UPLOAD_PATH, attachment["name"]))
-                res = model(image_prompt())
-                results.append({"type": "image", "result": res})
-            elif str(attachment["type"]).find("text") != -1:
-                content = ""
-                with open(
-                    os.path.join(UPLOAD_PATH, attachment["name"]), "r", encoding="utf-8"
-                ) as f:
-                    content = f.read()
-                    f.close()
-                model = OpenAi.OpenAi(API_URL, API_KEY, TEXT_HANDLER)
-                model.system_prompt = prompt.TEXT_PROMPT
-                res = model(content)
-                results.append({"type": "text", "result": res})
-            elif str(attachment["type"]).find("audio") != -1:
-                model = Audio.AudioModel(API_URL, API_KEY, VOICE_HANDLER)
-                with open(os.path.join(UPLOAD_PATH, attachment["name"]), "rb") as f:
-                    res = model(f)
-                    results.append({"type": "audio", "result": res})
+            kind = attachment_kind(attachment)
+            if kind is not None:
+                attachments.append((kind, attachment))
+            # 其它文件，如Word文档、视频、Excel等暂不处理
+        if not attachments:
+            return []
+        # 图片按`ATTACHMENT_IMAGE_BATCH_SIZE`分组，每组合并为一次图片模型调用，其它附件各自处理
+        jobs, images = [], []
+        for idx, (kind, attachment) in enumerate(attachments):
+            if kind == "image" and ATTACHMENT_IMAGE_BATCH_SIZE > 1:
+                images.append(idx)
+                if len(images) == ATTACHMENT_IMAGE_BATCH_SIZE:
+                    jobs.append(images)
+                    images = []
+            else:
+                jobs.append([idx])
+        if images:
+            jobs.append(images)
+
+        results = [None] * len(attachments)
+        with ThreadPoolExecutor(
+            max_workers=min(ATTACHMENT_MAX_WORKERS, len(jobs)),
+            thread_name_prefix="attachment",
+        ) as executor:
+            futures = [
+                executor.submit(
+                    self.run_image_batch, [attachments[idx][1] for idx in job]
+                )
+                if len(job) > 1
+                else executor.submit(self.run_attachment, *attachments[job[0]])
+                for job in jobs
+            ]
+            for job, future in zip(jobs, futures):
+                job_results = future.result()
+                if len(job) == 1:
+                    job_results = [job_results]
+                for idx, result in zip(job, job_results):
+                    results[idx] = result
+        return results
+
+    def run_attachment(self, kind: str, attachment: dict):
+        start = time.perf_counter()
+        try:
+            result = {"type": kind, "result": self.handle_attachment(kind, attachment)}
+        except Exception as e:
+            result = {"type": kind, "result": "Error: {}".format(e), "error": str(e)}
+        result["time"] = time.perf_counter() - start
+        return result
+
+    def run_image_batch(self, attachments: list[dict]):
+        """
+        将多张图片合并为一次图片模型调用
+        -----------------
+        :return: 与图片顺序一致的结果列表，每张图片的耗时均为整组的耗时；
+        只有一张图片未命中缓存，或回复中缺少某张图片的描述时，该图片单独调用一次；
+        合并调用与单独调用的结果按各自使用的提示分别缓存，读取时两者都可使用
+        """
+        start = time.perf_counter()
+        cache = get_attachment_cache()
+        paths = [os.path.join(UPLOAD_PATH, attachment["name"]) for attachment in attachments]
+        keys = [self.image_cache_key(path) for path in paths]
+        batch_keys = [self.image_cache_key(path, batch=True) for path in paths]
+        descriptions = [
+            cache.get(key) or cache.get(batch_key)
+            for key, batch_key in zip(keys, batch_keys)
+        ]
+        missing = [idx for idx, description in enumerate(descriptions) if description is None]
+
+        errors = {}
+        batched = set()
+        if len(missing) > 1:
+            try:
+                batch = self.describe_images([paths[idx] for idx in missing])
+                for idx, description in zip(missing, batch):
+                    descriptions[idx] = description
+                    if description is not None:
+                        batched.add(idx)
+            except Exception as e:
+                for idx in missing:
+                    errors[idx] = e
+        for idx in missing:
+            if descriptions[idx] is None and idx not in errors:
+                try:
+                    descriptions[idx] = self.describe_image(paths[idx])
+                except Exception as e:
+                    errors[idx] = e
+            if descriptions[idx] is not None and not descriptions[idx].startswith(
+                "Request Error:"
+            ):
+                key = batch_keys[idx] if idx in batched else keys[idx]
+                cache.set(key, descriptions[idx])
+
+        elapsed = time.perf_counter() - start
+        results = []
+        for idx in range(len(attachments)):
+            if idx in errors:
+                results.append(
+                    {
+                        "type": "image",
+                        "result": "Error: {}".format(errors[idx]),
+                        "error": str(errors[idx]),
+                        "time": elapsed,
+                    }
+                )
             else:
-                # 处理其它文件，如音频、Word文档、视频、Excel等
-                pass
+                results.append({"type": "image", "result": descriptions[idx], "time": elapsed})
         return results
 
+    def describe_image(self, path: str) -> str:
+        model = OpenAi.OpenAi(API_URL, API_KEY, IMAGE_HANDLER)
+        model.system_prompt = prompt.IMAGE_PROMPT
+        image_prompt = ImagePromptInitializer(self.prompt)
+        image_prompt.add(path)
+        return model(image_prompt())
+
+    def describe_images(self, paths: list[str]) -> list[str | None]:
+        """
+        一次调用描述多张图片
+        -----------------
+        :return: 每张图片的描述，回复中缺少某张图片的描述时该项为None；请求出错时每项均为错误信息
+        """
+        model = OpenAi.OpenAi(API_URL, API_KEY, IMAGE_HANDLER)
+        model.system_prompt = prompt.IMAGE_BATCH_PROMPT.format(count=len(paths))
+        image_prompt = ImagePromptInitializer(self.prompt)
+        for number, path in enumerate(paths, 1):
+            image_prompt.add(path, label="[图片{}]".format(number))
+        res = model(image_prompt())
+        if res.startswith("Request Error:"):
+            return [res] * len(paths)
+        return split_image_descriptions(res, len(paths))
+
+    def image_cache_key(self, path: str, batch: bool = False):
+        # 图片描述与用户的问题有关，问题也作为缓存键的一部分；合并调用使用的提示不同，结果分开缓存
+        image_prompt = prompt.IMAGE_BATCH_PROMPT if batch else prompt.IMAGE_PROMPT
+        return get_attachment_cache().make_key(
+            path, IMAGE_HANDLER, [image_prompt, self.prompt]
+        )
+
+    def handle_attachment(self, kind: str, attachment: dict) -> str:
+        """
+        处理单个附件，结果按文件内容缓存，同一文件再次被引用时直接返回上次的结果
+        """
+        path = os.path.join(UPLOAD_PATH, attachment["name"])
+        cache = get_attachment_cache()
+        if kind == "image":
+            key = self.image_cache_key(path)
+            res = cache.get(key)
+            if res is None:
+                res = self.describe_image(path)
+                if not res.startswith("Request Error:"):
+                    cache.set(key, res)
+            return res
+        elif kind == "text":
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+            summarizer = get_text_summarizer()
+            if not summarizer.needs_summary(content):
+                # 较短的文本直接放入对话
+                return content
+            key = cache.make_key(
+                path,
+                TEXT_HANDLER,
+                [prompt.TEXT_PROMPT, prompt.TEXT_CHUNK_PROMPT, prompt.TEXT_REDUCE_PROMPT],
+                chunk_tokens=TEXT_CHUNK_TOKENS,
+            )
+            res = cache.get(key)
+            if res is None:
+                res = summarizer(content)
+                if not res.startswith("Request Error:"):
+                    cache.set(key, res)
+            return res
+        else:
+            # 切分方式会影响转写结果的格式（分段时带有时间戳）
+            key = cache.make_key(
+                path,
+                VOICE_HANDLER,
+                segment_seconds=AUDIO_SEGMENT_SECONDS,
+                segment_mode=AUDIO_SEGMENT_MODE,
+                segment_max_bytes=AUDIO_SEGMENT_MAX_BYTES,
+                sample_rate=AUDIO_SAMPLE_RATE,
+            )
+            res = cache.get(key)
+            if res is None:
+                model = Audio.AudioModel(API_URL, API_KEY, VOICE_HANDLER)
+                # 长音频分段转写耗时较长，进度可通过`/attachment/progress/{附件名}`查询
+                name = attachment["name"]
+                set_attachment_progress(name, 0)
+                try:
+                    with open(path, "rb") as f:
+                        res = model(
+                            f,
+                            progress=lambda done, total: set_attachment_progress(
+                                name, done, total
+                            ),
+                        )
+                finally:
+                    set_attachment_progress(name, None)
+                if "Error:" not in res:
+                    cache.set(key, res)
+            return res
+
 
 class ToolRequest(BaseModel):
     tools: list[dict] = []
 
     def get_tools_result(self):
-        results = []
-        for tool_calling in self.tools:
-            tool_name = tool_calling["name"]
-            if "args" not in tool_calling:
-                tool_arg = {}
-            else:
-                tool_arg = tool_calling["args"]
-            if type(tool_arg) == str:
-                tool_arg = json.loads(tool_arg)
-            result = tools.call_tool_by_name(tool_name, **tool_arg)
-            results.append({"name": tool_name, "result": str(result)})
-        return results
+        # 同一轮中的多个工具并发执行，结果按原顺序返回
+        results = tools.call_tools(self.tools)
+        return [
+            {"name": result["name"], "result": str(result["result"])}
+            for result in results
+        ]
 
 
 def get_default_settings():
@@ -158,6 +404,29 @@ def get_system_info():
     system_info["memery"] = systemInfo.GetMemInfo()
     return system_info
 
+
+@app.get("/stats")
+def get_stats():
+    # 运行时统计信息，如连接池的复用情况
+    return {
+        "http": get_transport().stats(),
+        "completion_cache": get_completion_cache().stats(),
+        "attachment_cache": get_attachment_cache().stats(),
+        "image_preprocess": get_image_preprocessor().stats(),
+        "context": get_context_window().stats(),
+        "endpoints": get_endpoint_pool().stats() if API_ENDPOINTS else None,
+        "rate_limit": get_rate_limiter().stats(),
+        "single_flight": get_single_flight().stats(),
+        "telemetry": get_telemetry().stats(),
+    }
+
+@app.get("/attachment/progress/{file_name}")
+def get_attachment_progress(file_name: str):
+    # 附件的处理进度，未在处理中（未开始或已完成）时返回None
+    with attachment_progress_lock:
+        return attachment_progress.get(file_name)
+
+
 @app.get("/models")
 def get_models():
     return OpenAi.OpenAi(API_URL, API_KEY, DEFAULT_MODEL).get_models()
@@ -227,18 +496,26 @@ def delete_conversation(conversation_id: str):
 
 @app.post("/title")
 def get_title(messages: list[dict]):
-    title_summerizer_settings = {"stream": True, "system_prompt": prompt.TITLE_PROMPT}
+    title_summerizer_settings = {
+        "stream": True,
+        "system_prompt": prompt.TITLE_PROMPT,
+        "enable_cache": True,
+    }
     model = OpenAi.OpenAi(
         API_URL, API_KEY, TITLE_SUMMERIZER, **title_summerizer_settings
     )
     _prompt = "对话内容:{}".format(messages)
-    return StreamingResponse(model.call_stream(_prompt), media_type="text/event-stream")
+    return StreamingResponse(
+        model.call_stream(_prompt, parse_message=False), media_type="text/event-stream"
+    )
 
 
 @app.post("/chat")
 def chat(chatRequest: ChatRequest):
     model = OpenAi.OpenAi(API_URL, API_KEY, chatRequest.model, **chatRequest.settings)
     model.messages = chatRequest.message_list
+    # 前端每轮都会发送完整对话，按模型的token预算裁剪
+    model.context_window = get_context_window()
     attach_result = chatRequest.attachment_handler()
     _prompt = chatRequest.prompt
     if attach_result != []:
@@ -258,7 +535,10 @@ def chat(chatRequest: ChatRequest):
 async def char_stream(chatRequest: ChatRequest):
     model = OpenAi.OpenAi(API_URL, API_KEY, chatRequest.model, **chatRequest.settings)
     model.messages = chatRequest.message_list
-    attach_result = chatRequest.attachment_handler()
+    # 前端每轮都会发送完整对话，按模型的token预算裁剪
+    model.context_window = get_context_window()
+    # 附件处理是阻塞调用，放到线程中执行，避免阻塞事件循环上的其它连接
+    attach_result = await asyncio.to_thread(chatRequest.attachment_handler)
     _prompt = chatRequest.prompt
     if attach_result != []:
         _prompt += "附件：\n"
@@ -269,7 +549,9 @@ async def char_stream(chatRequest: ChatRequest):
                 _prompt += "一个文本文件，内容如下：\n{}\n".format(result["result"])
             elif result["type"] == "audio":
                 _prompt += "一个音频文件，内容如下：\n{}\n".format(result["result"])
-    return StreamingResponse(model.call_stream(_prompt), media_type="text/event-stream")
+    return StreamingResponse(
+        model.astream(_prompt, parse_message=False), media_type="text/event-stream"
+    )
 
 
 @app.get("/default_settings")
@@ -364,8 +646,7 @@ async def rag_get_settings():
 @app.post("/rag/relatives")
 async def get_relatives(query: str = Body(..., title="query", embed=True, description="查询"), 
                         top_k: int = Body(4, title="top_k", embed=True, description="top_k")):
-    rag = RAG("")
-    rag_result = rag.search(query, top_k)
+    rag_result = await asyncio.to_thread(lambda: RAG("").search(query, top_k))
     search_list = []
     cmap = {}
     for idx, doc in enumerate(rag_result["documents"][0]):
@@ -394,7 +675,9 @@ async def rag_chat(chatRequest: ChatRequest):
     # 默认为SSE
     model = OpenAi.OpenAi(API_URL, API_KEY, chatRequest.model, **chatRequest.settings)
     model.messages = chatRequest.message_list
-    attach_result = chatRequest.attachment_handler()
+    # 前端每轮都会发送完整对话，按模型的token预算裁剪
+    model.context_window = get_context_window()
+    attach_result = await asyncio.to_thread(chatRequest.attachment_handler)
     _prompt = chatRequest.prompt
     if attach_result != []:
         _prompt += "附件：\n"
@@ -407,35 +690,15 @@ async def rag_chat(chatRequest: ChatRequest):
                 _prompt += "一个音频文件，内容如下：\n{}\n".format(result["result"])
     # 处理RAG
     top_k = chatRequest.settings["top_k"] if "top_k" in chatRequest.settings else 4
-    rag = RAG("")   # 只处理搜索时不用文件名，也不必初始化
-    rag_result = rag.search(_prompt, top_k)
-    result_num = len(rag_result["documents"][0])
-    rag_prompt = chatRequest.settings["system_prompt"]
-    if result_num != 0:
-        rag_prompt += "参考文档：\n"
-    cmap = {}
-    for idx, doc in enumerate(rag_result["documents"][0]):
-        file_name = rag_result["metadatas"][0][idx]["file_name"]
-        start_line = rag_result["metadatas"][0][idx]["start_line"]
-        end_line = rag_result["metadatas"][0][idx]["end_line"]
-        dis = rag_result["distances"][0][idx]
-        # if dis > 0.26:
-        #     continue
-        unique = "{}{}{}".format(file_name, start_line, end_line)
-        if unique in cmap:
-            continue
-        else:
-            cmap[unique] = True
-        rag_prompt += "文件名：{}\n".format(file_name)
-        rag_prompt += "开始行数：{}\n".format(start_line)
-        rag_prompt += "结束行数：{}\n".format(end_line)
-        rag_prompt += "相关度：{}\n".format(1 - dis)
-        rag_prompt += "内容：\n{}\n\n".format(doc)
-    if chatRequest.message_list != []:
-        for idx in range(len(model.messages)):
-            if model.messages[idx]["role"] == "system":
-                model.messages[idx]["content"] = rag_prompt
-                break
-    else:
-        model.system_prompt = rag_prompt
-    return StreamingResponse(model.call_stream(_prompt), media_type="text/event-stream")
\ No newline at end of file
+    # 只处理搜索时不用文件名，也不必初始化；加载Embedding模型与搜索均为阻塞调用
+    rag_result = await asyncio.to_thread(lambda: RAG("").search(_prompt, top_k))
+    # 系统提示与历史对话每轮保持不变，参考文档默认放在最新的用户消息中，便于服务商的前缀缓存命中
+    model.messages, _prompt = layout_rag_prompt(
+        chatRequest.message_list,
+        chatRequest.settings["system_prompt"],
+        _prompt,
+        format_rag_documents(rag_result),
+    )
+    return StreamingResponse(
+        model.astream(_prompt, parse_message=False), media_type="text/event-stream"
+    )
\ No newline at end of file